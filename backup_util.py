@@ -5,34 +5,295 @@ import glob
 import os
 import datetime
 import subprocess
-import boto3
-from botocore.exceptions import ClientError
+# boto3, botocore, smtplib, email and cryptography are imported when first needed to keep one-shot calls quick to start
 import tempfile
 import shutil
-
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.utils import formatdate
+import concurrent.futures
+import multiprocessing
+import threading
+import time
+import json
+import re
+import hashlib
+import hmac
+import sqlite3
+import stat
+import zlib
+import collections
+import fnmatch
+import atexit
+import base64
+import queue
+import random
+import signal
+import fcntl
 
 MAX_ARCHIVE_AGE_DAYS = 20
+# Grandfather-father-son retention of the archives, e.g. {'daily': 7, 'weekly': 4, 'monthly': 12} keeps the newest archive
+# of each of the last 7 days, 4 weeks and 12 months having any, 'yearly' is supported too.
+# None keeps the archives modified within MAX_ARCHIVE_AGE_DAYS.
+# The policy applies to the series of archives of a job, named alike but for their timestamp. Archives named
+# with no timestamp (e.g. with a counter as backup-17.7z) cannot be told apart that way: the ones named as
+# the job archive up to its last number are kept for MAX_ARCHIVE_AGE_DAYS whatever the policy
+RETENTION_POLICY = None
+# S3 deletes are batched by that many keys, the most DeleteObjects accepts
+S3_DELETE_BATCH_SIZE = 1000
+
+# Streaming uploads keep at most STREAM_MAX_PARTS_IN_FLIGHT + 1 parts in memory
+STREAM_PART_SIZE = 64 * 1024 * 1024
+STREAM_MAX_PARTS_IN_FLIGHT = 4
+
+# Uploads of existing files
+UPLOAD_PART_SIZE = 64 * 1024 * 1024
+UPLOAD_MAX_CONCURRENCY = 8
+# Total upload bandwidth cap in bytes per second shared by all upload threads, None for no limit
+UPLOAD_MAX_BANDWIDTH = None
+# Files uploaded at once by backup_latest() in sync mode
+SYNC_MAX_CONCURRENCY = 4
+# Multipart uploads initiated earlier than that are considered left by crashed runs
+STALE_UPLOAD_MAX_AGE_HOURS = 48
+# Journals of the multipart uploads in progress, an interrupted upload of the same file resumes from its journal
+UPLOAD_JOURNAL_DIR = os.path.expanduser('~/.cache/backup_util/uploads')
+
+# Downloads fetch byte ranges of that size concurrently, streaming restores keep at most that many ranges in memory
+DOWNLOAD_PART_SIZE = 64 * 1024 * 1024
+DOWNLOAD_MAX_CONCURRENCY = 8
+
+# Deduplicating backups: chunks are DEDUP_MIN_CHUNK_SIZE + 2 ** DEDUP_AVG_CHUNK_BITS bytes long on average
+DEDUP_MIN_CHUNK_SIZE = 512 * 1024
+DEDUP_AVG_CHUNK_BITS = 19
+DEDUP_MAX_CHUNK_SIZE = 4 * 1024 * 1024
+DEDUP_PACK_SIZE = 32 * 1024 * 1024
+DEDUP_KEY_PREFIX = 'dedup/'
+# Packs uploaded within that many hours are never pruned, they may belong to a snapshot still being made
+DEDUP_PRUNE_GRACE_HOURS = 24
+# Local index of the chunks stored in each bucket
+DEDUP_INDEX_DIR = os.path.expanduser('~/.cache/backup_util')
+
+# Persistent git mirrors refreshed by incremental fetches
+GIT_MIRROR_CACHE_DIR = os.path.expanduser('~/.cache/backup_util/git')
+GIT_MAX_PARALLEL_FETCHES = 8
+# Incremental git backups make a full bundle again every that many days
+GIT_FULL_BACKUP_INTERVAL_DAYS = 7
+
+# Chains of incremental archives: the full archive each of them builds on, retention keeps the chains whole
+INCREMENTAL_STATE_DIR = os.path.expanduser('~/.cache/backup_util/incremental')
+
+# Persistent hotcopies and the last backed up revisions of svn repos backed up incrementally
+SVN_STAGING_DIR = os.path.expanduser('~/.cache/backup_util/svn')
+# Incremental svn dumps start again from r0 every that many days
+SVN_FULL_DUMP_INTERVAL_DAYS = 7
+
+# MySQL parallel dumps and incremental backups shipping binary logs
+MYSQL_DUMP_THREADS = 4
+MYSQL_FULL_BACKUP_INTERVAL_DAYS = 7
+MYSQL_STATE_DIR = os.path.expanduser('~/.cache/backup_util/mysql')
+# Extra options of mysql, mysqlbinlog and mydumper, e.g. ['--defaults-file=/path/to/test-instance.cnf']
+MYSQL_CLIENT_OPTIONS = []
+
+# Indexed archives are made of separately encrypted segments holding about that much source data each
+# (a bigger file makes a segment as big, restored as it is downloaded anyway), the index uploaded next to the archive under its name + INDEX_KEY_SUFFIX tells which segment holds each file
+INDEX_SEGMENT_SIZE = 64 * 1024 * 1024
+INDEX_KEY_SUFFIX = '.index'
+
+# Encryption of the tar based archives, see Encryption. 'gpg' pipes them through gpg, 'aes-gcm' encrypts them
+# in process in ENCRYPTION_CHUNK_SIZE chunks authenticated one by one by ENCRYPTION_THREADS threads (None for all cores)
+# and needs the cryptography package. 7z archives are encrypted by 7za, with 'aes-gcm' 7z means xz as for streaming.
+# Indexed archives encrypt each of their segments and their index on its own the same way
+ARCHIVE_ENCRYPTION = 'gpg'
+ENCRYPTION_CHUNK_SIZE = 1024 * 1024
+ENCRYPTION_THREADS = None
+
+# Fingerprints of the sources as of their last successful backup, jobs with skip_unchanged are skipped
+# while the fingerprint of their source stays the same. Directories are walked by that many threads
+FINGERPRINT_DIR = os.path.expanduser('~/.cache/backup_util/fingerprints')
+FINGERPRINT_WALK_WORKERS = 8
+
+# Compression of the archives, see Codec. Streamed and indexed archives are tar based, for them 7z means xz
+ARCHIVE_CODEC = '7z'
+# Level of the codec (0-9 for 7z and xz, 1-22 for zstd), None for the codec default
+ARCHIVE_COMPRESSION_LEVEL = None
+# Compression threads, None to use all cores
+COMPRESSION_THREADS = None
+# Store the files that are already compressed as they are instead of compressing them once more.
+# They are recognized by extension or by a sample of INCOMPRESSIBLE_SAMPLE_SIZE bytes that zlib fails to shrink
+# below INCOMPRESSIBLE_RATIO of its size
+STORE_COMPRESSED_FILES = True
+COMPRESSED_EXTENSIONS = frozenset(['.gz', '.tgz', '.bz2', '.xz', '.txz', '.zst', '.lz4', '.lzma', '.7z', '.zip', '.rar',
+                                   '.jar', '.war', '.apk', '.gpg', '.bundle', '.pack', '.jpg', '.jpeg', '.png', '.gif',
+                                   '.webp', '.heic', '.mp3', '.mp4', '.m4a', '.m4v', '.mkv', '.avi', '.mov', '.webm',
+                                   '.ogg', '.flac', '.pdf', '.docx', '.xlsx', '.pptx', '.odt'])
+INCOMPRESSIBLE_SAMPLE_SIZE = 64 * 1024
+INCOMPRESSIBLE_RATIO = 0.95
+
+# Each finished backup job appends its status and phases as a JSON line to METRICS_JSONL_PATH
+# and writes them to a .prom file in METRICS_TEXTFILE_DIR for the node_exporter textfile collector, None to skip
+METRICS_JSONL_PATH = None
+METRICS_TEXTFILE_DIR = None
+
+# Log records are buffered up to LOG_BUFFER_SIZE bytes or LOG_FLUSH_INTERVAL seconds and flushed
+# at the end of each backup phase
+LOG_BUFFER_SIZE = 64 * 1024
+LOG_FLUSH_INTERVAL = 5
+
+# The output of the commands run by the backups is logged line by line as it comes,
+# their status keeps only the last COMMAND_OUTPUT_TAIL_LINES lines
+COMMAND_OUTPUT_TAIL_LINES = 100
+# Timeouts in seconds of the commands by program name, e.g. {'svn': 3600, 'git': 7200}. No timeout by default
+COMMAND_TIMEOUTS = {}
+# Seconds to wait for the output of a finished command to be closed. Then the processes left by the command
+# still holding its output open are killed with its whole process group, background helpers the command
+# starts on purpose must redirect their output to survive
+COMMAND_OUTPUT_GRACE = 10
+
+# The backup jobs stage their dumps in the first of STAGING_DIRS with room for them, each entry is
+# (dir, max bytes staged there by one job or None), e.g. [('/dev/shm/backup_util', 1024 ** 3), ('/var/tmp', None)]
+# keeps the dumps estimated below 1 GiB on tmpfs. No entries means the default temp dir.
+# The estimates are based on the size of the source and the sizes of the previous dumps and archives of the job
+# times STAGING_ESTIMATE_MARGIN, the space is reserved across all the backups running on the host.
+# With no previous backup the archive is guessed as STAGING_GUESS_ARCHIVE_RATIO of the data archived
+# and a job which does not fit anyway only logs a warning, it fails on estimates from recorded sizes only
+STAGING_DIRS = []
+STAGING_ESTIMATE_MARGIN = 1.2
+STAGING_GUESS_ARCHIVE_RATIO = 0.5
+# A job waits that many seconds at most for the space reserved by other jobs to be released,
+# it fails right away when the space would not do anyway
+STAGING_WAIT_TIMEOUT = 600
+STAGING_STATE_DIR = os.path.expanduser('~/.cache/backup_util/staging')
+
+# Default concurrency of run_backup_jobs()
+JOB_MAX_ARCHIVE_WORKERS = 2
+JOB_MAX_UPLOAD_WORKERS = 4
+# NotificationQueue keeps its SMTP connection open for this many seconds after the last mail
+NOTIFY_SMTP_IDLE_TIMEOUT = 30
+# and tries to send a mail this many times, each time over a new connection, waiting NOTIFY_RETRY_BACKOFF seconds
+# before the second attempt and twice as long before each next one
+NOTIFY_MAX_ATTEMPTS = 3
+NOTIFY_RETRY_BACKOFF = 2
+# Mails still not sent are spooled there and sent once a connection to the SMTP server succeeds again
+NOTIFY_SPOOL_DIR = os.path.expanduser('~/.cache/backup_util/mail')
+# run_daemon() checks the job file for changes and the jobs for being due at least this often, in seconds
+DAEMON_POLL_INTERVAL = 60
+
+# Settings of the shared S3 clients, change them with configure_s3_clients()
+S3_MAX_POOL_CONNECTIONS = 32
+S3_RETRY_MODE = 'adaptive'
+S3_MAX_RETRY_ATTEMPTS = 10
+# {bucket_name: region_name} for buckets outside of the default region
+S3_BUCKET_REGIONS = {}
+# {bucket_name: endpoint_url} for buckets served by other S3 compatible storages
+S3_BUCKET_ENDPOINTS = {}
+S3_LIST_MAX_CONCURRENCY = 8
+# Object listing the latest uploaded backups, so that download_latest() does not need to list the bucket
+LATEST_MANIFEST_KEY = 'backup_util.latest.json'
+# Concurrent updates of the manifest are retried after a random delay of up to that many seconds, doubled each time
+LATEST_MANIFEST_RETRY_DELAY = 0.1
+
+
+class _LogHandle:
+    """Buffered log file shared by all jobs logging to it.
+
+    Records are kept in memory and appended with one write when flushed, so the records of concurrent jobs
+    do not interleave. The file is reopened when it gets rotated.
+    """
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.lock = threading.Lock()
+        self.records = []
+        self.size = 0
+        self.oldest = None
+        self.file = None
+
+    def write(self, record):
+        with self.lock:
+            if not self.records:
+                self.oldest = time.monotonic()
+            self.records.append(record)
+            self.size += len(record)
+            if self.size >= LOG_BUFFER_SIZE or time.monotonic() - self.oldest >= LOG_FLUSH_INTERVAL:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.records:
+            return
+        if self.file is not None:
+            try:
+                rotated = os.stat(self.log_file).st_ino != os.fstat(self.file.fileno()).st_ino
+            except FileNotFoundError:
+                rotated = True
+            if rotated:
+                self.file.close()
+                self.file = None
+        if self.file is None:
+            self.file = open(self.log_file, 'a')
+        self.file.write(''.join(self.records))
+        self.file.flush()
+        self.records = []
+        self.size = 0
+
+    def _reset_after_fork(self):
+        # the parent flushes what it has buffered, the child must not write it once more
+        self.lock = threading.Lock()
+        self.records = []
+        self.size = 0
+
+
+_log_handles = {}
+_log_handles_lock = threading.Lock()
+
+
+def _get_log_handle(log_file):
+    with _log_handles_lock:
+        handle = _log_handles.get(log_file)
+        if handle is None:
+            handle = _log_handles[log_file] = _LogHandle(log_file)
+        return handle
 
 
-def _write_log(log_file, msg):
+def _flush_log(log_file=None):
+    """Flush the buffered records of log_file, of all log files if not given"""
+    with _log_handles_lock:
+        handles = [_log_handles[log_file]] if log_file in _log_handles else \
+            (list(_log_handles.values()) if log_file is None else [])
+    for handle in handles:
+        handle.flush()
+
+
+def _reset_log_handles_after_fork():
+    global _log_handles_lock
+    _log_handles_lock = threading.Lock()
+    for handle in _log_handles.values():
+        handle._reset_after_fork()
+
+
+atexit.register(_flush_log)
+os.register_at_fork(after_in_child=_reset_log_handles_after_fork)
+
+
+def _write_log(log_file, msg, flush=False):
+    """Log msg to log_file. The record is buffered unless flush is set, see _LogHandle"""
     if isinstance(msg, list):
         msg = '\n'.join(msg)
-    with open(log_file, 'a') as f:
-        f.write('[{}] {}\n'.format(datetime.datetime.today(), msg))
+    handle = _get_log_handle(log_file)
+    handle.write('[{}] {}\n'.format(datetime.datetime.today(), msg))
+    if flush:
+        handle.flush()
 
 
 def _to_utf8(s):
    return s.encode('utf-8')
 
 
-def _to_unicode(s):
+def _to_unicode(s, log_file=None):
     """
     When s is a sequence type it gets converted a string/bytearray
-    with elements separated by one space
+    with elements separated by one space.
+    Decoding errors are logged to log_file if given.
     """
     if isinstance(s, list) or isinstance(s, tuple):
         s = b" ".join(s)
@@ -40,24 +301,32 @@ def _to_unicode(s):
         try:
             s = s.decode('utf-8')
         except UnicodeDecodeError as e:
-            _write_log(
-                "Failed to utf8 decode process output, 'bad' characters will be replaced with U+FFFD. {}.".format(e))
+            if log_file:
+                _write_log(log_file,
+                           "Failed to utf8 decode process output, 'bad' characters will be replaced with U+FFFD. {}.".format(e))
             s = s.decode('utf-8', 'replace')
     return s
 
 
-def _get_log_tail(log_file):
+def _get_log_tail(log_file, lines=100):
+    """Return the last lines of log_file reading it backwards from the end"""
     if not log_file:
         return ""
 
     try:
-        p = subprocess.Popen("tail -n 100 " + log_file, shell=True, stdout=subprocess.PIPE)
-        myStdout, _ = p.communicate()
-        myStdout = _to_unicode(myStdout)
-        if p.returncode == 0:
-            return myStdout.rstrip()
-        else:
-            return ""
+        _flush_log(log_file)
+        with open(log_file, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            pos = end
+            data = b''
+            # one more newline than lines since the file ends with one
+            while pos > 0 and data.count(b'\n') <= lines:
+                step = min(8192, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        return _to_unicode(b'\n'.join(data.rstrip(b'\n').split(b'\n')[-lines:]))
     except:
         return ""
 
@@ -81,7 +350,10 @@ def _format_time_delta(aTimeDelta):
 
 
 def _pretty_filesize(filename):
-    num = os.path.getsize(filename)
+    return _pretty_size(os.path.getsize(filename))
+
+
+def _pretty_size(num):
     for x in ['bytes', 'KB', 'MB', 'GB']:
         if num < 1024.0 and num > -1024.0:
             return "%3.1f%s" % (num, x)
@@ -89,528 +361,3939 @@ def _pretty_filesize(filename):
     return "%3.1f%s" % (num, 'TB')
 
 
-def _svn_backup(svn_dir, backup_dir):
-    myCmd = "svnadmin hotcopy --clean-logs {} {}".format(svn_dir, backup_dir)
-    myProcess = subprocess.Popen(
-        myCmd, shell=True, cwd=svn_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    myStdout, myStderr = myProcess.communicate()
-    myStdout = _to_unicode(myStdout)
-    myStderr = _to_unicode(myStderr)
+def _dir_size(path, follow_symlinks=True):
+    """Return the total size of the files under path, of the symlinks themselves unless follow_symlinks"""
+    size = 0
+    for root, _, files in os.walk(path, followlinks=follow_symlinks):
+        for name in files:
+            try:
+                size += os.stat(os.path.join(root, name), follow_symlinks=follow_symlinks).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _scan_tree(path, follow_symlinks=False):
+    """Return the sha256 of the names, types, sizes and modification times of everything under path
+    and the total size of the files there"""
+    entries = []
+    size = 0
+    dirs = ['']
+    while dirs:
+        rel_dir = dirs.pop()
+        with os.scandir(os.path.join(path, rel_dir)) as it:
+            for entry in it:
+                name = os.path.join(rel_dir, entry.name)
+                try:
+                    st = entry.stat(follow_symlinks=follow_symlinks)
+                except OSError:
+                    # dangling symlink
+                    st = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode):
+                    dirs.append(name)
+                    entries.append((name, 'd', st.st_mode, 0, 0))
+                else:
+                    entries.append((name, 'l' if stat.S_ISLNK(st.st_mode) else 'f', st.st_mode, st.st_size,
+                                    st.st_mtime_ns))
+                    size += st.st_size
+    h = hashlib.sha256()
+    for entry in sorted(entries):
+        h.update(repr(entry).encode('utf-8'))
+    return h.hexdigest(), size
+
+
+def _dir_fingerprint(path, follow_symlinks=False):
+    """Return the fingerprint of the tree at path and the total size of its files,
+    its subtrees are walked in parallel.
+
+    The fingerprint changes when files are added, removed, resized or modified (as told by their mtime).
+    """
+    entries = []
+    subtrees = []
+    size = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                subtrees.append(entry.name)
+            else:
+                st = entry.stat(follow_symlinks=follow_symlinks and os.path.exists(entry.path))
+                entries.append((entry.name, st.st_mode, st.st_size, st.st_mtime_ns))
+                size += st.st_size
+    with concurrent.futures.ThreadPoolExecutor(max_workers=FINGERPRINT_WALK_WORKERS) as pool:
+        for name, (digest, subtree_size) in zip(subtrees, pool.map(
+                lambda name: _scan_tree(os.path.join(path, name), follow_symlinks), subtrees)):
+            entries.append((name, digest))
+            size += subtree_size
+    h = hashlib.sha256()
+    for entry in sorted(entries, key=lambda entry: entry[0]):
+        h.update(repr(entry).encode('utf-8'))
+    return h.hexdigest(), size
+
+
+def _make_phase(name, start_time, bytes_in=None, bytes_out=None):
+    """Return the record of a backup phase started at start_time (time.monotonic()).
+
+    The throughput is in bytes per second of the phase input, of its output if the input is unknown.
+    """
+    seconds = time.monotonic() - start_time
+    processed = bytes_in if bytes_in is not None else bytes_out
+    return {'phase': name, 'seconds': seconds, 'bytes_in': bytes_in, 'bytes_out': bytes_out,
+            'throughput': processed / seconds if processed is not None and seconds > 0 else None}
+
+
+def _format_phase(phase):
+    text = 'Phase {}: {}'.format(phase['phase'], _format_time_delta(datetime.timedelta(seconds=phase['seconds'])))
+    if phase['bytes_in'] is not None:
+        text += ', read {}'.format(_pretty_size(phase['bytes_in']))
+    if phase['bytes_out'] is not None:
+        text += ', wrote {}'.format(_pretty_size(phase['bytes_out']))
+    if phase.get('throughput') is not None:
+        text += ', {}/s'.format(_pretty_size(phase['throughput']))
+    return text
+
+
+_metrics_lock = threading.Lock()
+
+
+def _prometheus_labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in sorted(labels.items())) + '}'
+
+
+def _write_metrics_textfile(job, result, finished):
+    """Write the job metrics to <METRICS_TEXTFILE_DIR>/backup_util_<job>.prom for the node_exporter textfile collector"""
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', job['hint'])
+    path = os.path.join(METRICS_TEXTFILE_DIR, 'backup_util_{}.prom'.format(name))
+    labels = {'job_name': job['hint'], 'kind': job['kind'], 'bucket': job['bucket_name']}
+    lines = ['# TYPE backup_util_job_success gauge',
+             'backup_util_job_success{} {}'.format(_prometheus_labels(labels), 1 if result['retval'] else 0),
+             '# TYPE backup_util_job_duration_seconds gauge',
+             'backup_util_job_duration_seconds{} {}'.format(_prometheus_labels(labels), result['seconds']),
+             '# TYPE backup_util_job_last_run_timestamp_seconds gauge',
+             'backup_util_job_last_run_timestamp_seconds{} {}'.format(_prometheus_labels(labels), finished),
+             '# TYPE backup_util_job_last_success_timestamp_seconds gauge']
+    if result['retval']:
+        lines.append('backup_util_job_last_success_timestamp_seconds{} {}'.format(_prometheus_labels(labels), finished))
+    elif os.path.exists(path):
+        # keep the time of the last success across failures so that stale backups can be alerted on
+        with open(path) as f:
+            lines += [line.rstrip('\n') for line in f if line.startswith('backup_util_job_last_success_timestamp_seconds')]
+    for metric, key in (('duration_seconds', 'seconds'), ('bytes_in', 'bytes_in'), ('bytes_out', 'bytes_out'),
+                        ('throughput_bytes_per_second', 'throughput')):
+        lines.append('# TYPE backup_util_phase_{} gauge'.format(metric))
+        for phase in result['phases']:
+            if phase[key] is not None:
+                lines.append('backup_util_phase_{}{} {}'.format(
+                    metric, _prometheus_labels(dict(labels, phase=phase['phase'])), phase[key]))
+    # the collector may read the file any time, so it is replaced atomically
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(temp_path, path)
 
-    if myProcess.returncode != 0:
-        return {"ret": False,
-                "description": "svn backup at {} finished with return code {}".format(svn_dir, myProcess.returncode),
-                "stdout": myStdout.rstrip(),
-                "stderr": myStderr.rstrip()}
-    return {"ret": True,
-            "description": "svn backup at {} completed successfully.".format(svn_dir),
-            "stdout": myStdout.rstrip(),
-            "stderr": myStderr.rstrip()}
 
+def _export_metrics(job, result):
+    """Write the job result with its phases to METRICS_JSONL_PATH and METRICS_TEXTFILE_DIR if set"""
+    finished = time.time()
+    with _metrics_lock:
+        if METRICS_JSONL_PATH:
+            record = {'time': finished, 'job_name': job['hint'], 'kind': job['kind'], 'bucket': job['bucket_name'],
+                      'retval': result['retval'], 'seconds': result['seconds'], 'phases': result['phases']}
+            with open(METRICS_JSONL_PATH, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if METRICS_TEXTFILE_DIR:
+            _write_metrics_textfile(job, result, finished)
 
-def _svn_update(svn_dir):
-    myCmd = "svn up --non-interactive --trust-server-cert"
-    myProcess = subprocess.Popen(
-        myCmd, shell=True, cwd=svn_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    myStdout, myStderr = myProcess.communicate()
-    myStdout = _to_unicode(myStdout)
-    myStderr = _to_unicode(myStderr)
+
+# Longer lines of command output are split
+_COMMAND_MAX_LINE = 64 * 1024
+
+
+def _read_command_output(pipe, tail, log_file):
+    for line in iter(lambda: pipe.readline(_COMMAND_MAX_LINE), b''):
+        line = _to_unicode(line, log_file).rstrip('\r\n')
+        tail.append(line)
+        if log_file:
+            _write_log(log_file, line)
+    pipe.close()
+
+
+def _kill_process_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _run_command(myCmd, myAction, cwd=None, log_file=None, timeout=None, stdout=subprocess.PIPE):
+    """Run myCmd given as a list of arguments. Return {"ret", "description", "stdout", "stderr"}
+
+    The output is logged to log_file if given line by line as it comes, only its last COMMAND_OUTPUT_TAIL_LINES
+    lines are returned. The command runs in a process group of its own, it is killed with the processes it has
+    started after timeout seconds, COMMAND_TIMEOUTS by default. Once it has finished, the processes it has left
+    are killed with the group too if they still hold its output open after COMMAND_OUTPUT_GRACE seconds.
+    stdout may be a file to write the standard output to.
+    """
+    if timeout is None:
+        timeout = COMMAND_TIMEOUTS.get(os.path.basename(myCmd[0]))
+    # in a session of its own, so that its children inheriting the pipes can be killed with it
+    myProcess = subprocess.Popen(myCmd, cwd=cwd, stdout=stdout, stderr=subprocess.PIPE, start_new_session=True)
+    myStdout = collections.deque(maxlen=COMMAND_OUTPUT_TAIL_LINES)
+    myStderr = collections.deque(maxlen=COMMAND_OUTPUT_TAIL_LINES)
+    readers = [threading.Thread(target=_read_command_output, args=(myProcess.stderr, myStderr, log_file))]
+    if stdout == subprocess.PIPE:
+        readers.append(threading.Thread(target=_read_command_output, args=(myProcess.stdout, myStdout, log_file)))
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    try:
+        myProcess.wait(timeout)
+        myDescription = "{} finished with return code {}.".format(myAction, myProcess.returncode)
+    except subprocess.TimeoutExpired:
+        _kill_process_group(myProcess)
+        myProcess.wait()
+        myDescription = "{} timed out after {} sec.".format(myAction, timeout)
+    deadline = time.monotonic() + COMMAND_OUTPUT_GRACE
+    for reader in readers:
+        reader.join(max(0, deadline - time.monotonic()))
+    if any(reader.is_alive() for reader in readers):
+        # background processes left by the command still hold its output open
+        _kill_process_group(myProcess)
+        deadline = time.monotonic() + COMMAND_OUTPUT_GRACE
+        for reader in readers:
+            reader.join(max(0, deadline - time.monotonic()))
+    myStdout = '\n'.join(myStdout).rstrip()
+    myStderr = '\n'.join(myStderr).rstrip()
 
     if myProcess.returncode != 0:
         return {"ret": False,
-                "description": "'svn update' of {} finished with return code {}".format(svn_dir, myProcess.returncode),
-                "stdout": myStdout.rstrip(),
-                "stderr": myStderr.rstrip()}
+                "description": myDescription,
+                "stdout": myStdout,
+                "stderr": myStderr}
     return {"ret": True,
-            "description": "'svn update' of {} completed successfully.".format(svn_dir),
-            "stdout": myStdout.rstrip(),
-            "stderr": myStderr.rstrip()}
+            "description": "{} completed successfully.".format(myAction),
+            "stdout": myStdout,
+            "stderr": myStderr}
 
+def _svn_backup(svn_dir, backup_dir, incremental=False, log_file=None):
+    myCmd = ["svnadmin", "hotcopy", "--clean-logs"] + (["--incremental"] if incremental else []) + [svn_dir, backup_dir]
+    return _run_command(myCmd, "svn backup at {}".format(svn_dir), cwd=svn_dir, log_file=log_file)
 
-def _get_s3_archive_pwd():
+def _svn_dump(svn_dir, dump_path, start_rev, end_rev, log_file=None):
+    myCmd = ["svnadmin", "dump", "--quiet", "--deltas", "-r", "{}:{}".format(start_rev, end_rev)]
+    if start_rev > 0:
+        myCmd.append("--incremental")
+    myCmd.append(svn_dir)
+    with open(dump_path, 'wb') as dump_file:
+        return _run_command(myCmd, "svn dump of r{}:{} at {}".format(start_rev, end_rev, svn_dir),
+                            log_file=log_file, stdout=dump_file)
+
+def _svn_youngest(svn_dir):
+    return int(subprocess.check_output(["svnlook", "youngest", svn_dir]).strip())
+
+
+def _svn_state_name(svn_dir):
+    svn_dir = os.path.abspath(svn_dir)
+    return hashlib.sha1(svn_dir.encode('utf-8')).hexdigest()[:16] + '-' + os.path.basename(svn_dir)
+
+
+def _svn_update(svn_dir, log_file=None):
+    return _run_command(["svn", "up", "--non-interactive", "--trust-server-cert"],
+                        "'svn update' of {}".format(svn_dir), cwd=svn_dir, log_file=log_file)
+
+def _svn_head_revision(svn_dir):
+    """Return the youngest revision of the repo the working copy at svn_dir is checked out from"""
+    myStdout = subprocess.check_output(["svn", "info", "--show-item", "revision", "-r", "HEAD",
+                                        "--non-interactive", "--trust-server-cert"], cwd=svn_dir)
+    return int(myStdout.strip())
+
+
+def _get_s3_archive_pwd_path():
     import pwd
     home_dir = pwd.getpwuid(os.getuid()).pw_dir
-    with open("{}/.aws/s3-archive.pwd".format(home_dir)) as f:
+    return "{}/.aws/s3-archive.pwd".format(home_dir)
+
+
+def _get_s3_archive_pwd():
+    with open(_get_s3_archive_pwd_path()) as f:
         return f.read()
 
 
-def _is_file_exist_on_s3(file_path, bucket_name):
-    s3_client = boto3.client('s3')
+# Year and month in the dated archive names, as in 202401, 2024-01 or 2024_01
+_S3_LIST_DATE_RE = re.compile(r'((?:19|20)[0-9]{2})([-_.]?)(0[1-9]|1[0-2])')
+
+_s3_session = None
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+
+def _get_s3_client(bucket_name=None, region_name=None):
+    """Return the S3 client for bucket_name shared by all backups and downloads.
+
+    Clients are created lazily from a single boto3 session, one per bucket and region,
+    and keep their connection pool between calls. boto3 clients are thread-safe, sessions are not.
+    """
+    global _s3_session
+    region_name = region_name or S3_BUCKET_REGIONS.get(bucket_name)
+    client_key = (bucket_name, region_name)
+    with _s3_clients_lock:
+        if client_key not in _s3_clients:
+            import boto3
+            from botocore.config import Config as BotoConfig
+            if _s3_session is None:
+                _s3_session = boto3.session.Session()
+            config = BotoConfig(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                                retries={'mode': S3_RETRY_MODE, 'max_attempts': S3_MAX_RETRY_ATTEMPTS})
+            _s3_clients[client_key] = _s3_session.client('s3', region_name=region_name, config=config,
+                                                         endpoint_url=S3_BUCKET_ENDPOINTS.get(bucket_name))
+        return _s3_clients[client_key]
+
+
+def _client_error():
+    """Return botocore ClientError for the except clauses, it is imported only when an S3 call has failed"""
+    from botocore.exceptions import ClientError
+    return ClientError
+
+
+def _reset_s3_clients_after_fork():
+    # the clients of the parent hold its open connections, a forked archive worker makes its own
+    global _s3_session, _s3_clients, _s3_clients_lock
+    _s3_session = None
+    _s3_clients = {}
+    _s3_clients_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_s3_clients_after_fork)
+
+
+def _is_file_exist_on_s3(file_path, bucket_name, sha256=None):
+    """Tell whether file_path is already in S3 comparing its sha256 (hex) if given and known for the object,
+    its size otherwise"""
+    s3_client = _get_s3_client(bucket_name)
     s3_key_name = os.path.basename(file_path)
     file_size = os.path.getsize(file_path)
     try:
       obj = s3_client.head_object(Bucket=bucket_name, Key=s3_key_name)
+      if sha256 and 'sha256' in obj.get('Metadata', {}):
+          return obj['Metadata']['sha256'] == sha256
       return obj['ContentLength'] == file_size
-    except ClientError as e:
+    except _client_error() as e:
         if int(e.response['Error']['Code']) == 404:
             return False
         else:
             raise
 
 
-def _upload_to_s3(file_path, bucket_name):
-    s3_client = boto3.client('s3')
-    s3_key_name = os.path.basename(file_path)
-    s3_client.upload_file(file_path, bucket_name, s3_key_name)
+class _RateLimiter:
+    """Cap the total throughput of the threads sharing the limiter to rate bytes per second"""
+
+    def __init__(self, rate):
+        self._rate = float(rate)
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def consume(self, nbytes):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_slot)
+            self._next_slot = start + nbytes / self._rate
+        if start > now:
+            time.sleep(start - now)
+
 
+def _make_rate_limiter(max_bandwidth):
+    return _RateLimiter(max_bandwidth) if max_bandwidth else None
 
-def _find_latest_modified_s3_key(bucket_name, key_prefix):
-    s3_client = boto3.client('s3')
+
+def _upload_journal_path(file_path, bucket_name):
+    # kept apart from the file so that the journals are not taken for backups by file masks
+    name = json.dumps([os.path.abspath(file_path), bucket_name])
+    return os.path.join(UPLOAD_JOURNAL_DIR, hashlib.sha1(name.encode('utf-8')).hexdigest() + '.json')
+
+
+def _load_json_file(path):
+    """Return the content of the JSON state file or None if it does not exist or is damaged"""
     try:
-        if key_prefix:
-            keys = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=key_prefix)['Contents']
-        else:
-            keys = s3_client.list_objects_v2(Bucket=bucket_name)['Contents']
-        if keys:
-            keys.sort(key=lambda k: k['LastModified'])
-            return keys[-1]
-        else:
-            return None
-    except boto3.S3.Client.exceptions.NoSuchBucket:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
         return None
 
 
-def _download_from_s3(bucket_name, key_to_download, store_path):
-    s3_client = boto3.client('s3')
-    s3_client.download_file(bucket_name, key_to_download, store_path)
+def _save_json_file(path, data):
+    """Atomically replace the JSON state file"""
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
 
 
-def _git_backup(clone_url, repo_archive_path):
-    temp_dir = tempfile.mkdtemp()
-    myCmd = "git clone --mirror {} ./ && git bundle create {} --all".format(clone_url, repo_archive_path)
-    myProcess = subprocess.Popen(
-        myCmd, shell=True, cwd=temp_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    myStdout, myStderr = myProcess.communicate()
-    shutil.rmtree(temp_dir, ignore_errors=True)
-    myStdout = _to_unicode(myStdout)
-    myStderr = _to_unicode(myStderr)
+def _list_uploaded_parts(s3_client, bucket_name, s3_key_name, upload_id):
+    """Return {part_number: (part, size)} for the parts of the multipart upload stored on S3
+    or None if the upload does not exist anymore. part is as returned by _upload_part().
+    """
+    parts = {}
+    marker = 0
+    try:
+        while True:
+            resp = s3_client.list_parts(Bucket=bucket_name, Key=s3_key_name, UploadId=upload_id,
+                                        PartNumberMarker=marker)
+            for part in resp.get('Parts', []):
+                parts[part['PartNumber']] = (dict((name, part[name]) for name in ('PartNumber', 'ETag', 'ChecksumSHA256')
+                                                  if name in part), part['Size'])
+            if not resp.get('IsTruncated'):
+                return parts
+            marker = resp['NextPartNumberMarker']
+    except _client_error() as e:
+        if e.response['Error']['Code'] == 'NoSuchUpload':
+            return None
+        raise
 
-    if myProcess.returncode != 0:
-        return {"ret": False,
-                "description": "git local backup from {} to {} finished with return code {}.".format(clone_url, repo_archive_path, myProcess.returncode),
-                "stdout": myStdout.rstrip(),
-                "stderr": myStderr.rstrip()}
-    return {"ret": True,
-            "description": "git local backup from {} to {} completed successfully.".format(clone_url, repo_archive_path),
-            "stdout": myStdout.rstrip(),
-            "stderr": myStderr.rstrip()}
 
+def _upload_file_part(s3_client, file_path, bucket_name, s3_key_name, upload_id, part_number, part_size, limiter):
+    with open(file_path, 'rb') as f:
+        f.seek((part_number - 1) * part_size)
+        data = f.read(part_size)
+    return _upload_part(s3_client, bucket_name, s3_key_name, upload_id, part_number, data, limiter)
 
-def _mysql_db_backup(db_name, backup_path):
-        myCmd = "mysqldump {} > {}".format(db_name, backup_path)
-        myProcess = subprocess.Popen(
-            myCmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        myStdout, myStderr = myProcess.communicate()
-        myStdout = _to_unicode(myStdout)
-        myStderr = _to_unicode(myStderr)
 
-        if myProcess.returncode != 0:
-            return {"ret": False,
-                    "description": "MySQL backup of {} to {} finished with return code {}.".format(db_name, backup_path, myProcess.returncode),
-                    "stdout": myStdout.rstrip(),
-                    "stderr": myStderr.rstrip()}
-        return {"ret": True,
-                "description": "MySQL backup of {} to {} completed successfully.".format(db_name, backup_path),
-                "stdout": myStdout.rstrip(),
-                "stderr": myStderr.rstrip()}
+def _upload_to_s3(file_path, bucket_name, part_size=None, max_concurrency=None, max_bandwidth=None, sha256=None):
+    """Upload file_path to S3 under its base name.
 
+    Large files are uploaded as parallel multipart uploads. Uploaded parts are recorded in a journal
+    in UPLOAD_JOURNAL_DIR named by the file path and the bucket, so that an interrupted upload of the same
+    file resumes from where it stopped.
+    S3 verifies the SHA-256 checksum of each part. sha256 (hex) of the whole file if known is kept
+    in the object metadata for _is_file_exist_on_s3().
+    """
+    part_size = part_size or UPLOAD_PART_SIZE
+    max_concurrency = max_concurrency or UPLOAD_MAX_CONCURRENCY
+    limiter = _make_rate_limiter(max_bandwidth or UPLOAD_MAX_BANDWIDTH)
+    s3_client = _get_s3_client(bucket_name)
+    s3_key_name = os.path.basename(file_path)
+    file_size = os.path.getsize(file_path)
+    metadata = {'sha256': sha256} if sha256 else {}
 
-def _trac_backup(trac_dir, backup_dir):
-    myCmd = "/usr/local/bin/trac-admin {} hotcopy {}".format(trac_dir, backup_dir)
-    myProcess = subprocess.Popen(
-        myCmd, shell=True, cwd=trac_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    myStdout, myStderr = myProcess.communicate()
-    myStdout = _to_unicode(myStdout)
-    myStderr = _to_unicode(myStderr)
+    if file_size <= part_size:
+        if limiter:
+            limiter.consume(file_size)
+        checksum = {'ChecksumSHA256': _b64_sha256(bytes.fromhex(sha256))} if sha256 else {'ChecksumAlgorithm': 'SHA256'}
+        with open(file_path, 'rb') as f:
+            s3_client.put_object(Bucket=bucket_name, Key=s3_key_name, Body=f, Metadata=metadata, **checksum)
+        return
 
-    if myProcess.returncode != 0:
-        return {"ret": False,
-                "description": "svn backup at {} finished with return code {}.".format(trac_dir, myProcess.returncode),
-                "stdout": myStdout.rstrip(),
-                "stderr": myStderr.rstrip()}
-    return {"ret": True,
-            "description": "svn backup at {} completed successfully.".format(trac_dir),
-            "stdout": myStdout.rstrip(),
-            "stderr": myStderr.rstrip()}
+    journal_path = _upload_journal_path(file_path, bucket_name)
+    journal = _load_json_file(journal_path)
+    uploaded_parts = None
+    if journal:
+        if (journal.get('bucket'), journal.get('key'), journal.get('size'), journal.get('mtime'), journal.get('part_size'),
+                journal.get('checksum_algorithm')) == \
+                (bucket_name, s3_key_name, file_size, os.path.getmtime(file_path), part_size, 'SHA256'):
+            uploaded_parts = _list_uploaded_parts(s3_client, bucket_name, s3_key_name, journal['upload_id'])
+        else:
+            # the file has changed since, its parts are of no use
+            try:
+                s3_client.abort_multipart_upload(Bucket=journal['bucket'], Key=journal['key'],
+                                                 UploadId=journal['upload_id'])
+            except _client_error():
+                pass
+    if uploaded_parts is None:
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket_name, Key=s3_key_name, Metadata=metadata,
+                                                      ChecksumAlgorithm='SHA256')['UploadId']
+        journal = {'bucket': bucket_name, 'key': s3_key_name, 'upload_id': upload_id,
+                   'size': file_size, 'mtime': os.path.getmtime(file_path), 'part_size': part_size,
+                   'checksum_algorithm': 'SHA256'}
+        uploaded_parts = {}
+    upload_id = journal['upload_id']
 
+    part_count = (file_size + part_size - 1) // part_size
+    parts = {}
+    for part_number, (part, size) in uploaded_parts.items():
+        if size == min(part_size, file_size - (part_number - 1) * part_size):
+            parts[part_number] = part
+    journal['parts'] = dict((str(n), part['ETag']) for n, part in parts.items())
+    _save_json_file(journal_path, journal)
 
-def _archive(src_dir, dest_archive):
-    archive_password = _get_s3_archive_pwd()
-    myCmd = "7za a -t7z -mhe=on -p{} {} *".format(archive_password, dest_archive)
-    if not os.path.exists(os.path.dirname(dest_archive)):
-        os.makedirs(os.path.dirname(dest_archive))
-    with open(os.devnull, "w") as fnull:
-        # skip stdout since it contains all files added to the archive
-        myProcess = subprocess.Popen(
-            myCmd, shell=True, cwd=src_dir, stdout=fnull, stderr=subprocess.PIPE)
-        _, myStderr = myProcess.communicate()
-        myStderr = _to_unicode(myStderr)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(_upload_file_part, s3_client, file_path, bucket_name, s3_key_name,
+                                   upload_id, part_number, part_size, limiter)
+                   for part_number in range(1, part_count + 1) if part_number not in parts]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                part = future.result()
+                parts[part['PartNumber']] = part
+                journal['parts'][str(part['PartNumber'])] = part['ETag']
+                _save_json_file(journal_path, journal)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
 
-        if myProcess.returncode != 0:
-            return {"ret": False,
-                    "description": "archiving {} to {} finished with return code {}.".format(src_dir, dest_archive, myProcess.returncode),
-                    "stderr": myStderr.rstrip()}
-        return {"ret": True,
-                "description": "archiving {} to {} completed successfully.".format(src_dir, dest_archive),
-                "stderr": myStderr.rstrip()}
+    _complete_multipart_upload(s3_client, bucket_name, s3_key_name, upload_id, [parts[n] for n in sorted(parts)])
+    os.remove(journal_path)
 
 
-def _cleanup_old_archines(dir, extension, max_age=MAX_ARCHIVE_AGE_DAYS):
-    myCmd = r"find %s/*%s -mtime +%d -exec rm -f {} \;" % (dir, extension, max_age)
-    with open(os.devnull, "w") as fnull:
-        myProcess = subprocess.Popen(
-            myCmd, shell=True, cwd=dir, stdout=fnull, stderr=subprocess.PIPE)
-        _, myStderr = myProcess.communicate()
-        myStderr = _to_unicode(myStderr)
+def _abort_stale_multipart_uploads(bucket_name, max_age_hours=STALE_UPLOAD_MAX_AGE_HOURS):
+    """Abort multipart uploads in bucket_name initiated more than max_age_hours ago.
 
-        if myProcess.returncode != 0:
-            return {"ret": False,
-                    "description": "cleaning up {}/*{} finished with return code {}.".format(dir, extension, myProcess.returncode),
-                    "stderr": myStderr.rstrip()}
-        return {"ret": True,
-                "description": "cleaning up {}/*{} completed successfully.".format(dir, extension),
-                "stderr": myStderr.rstrip()}
+    The local journals of the aborted uploads and of the uploads to bucket_name not resumed
+    for max_age_hours are deleted too.
+    Return the list of keys of the aborted uploads.
+    """
+    s3_client = _get_s3_client(bucket_name)
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=max_age_hours)
+    stale = []
+    for page in s3_client.get_paginator('list_multipart_uploads').paginate(Bucket=bucket_name):
+        stale += [upload for upload in page.get('Uploads', []) if upload['Initiated'] < cutoff]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_MAX_CONCURRENCY) as executor:
+        list(executor.map(lambda upload: s3_client.abort_multipart_upload(
+            Bucket=bucket_name, Key=upload['Key'], UploadId=upload['UploadId']), stale))
+    _expire_upload_journals(bucket_name, set(upload['UploadId'] for upload in stale), cutoff.timestamp())
+    return [upload['Key'] for upload in stale]
 
-class SvnBackupType:
-    REPO = 1
-    WORKING_COPY = 2
 
+def _expire_upload_journals(bucket_name, upload_ids, cutoff):
+    if not os.path.isdir(UPLOAD_JOURNAL_DIR):
+        return
+    for name in os.listdir(UPLOAD_JOURNAL_DIR):
+        path = os.path.join(UPLOAD_JOURNAL_DIR, name)
+        if not name.endswith('.json'):
+            continue
+        journal = _load_json_file(path) or {}
+        try:
+            old = os.path.getmtime(path) < cutoff
+            if journal.get('upload_id') in upload_ids or old and journal.get('bucket') in (bucket_name, None):
+                os.remove(path)
+        except OSError:
+            pass
 
-def _backup_svn(backup_name_hint, svn_backup_type, svn_url, archive_path, bucket_name, log_file):
-    status_brief = '[S3 Backup] ' + backup_name_hint
-    status_detailed = ''
-    backup_ok = False
-    start = datetime.datetime.today()
-    _write_log(log_file, 'Starting backup')
-    svn_backup_dir = None
-    try:
-        if svn_backup_type == SvnBackupType.REPO:
-            _write_log(log_file, "Backing up svn repo at " + svn_url)
-            svn_backup_dir = tempfile.mkdtemp()
-            ret = _svn_backup(svn_url, svn_backup_dir)
-            svn_url = svn_backup_dir
-        elif svn_backup_type == SvnBackupType.WORKING_COPY:
-            _write_log(log_file, "Updating " + svn_url)
-            ret = _svn_update(svn_url)
-        else:
-            raise Exception("Unsupported svn backup type {}".format(svn_backup_type))
-        _write_log(log_file, '{}\nStdOut: {}\nStdErr: {}\n'.format(
-                   ret['description'], ret['stdout'], ret['stderr']))
-        if ret['ret']:
-            _write_log(log_file, "Archiving {} to {}".format(svn_url, archive_path))
-            ret = _archive(svn_url, archive_path)
-            _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
-            if ret['ret']:
-                if not _is_file_exist_on_s3(archive_path, bucket_name):
-                    status_detailed = 'Uploading {} ({}) to S3...'.format(
-                        archive_path, _pretty_filesize(archive_path))
-                    _upload_to_s3(archive_path, bucket_name)
-                    status_detailed += 'done.'
-                else:
-                    status_detailed = 'The file {} with size {} already exists at to S3, skip upload\n'.format(
-                        archive_path, _pretty_filesize(archive_path))
-                backup_ok = True
 
-    except Exception as e:
-        status_detailed += '\nError: {} {}'.format(type(e), e)
-    except:
-        status_detailed += '\nUnknown error'
-    finally:
-        if svn_backup_dir is not None:
-            shutil.rmtree(svn_backup_dir, ignore_errors=True)
-        if backup_ok:
-            status_brief += ' OK'
-            ret = _cleanup_old_archines(dir=os.path.dirname(archive_path),
-                                        extension=os.path.splitext(archive_path)[1])
-            _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
-        else:
-            status_brief += ' FAILED'
-        end = datetime.datetime.today()
-        status_detailed += '\nElapsed time: ' + _format_time_delta(end - start)
-        _write_log(log_file, status_detailed)
-        _write_log(log_file, 'Backup to {} finished with status {}'.format(
-                   bucket_name, 'SUCCESS' if backup_ok else 'ERROR'))
-        return {'retval': backup_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
+def _list_s3_key_range(s3_client, bucket_name, key_prefix, start_after, last_key):
+    """List the objects under key_prefix with keys in (start_after, last_key], None meaning no bound"""
+    kwargs = {'Bucket': bucket_name, 'Prefix': key_prefix}
+    if start_after is not None:
+        kwargs['StartAfter'] = start_after
+    objects = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(**kwargs):
+        for obj in page.get('Contents', []):
+            if last_key is not None and obj['Key'] > last_key:
+                return objects
+            objects.append(obj)
+    return objects
 
 
+def _list_shard_bounds(key_prefix, last_key):
+    """Return the keys splitting the key space after last_key into ranges to list in parallel.
 
-#
-# Public API
-#
+    The keys of one backup differ by their date, so when last_key has a date after key_prefix
+    the bounds are that name dated with each of the following months up to the current one.
+    Otherwise there are no bounds and the rest is listed page by page.
+    """
+    match = _S3_LIST_DATE_RE.search(last_key, len(key_prefix))
+    if not match:
+        return []
+    year, separator, month = int(match.group(1)), match.group(2), int(match.group(3))
+    today = datetime.date.today()
+    bounds = []
+    while (year, month) < (today.year, today.month):
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        bounds.append('{}{:04d}{}{:02d}'.format(last_key[:match.start()], year, separator, month))
+    return bounds
 
-def send_email(aSubj, aMsg, aSender, aRecepients, aLogFile, anSmtpSvrHost='localhost', anSmtpSvrPort=25, aUser=None, aPassword=None):
-    log_tail = _get_log_tail(aLogFile)
-    msg = MIMEMultipart()
-    attachment = MIMEText(_to_utf8(log_tail), 'plain', 'utf-8')
-    attachment.add_header('Content-Disposition', 'attachment', filename=aLogFile)
-    msg.attach(attachment)
-    msg.attach(MIMEText(_to_utf8(aMsg), 'plain', 'utf-8'))
-
-    msg['Subject'] = aSubj
-    msg['From'] = aSender
-    msg['To'] = ', '.join(aRecepients)
-    msg['Date'] = formatdate()
 
-    mySmtpSvr = smtplib.SMTP(anSmtpSvrHost, anSmtpSvrPort)
-    if aUser and aPassword is not None:
-        mySmtpSvr.login(aUser, aPassword)
+def _list_s3_keys(bucket_name, key_prefix=''):
+    """Return all objects under key_prefix.
 
-    # mySmtpSvr.set_debuglevel(1)
-    mySmtpSvr.sendmail(aSender, aRecepients, msg.as_string())
-    mySmtpSvr.quit()
+    When they do not fit into one page the rest of the key space is split by months, see _list_shard_bounds(),
+    and the ranges are listed in parallel.
+    """
+    s3_client = _get_s3_client(bucket_name)
+    key_prefix = key_prefix or ''
+    page = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=key_prefix)
+    objects = page.get('Contents', [])
+    if not page.get('IsTruncated'):
+        return objects
+    last_key = objects[-1]['Key']
+    bounds = _list_shard_bounds(key_prefix, last_key)
+    ranges = list(zip([last_key] + bounds, bounds + [None]))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=S3_LIST_MAX_CONCURRENCY) as executor:
+        shards = executor.map(lambda r: _list_s3_key_range(s3_client, bucket_name, key_prefix, r[0], r[1]), ranges)
+        for shard in shards:
+            objects += shard
+    return objects
 
 
-def backup_dir(hint, dir, archive_path, bucket_name, log_file):
-    status_brief = '[S3 Backup] ' + hint
-    status_detailed = ''
-    backup_ok = False
-    start = datetime.datetime.today()
-    _write_log(log_file, 'Starting backup')
-    try:
-        _write_log(log_file, "Archiving {} to {}".format(dir, archive_path))
-        ret = _archive(dir, archive_path)
-        _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
-        if ret['ret']:
-            if not _is_file_exist_on_s3(archive_path, bucket_name):
-                status_detailed = 'Uploading {} ({}) to S3...'.format(
-                    archive_path, _pretty_filesize(archive_path))
-                _upload_to_s3(archive_path, bucket_name)
-                status_detailed += 'done.'
-            else:
-                status_detailed = 'The file {} with size {} already exists at to S3, skip upload\n'.format(
-                        archive_path, _pretty_filesize(archive_path))
-            backup_ok = True
-    except Exception as e:
-        status_detailed += '\nError: {}. {}'.format(type(e), e)
-    except:
-        status_detailed += '\nUnknown error'
-    finally:
-        if backup_ok:
-            status_brief += ' OK'
-            ret = _cleanup_old_archines(dir=os.path.dirname(archive_path),
-                                        extension=os.path.splitext(archive_path)[1])
-            _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
-        else:
-            status_brief += ' FAILED'
-        end = datetime.datetime.today()
-        status_detailed += '\nElapsed time: ' + _format_time_delta(end - start)
-        _write_log(log_file, status_detailed)
-        _write_log(log_file, 'Backup to {} finished with status {}'.format(
-                   bucket_name, 'SUCCESS' if backup_ok else 'ERROR'))
-        return {'retval': backup_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
+def _update_latest_manifest(bucket_name, update):
+    """Apply update(manifest) to the manifest of the latest uploads used by download_latest()
 
+    Concurrent updates from several jobs or hosts are resolved with conditional writes
+    retried with jittered exponential backoff.
+    """
+    s3_client = _get_s3_client(bucket_name)
+    for attempt in range(S3_MAX_RETRY_ATTEMPTS):
+        if attempt:
+            time.sleep(random.uniform(0, LATEST_MANIFEST_RETRY_DELAY * 2 ** attempt))
+        try:
+            resp = s3_client.get_object(Bucket=bucket_name, Key=LATEST_MANIFEST_KEY)
+            manifest = json.loads(_to_unicode(resp['Body'].read()))
+            condition = {'IfMatch': resp['ETag']}
+        except _client_error() as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            manifest = {}
+            condition = {'IfNoneMatch': '*'}
+        update(manifest)
+        try:
+            s3_client.put_object(Bucket=bucket_name, Key=LATEST_MANIFEST_KEY, Body=json.dumps(manifest).encode('utf-8'),
+                                 ContentType='application/json', **condition)
+            return
+        except _client_error() as e:
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+    raise Exception("Failed to update {} in {}: too many concurrent updates".format(LATEST_MANIFEST_KEY, bucket_name))
 
-# Backup LAMP setup including apache HTML directory, apache config directory and MySQL Db
-def backup_lamp(backup_name_hint, db_name, archive_path, bucket_name, log_file):
-    status_brief = '[S3 Backup] ' + backup_name_hint
-    status_detailed = ''
-    backup_ok = False
-    start = datetime.datetime.today()
-    temp_backup_dir = None
-    _write_log(log_file, 'Starting backup')
 
+# Timestamps in archive names: dates year first or day first, optionally followed by the time, or Unix time
+_ARCHIVE_TIMESTAMP_RE = re.compile(r'(?:19|20)[0-9]{2}[-_.]?(?:0[1-9]|1[0-2])(?:[-_.T:]?[0-9]{2})*|'
+                                   r'(?:0[1-9]|[12][0-9]|3[01])[-_.]?(?:0[1-9]|1[0-2])[-_.]?(?:19|20)[0-9]{2}'
+                                   r'(?:[-_.T:]?[0-9]{2})*|'
+                                   r'(?<![0-9])1[0-9]{9}(?![0-9])')
+
+
+def _archive_series(name):
+    """Return the name shared by all the archives of a backup, that is the archive name with its timestamp
+    masked, e.g. web01_#.7z of web01_20240101.7z. Other numbers such as host numbers are part of the series."""
+    return _ARCHIVE_TIMESTAMP_RE.sub('#', name)
+
+
+def _record_latest_upload(bucket_name, s3_key_name, size, sha256=None):
+    return _record_latest_uploads(bucket_name, {s3_key_name: size}, sha256 and {s3_key_name: sha256})
+
+
+def _record_latest_uploads(bucket_name, sizes, sha256s=None):
+    """Record the uploads given as {s3_key_name: size} and optionally {s3_key_name: sha256} in one manifest update.
+
+    Only the latest upload of each series of archives is kept, see _archive_series().
+    The uploads are complete anyway, so a failed update is not an error: return the warning
+    for the backup report or '' if the manifest is updated.
+    """
+    def update(manifest):
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        for s3_key_name, size in sizes.items():
+            manifest[s3_key_name] = {'Size': size, 'LastModified': now}
+            if sha256s and s3_key_name in sha256s:
+                manifest[s3_key_name]['SHA256'] = sha256s[s3_key_name]
+        latest = {}
+        for s3_key_name in sorted(manifest, key=lambda name: manifest[name]['LastModified']):
+            latest[_archive_series(s3_key_name)] = s3_key_name
+        for s3_key_name in set(manifest) - set(latest.values()):
+            del manifest[s3_key_name]
     try:
-        temp_backup_dir = tempfile.mkdtemp()
-        shutil.copytree('/var/www/html/', os.path.join(temp_backup_dir, 'var.www.html'))
-        shutil.copytree('/etc/apache2/', os.path.join(temp_backup_dir, 'etc.apache2'))
-        shutil.copytree('/etc/mysql/', os.path.join(temp_backup_dir, 'etc.mysql'))
-        shutil.copytree('/var/log/apache2/', os.path.join(temp_backup_dir, 'var.log.apache2'))
-        ret = _mysql_db_backup(db_name, os.path.join(temp_backup_dir, db_name + '.sql'))
-        if ret['ret']:
-            _write_log(log_file, "Archiving {} to {}".format(temp_backup_dir, archive_path))
-            ret = _archive(temp_backup_dir, archive_path)
-            _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
-
-            if ret['ret']:
-                if not _is_file_exist_on_s3(archive_path, bucket_name):
-                    status_detailed = 'Uploading {} ({}) to S3...'.format(
-                        archive_path, _pretty_filesize(archive_path))
-                    _upload_to_s3(archive_path, bucket_name)
-                    status_detailed += 'done.'
-                else:
-                    status_detailed = 'The file {} with size {} already exists at to S3, skip upload\n'.format(
-                        archive_path, _pretty_filesize(archive_path))
-                backup_ok = True
+        _update_latest_manifest(bucket_name, update)
     except Exception as e:
-        status_detailed += '\nError: {}. {}'.format(type(e), e)
-    except:
-        status_detailed += '\nUnknown error'
-    finally:
-        if temp_backup_dir is not None:
-            shutil.rmtree(temp_backup_dir, ignore_errors=True)
-        if backup_ok:
-            status_brief += ' OK'
-            ret = _cleanup_old_archines(dir=os.path.dirname(archive_path),
-                                        extension=os.path.splitext(archive_path)[1])
-            _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
-        else:
-            status_brief += ' FAILED'
-        end = datetime.datetime.today()
-        status_detailed += '\nElapsed time: ' + _format_time_delta(end - start)
-        _write_log(log_file, status_detailed)
-        _write_log(log_file, 'Backup to {} finished with status {}'.format(
-                   bucket_name, 'SUCCESS' if backup_ok else 'ERROR'))
-        return {'retval': backup_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
+        return '\nWarning: failed to record {} in {} of {}, download_latest() may get an older backup. {}'.format(
+            ', '.join(sorted(sizes)), LATEST_MANIFEST_KEY, bucket_name, e)
+    return ''
 
 
-def backup_svn_repo(backup_name_hint, svn_url, archive_path, bucket_name, log_file):
-    return _backup_svn(backup_name_hint, SvnBackupType.REPO, svn_url, archive_path, bucket_name, log_file)
+def _record_mirror_uploads(mirrors, mirror_buckets, s3_key_name, size, sha256=None):
+    """Record the upload in the manifests of the mirror buckets it succeeded to, see _stream_to_s3().
 
+    Return the warnings of the failed updates.
+    """
+    return ''.join(_record_latest_upload(mirror, s3_key_name, size, sha256) for mirror in mirror_buckets
+                   if mirrors.get('s3://{}/{}'.format(mirror, s3_key_name)) is None)
 
-def backup_svn_wc(backup_name_hint, svn_dir, archive_path, bucket_name, log_file):
-    return _backup_svn(backup_name_hint, SvnBackupType.WORKING_COPY, svn_dir, archive_path, bucket_name, log_file)
 
+def _forget_latest_uploads(bucket_name, s3_key_names):
+    def update(manifest):
+        for s3_key_name in s3_key_names:
+            manifest.pop(s3_key_name, None)
+    _update_latest_manifest(bucket_name, update)
 
-def backup_git_repo(backup_name_hint, clone_url, archive_path, bucket_name, log_file):
-    status_brief = '[S3 Backup] ' + backup_name_hint
-    status_detailed = ''
-    backup_ok = False
-    start = datetime.datetime.today()
-    _write_log(log_file, 'Starting backup')
-    temp_backup_dir = None
-    try:
-        _write_log(log_file, "Backing up git repo at " + archive_path)
-        temp_backup_dir = tempfile.mkdtemp()
-        ret = _git_backup(clone_url, temp_backup_dir + '/git_repo.bundle')
-        _write_log(log_file, '{}\nStdOut: {}\nStdErr: {}\n'.format(
-                   ret['description'], ret['stdout'], ret['stderr']))
-        if ret['ret']:
-            _write_log(log_file, "Archiving {} to {}".format(temp_backup_dir, archive_path))
-            ret = _archive(temp_backup_dir, archive_path)
-            _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
-            if ret['ret']:
-                if not _is_file_exist_on_s3(archive_path, bucket_name):
-                    status_detailed = 'Uploading {} ({}) to S3...'.format(
-                        archive_path, _pretty_filesize(archive_path))
-                    _upload_to_s3(archive_path, bucket_name)
-                    status_detailed += 'done.'
-                else:
-                    status_detailed = 'The file {} with size {} already exists at to S3, skip upload\n'.format(
-                        archive_path, _pretty_filesize(archive_path))
-                backup_ok = True
-    except Exception as e:
-        status_detailed += '\nError: {}. {}'.format(type(e), e)
-    except:
-        status_detailed += '\nUnknown error'
-    finally:
-        if temp_backup_dir is not None:
-            shutil.rmtree(temp_backup_dir, ignore_errors=True)
-        if backup_ok:
-            status_brief += ' OK'
-            ret = _cleanup_old_archines(dir=os.path.dirname(archive_path),
-                                        extension=os.path.splitext(archive_path)[1])
-            _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
-        else:
-            status_brief += ' FAILED'
-        end = datetime.datetime.today()
-        status_detailed += '\nElapsed time: ' + _format_time_delta(end - start)
-        _write_log(log_file, status_detailed)
-        _write_log(log_file, 'Backup to {} finished with status {}'.format(
-                   bucket_name, 'SUCCESS' if backup_ok else 'ERROR'))
-        return {'retval': backup_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
 
+def _find_latest_in_manifest(bucket_name, key_prefix):
+    s3_client = _get_s3_client(bucket_name)
+    try:
+        manifest = json.loads(_to_unicode(
+            s3_client.get_object(Bucket=bucket_name, Key=LATEST_MANIFEST_KEY)['Body'].read()))
+    except _client_error() as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', 'NoSuchBucket', '404'):
+            return None
+        raise
+    keys = [dict(entry, Key=key) for key, entry in manifest.items() if key.startswith(key_prefix or '')]
+    if not keys:
+        return None
+    return max(keys, key=lambda k: k['LastModified'])
 
-def backup_latest(backup_name_hint, backup_filemask, bucket_name, log_file):
-    status_brief = '[S3 Backup] ' + backup_name_hint
-    status_detailed = ''
-    backup_ok = False
-    start = datetime.datetime.today()
-    _write_log(log_file, 'Starting backup {} to {}'.format(backup_name_hint, bucket_name))
+
+def _find_latest_modified_s3_key(bucket_name, key_prefix, use_latest_manifest=False):
+    """Return the latest modified object under key_prefix as {'Key', 'Size', 'LastModified'} or None.
+
+    With use_latest_manifest the manifest kept by the backups is consulted first instead of listing the bucket.
+    Its entries hold the latest upload of each series of archives (see _archive_series()). The bucket is listed
+    when no entry is named with key_prefix or the object of the latest one has been deleted meanwhile,
+    e.g. by the retention run on another host.
+    """
+    if use_latest_manifest:
+        latest = _find_latest_in_manifest(bucket_name, key_prefix)
+        if latest:
+            try:
+                _get_s3_client(bucket_name).head_object(Bucket=bucket_name, Key=latest['Key'])
+                return latest
+            except _client_error() as e:
+                if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                    raise
     try:
-        files = sorted(glob.glob(backup_filemask), key=lambda filename: os.stat(filename).st_mtime)
-        if len(files) == 0:
-            backup_ok = True
-            status_detailed = 'Nothing to backup in ' + backup_filemask
-        else:
-            backup_filepath = files[-1]
-            if not _is_file_exist_on_s3(backup_filepath, bucket_name):
-                status_detailed = 'Uploading {} to S3...'.format(backup_filepath)
-                _write_log(log_file, 'Uploading {} ({}) to S3...'.format(
-                           backup_filepath, _pretty_filesize(backup_filepath)))
-                _upload_to_s3(backup_filepath, bucket_name)
-                status_detailed += 'done.'
-            else:
-                status_detailed = 'The file {} with size {} already exists at to S3, skip upload\n'.format(
-                    backup_filepath, _pretty_filesize(backup_filepath))
-            backup_ok = True
-    except Exception as e:
-        status_detailed += '\nError: {}. {}'.format(type(e), e)
-    except:
-        status_detailed += '\nUnknown error'
-    finally:
-        if backup_ok:
-            status_brief += ' OK'
+        keys = [k for k in _list_s3_keys(bucket_name, key_prefix)
+                if k['Key'] != LATEST_MANIFEST_KEY and not k['Key'].endswith(INDEX_KEY_SUFFIX)]
+        if keys:
+            return max(keys, key=lambda k: k['LastModified'])
         else:
-            status_brief += ' FAILED'
-        end = datetime.datetime.today()
-        status_detailed += '\nElapsed time: ' + _format_time_delta(end - start)
-        _write_log(log_file, status_detailed)
-        _write_log(log_file, 'Backup to {} finished with status {}'.format(
-                   bucket_name, 'SUCCESS' if backup_ok else 'ERROR'))
-        return {'retval': backup_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
+            return None
+    except _client_error() as e:
+        if e.response['Error']['Code'] == 'NoSuchBucket':
+            return None
+        raise
 
 
-def backup_trac(backup_name_hint, trac_dir, archive_path, bucket_name, log_file):
-    status_brief = '[S3 Backup] ' + backup_name_hint
-    status_detailed = ''
-    backup_ok = False
-    start = datetime.datetime.today()
+def _download_journal_path(store_path):
+    return store_path + '.download-journal'
+
+
+def _get_s3_range(s3_client, bucket_name, s3_key_name, etag, start, end):
+    """Return bytes [start, end) of the object, failing if it has been replaced meanwhile"""
+    resp = s3_client.get_object(Bucket=bucket_name, Key=s3_key_name, IfMatch=etag,
+                                Range='bytes={}-{}'.format(start, end - 1))
+    return resp['Body'].read()
+
+
+def _download_from_s3(bucket_name, key_to_download, store_path, part_size=None, max_concurrency=None):
+    """Download the object with concurrent byte-range GETs. Return its size.
+
+    The data goes to store_path + '.part' which is renamed to store_path once complete.
+    The fetched ranges are journaled next to it, so an interrupted download resumes where it stopped.
+    """
+    part_size = part_size or DOWNLOAD_PART_SIZE
+    max_concurrency = max_concurrency or DOWNLOAD_MAX_CONCURRENCY
+    s3_client = _get_s3_client(bucket_name)
+    head = s3_client.head_object(Bucket=bucket_name, Key=key_to_download)
+    size = head['ContentLength']
+    partial_path = store_path + '.part'
+    journal_path = _download_journal_path(store_path)
+    journal = _load_json_file(journal_path)
+    if (not journal or not os.path.exists(partial_path) or journal.get('etag') != head['ETag'] or
+            journal.get('size') != size or journal.get('part_size') != part_size):
+        journal = {'etag': head['ETag'], 'size': size, 'part_size': part_size, 'parts': []}
+        if os.path.dirname(store_path) and not os.path.exists(os.path.dirname(store_path)):
+            os.makedirs(os.path.dirname(store_path))
+        with open(partial_path, 'wb') as f:
+            f.truncate(size)
+        _save_json_file(journal_path, journal)
+    done = set(journal['parts'])
+    offsets = [offset for offset in range(0, size, part_size) if offset not in done]
+
+    def fetch(fd, offset):
+        data = _get_s3_range(s3_client, bucket_name, key_to_download, head['ETag'], offset, min(offset + part_size, size))
+        os.pwrite(fd, data, offset)
+        return offset
+
+    fd = os.open(partial_path, os.O_WRONLY)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = [executor.submit(fetch, fd, offset) for offset in offsets]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    journal['parts'].append(future.result())
+                    _save_json_file(journal_path, journal)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(partial_path, store_path)
+    os.remove(journal_path)
+    return size
+
+
+def _iter_s3_ranges(bucket_name, s3_key_name, part_size=None, max_concurrency=None, start=0, end=None, etag=None):
+    """Yield bytes [start, end) of the object (all of it by default) in order, fetching up to max_concurrency
+    ranges ahead. With etag given the object is not looked up first."""
+    part_size = part_size or DOWNLOAD_PART_SIZE
+    max_concurrency = max_concurrency or DOWNLOAD_MAX_CONCURRENCY
+    s3_client = _get_s3_client(bucket_name)
+    if etag is None or end is None:
+        head = s3_client.head_object(Bucket=bucket_name, Key=s3_key_name)
+        etag = etag or head['ETag']
+        end = head['ContentLength'] if end is None else end
+    offsets = iter(range(start, end, part_size))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending = []
+        try:
+            while True:
+                while len(pending) < max_concurrency:
+                    offset = next(offsets, None)
+                    if offset is None:
+                        break
+                    pending.append(executor.submit(_get_s3_range, s3_client, bucket_name, s3_key_name,
+                                                   etag, offset, min(offset + part_size, end)))
+                if not pending:
+                    return
+                yield pending.pop(0).result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+# 7z archives can only be extracted from a seekable file, everything else is taken for a streamed tar.xz.gpg
+_7Z_SIGNATURE = b"7z\xbc\xaf\x27\x1c"
+
+
+def _is_7z_on_s3(bucket_name, s3_key_name):
+    s3_client = _get_s3_client(bucket_name)
+    head = s3_client.head_object(Bucket=bucket_name, Key=s3_key_name)
+    if head['ContentLength'] < len(_7Z_SIGNATURE):
+        return False
+    return _get_s3_range(s3_client, bucket_name, s3_key_name, head['ETag'], 0, len(_7Z_SIGNATURE)) == _7Z_SIGNATURE
+
+
+def _extract_7z(archive_path, target_dir):
+    archive_password = _get_s3_archive_pwd()
+    return _run_command(["7za", "x", "-y", "-p" + archive_password, "-o" + target_dir, archive_path],
+                        "extracting {} to {}".format(archive_path, target_dir))
+
+
+def _stream_restore_from_s3(bucket_name, s3_key_name, target_dir):
+    """Extract the archive made by _stream_archive_to_s3() to target_dir while it is being downloaded.
+
+    Return the number of bytes downloaded.
+    """
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    ranges = _iter_s3_ranges(bucket_name, s3_key_name)
+    first = next(ranges, b'')
+    if first.startswith(_AEAD_MAGIC):
+        return _aead_stream_restore(first, ranges, target_dir)
+    return _gpg_stream_restore(first, ranges, target_dir)
+
+
+def _gpg_stream_restore(first, ranges, target_dir, tar_options=()):
+    """Decrypt with gpg and extract to target_dir the compressed tar downloaded as first and the rest of ranges.
+
+    tar_options are passed to 'tar -x', e.g. to extract only some members. Return the number of bytes downloaded.
+    """
+    decrypt = _start_pipeline([_gpg_cmd(["--decrypt", "-o", "-"])], stdin=subprocess.PIPE)
+    extract = []
+    relay_errors = []
+
+    def relay():
+        # the decompressor is known only once the beginning of the archive is decrypted
+        try:
+            data = _read_part(decrypt[0].stdout, _COMPRESSION_MAGIC_SIZE)
+            extract.extend(_start_pipeline(_decompress_cmds(data) +
+                                           [["tar", "-C", target_dir, "-xf", "-"] + list(tar_options)],
+                                           stdin=subprocess.PIPE))
+            # tar -x does not write to stdout
+            extract[-1].stdout.close()
+            while data:
+                extract[0].stdin.write(data)
+                data = decrypt[0].stdout.read(1024 * 1024)
+            extract[0].stdin.close()
+        except BaseException as e:
+            relay_errors.append(e)
+            decrypt[0].kill()
+
+    relay_thread = threading.Thread(target=relay)
+    relay_thread.start()
+    size = 0
+    try:
+        data = first
+        while data:
+            decrypt[0].stdin.write(data)
+            size += len(data)
+            data = next(ranges, b'')
+        decrypt[0].stdin.close()
+    except Exception as e:
+        decrypt[0].kill()
+        relay_thread.join()
+        for myProcess in extract:
+            if myProcess.poll() is None:
+                myProcess.kill()
+        failed, stderr = _finish_pipeline(decrypt + extract)
+        raise Exception('{}. {}'.format(e, stderr) if stderr else e)
+    relay_thread.join()
+    decrypt[0].stdout.close()
+    failed, stderr = _finish_pipeline(decrypt + extract)
+    failed += [str(e) for e in relay_errors if not isinstance(e, BrokenPipeError)]
+    if failed:
+        raise Exception('{}. {}'.format('; '.join(failed), stderr))
+    return size
+
+
+def _aead_stream_restore(first, ranges, target_dir, tar_options=()):
+    """Decrypt in process and extract the Encryption.AES_GCM archive downloaded as first and the rest of ranges.
+
+    tar_options are passed to 'tar -x' as by _gpg_stream_restore(). Return the number of bytes downloaded.
+    """
+    sizes = []
+
+    def download():
+        sizes.append(len(first))
+        yield first
+        for data in ranges:
+            sizes.append(len(data))
+            yield data
+
+    plain = _IterReader(_aead_decrypt_chunks(_IterReader(download())))
+    data = _read_part(plain, _COMPRESSION_MAGIC_SIZE)
+    extract = _start_pipeline(_decompress_cmds(data) + [["tar", "-C", target_dir, "-xf", "-"] + list(tar_options)],
+                              stdin=subprocess.PIPE)
+    # tar -x does not write to stdout
+    extract[-1].stdout.close()
+    try:
+        while data:
+            extract[0].stdin.write(data)
+            data = plain.read(1024 * 1024)
+        extract[0].stdin.close()
+    except Exception as e:
+        for myProcess in extract:
+            if myProcess.poll() is None:
+                myProcess.kill()
+        failed, stderr = _finish_pipeline(extract)
+        raise Exception('{}. {}'.format(e, stderr) if stderr else e)
+    failed, stderr = _finish_pipeline(extract)
+    if failed:
+        raise Exception('{}. {}'.format('; '.join(failed), stderr))
+    return sum(sizes)
+
+
+def _read_part(stream, part_size):
+    """Read up to part_size bytes from stream, less only at EOF"""
+    chunks = []
+    remaining = part_size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def _stream_to_s3(stream, bucket_name, s3_key_name, local_copy_path=None, on_eof=None,
+                  part_size=STREAM_PART_SIZE, max_parts_in_flight=STREAM_MAX_PARTS_IN_FLIGHT,
+                  mirror_buckets=(), mirror_dir=None):
+    """Upload everything read from stream to S3 using multipart upload while the stream is still being produced.
+
+    The stream is read once and sent at the same time to the mirror_buckets and to mirror_dir if given.
+    At most max_parts_in_flight parts are uploaded concurrently to each destination; reading is paused
+    when all of them are busy for any destination.
+    on_eof is called once the stream is exhausted and before the upload is completed,
+    an exception raised from it aborts the upload. When every destination has failed the stream is left
+    partly read and an exception is raised without calling on_eof.
+    The SHA-256 checksums of the parts are verified by S3 and the one of the whole upload is computed on the way.
+    Return the number of bytes uploaded, their SHA-256 as hex and {mirror: error message or None}.
+    The failure of a mirror does not affect the other destinations, the one of bucket_name raises an exception
+    once the mirrors are done.
+    """
+    limiter = _make_rate_limiter(UPLOAD_MAX_BANDWIDTH)
+    destinations = [_S3StreamDestination(bucket, s3_key_name, max_parts_in_flight, limiter)
+                    for bucket in [bucket_name] + list(mirror_buckets)]
+    if mirror_dir:
+        destinations.append(_LocalStreamDestination(os.path.join(mirror_dir, s3_key_name), part_size,
+                                                    max_parts_in_flight))
+    local_copy = None
+    try:
+        if local_copy_path:
+            local_copy = open(local_copy_path, 'wb')
+        total_size = 0
+        total_sha256 = hashlib.sha256()
+        part_number = 1
+        while True:
+            data = _read_part(stream, part_size)
+            if not data and part_number > 1:
+                break
+            if local_copy:
+                local_copy.write(data)
+            total_sha256.update(data)
+            if all(destination.error for destination in destinations):
+                # stop reading, the callers kill the producers of the stream on the exception
+                raise Exception(destinations[0].error)
+            for destination in destinations:
+                destination.put(part_number, data)
+            total_size += len(data)
+            part_number += 1
+            if len(data) < part_size:
+                break
+        if on_eof:
+            on_eof()
+    except BaseException:
+        for destination in destinations:
+            destination.abort()
+        raise
+    finally:
+        if local_copy:
+            local_copy.close()
+    errors = dict((destination.name, destination.finish()) for destination in destinations)
+    error = errors.pop(destinations[0].name)
+    if error:
+        raise Exception(error)
+    return total_size, total_sha256.hexdigest(), errors
+
+
+class _StreamDestination:
+    """Destination of the parts of a stream read by _stream_to_s3(), they are stored in background threads.
+
+    At most max_parts parts are stored at once, put() waits for a free slot. After the first error
+    the destination ignores the rest of the stream, finish() returns the error.
+    """
+
+    def __init__(self, name, max_parts):
+        self.name = name
+        self.error = None
+        self._slots = threading.Semaphore(max_parts)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_parts)
+        self._futures = []
+
+    def put(self, part_number, data):
+        if self.error is None:
+            self._slots.acquire()
+            self._futures.append(self._executor.submit(self._store, part_number, data))
+
+    def _store(self, part_number, data):
+        try:
+            if self.error is None:
+                return self.store_part(part_number, data)
+        except Exception as e:
+            self.error = self.error or "{} failed. {}".format(self.name, e)
+        finally:
+            self._slots.release()
+
+    def finish(self):
+        """Wait for the parts to get stored and complete the destination. Return the error message or None"""
+        self._executor.shutdown()
+        if self.error is None:
+            try:
+                self.complete([future.result() for future in self._futures])
+            except Exception as e:
+                self.error = "{} failed. {}".format(self.name, e)
+        if self.error is not None:
+            self.abort()
+        return self.error
+
+    def abort(self):
+        self._executor.shutdown()
+
+
+class _S3StreamDestination(_StreamDestination):
+    def __init__(self, bucket_name, s3_key_name, max_parts, limiter=None):
+        _StreamDestination.__init__(self, 's3://{}/{}'.format(bucket_name, s3_key_name), max_parts)
+        self.bucket_name = bucket_name
+        self.s3_key_name = s3_key_name
+        self.upload_id = None
+        self._limiter = limiter
+        self._s3_client = _get_s3_client(bucket_name)
+        try:
+            self.upload_id = self._s3_client.create_multipart_upload(Bucket=bucket_name, Key=s3_key_name,
+                                                                     ChecksumAlgorithm='SHA256')['UploadId']
+        except Exception as e:
+            self.error = "{} failed. {}".format(self.name, e)
+
+    def store_part(self, part_number, data):
+        return _upload_part(self._s3_client, self.bucket_name, self.s3_key_name, self.upload_id, part_number, data,
+                            self._limiter)
+
+    def complete(self, parts):
+        parts.sort(key=lambda p: p['PartNumber'])
+        _complete_multipart_upload(self._s3_client, self.bucket_name, self.s3_key_name, self.upload_id, parts)
+
+    def abort(self):
+        _StreamDestination.abort(self)
+        if self.upload_id is not None:
+            try:
+                self._s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key_name,
+                                                       UploadId=self.upload_id)
+            except _client_error():
+                pass
+            self.upload_id = None
+
+
+class _LocalStreamDestination(_StreamDestination):
+    """Copy of the stream in a local file, written to path + '.part' and renamed when complete"""
+
+    def __init__(self, path, part_size, max_parts):
+        _StreamDestination.__init__(self, path, max_parts)
+        self._part_size = part_size
+        self._file = None
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self._file = open(path + '.part', 'wb')
+        except Exception as e:
+            self.error = "{} failed. {}".format(self.name, e)
+
+    def store_part(self, part_number, data):
+        os.pwrite(self._file.fileno(), data, (part_number - 1) * self._part_size)
+
+    def complete(self, parts):
+        self._file.close()
+        os.replace(self.name + '.part', self.name)
+
+    def abort(self):
+        _StreamDestination.abort(self)
+        if self._file is not None:
+            self._file.close()
+            if os.path.exists(self.name + '.part'):
+                os.remove(self.name + '.part')
+
+
+def _upload_part(s3_client, bucket_name, s3_key_name, upload_id, part_number, data, limiter=None):
+    if limiter:
+        limiter.consume(len(data))
+    checksum = _b64_sha256(hashlib.sha256(data).digest())
+    resp = s3_client.upload_part(Bucket=bucket_name, Key=s3_key_name, UploadId=upload_id,
+                                 PartNumber=part_number, Body=data, ChecksumSHA256=checksum)
+    return {'PartNumber': part_number, 'ETag': resp['ETag'], 'ChecksumSHA256': checksum}
+
+
+def _b64_sha256(digest):
+    return base64.b64encode(digest).decode('ascii')
+
+
+def _complete_multipart_upload(s3_client, bucket_name, s3_key_name, upload_id, parts):
+    """Complete the upload of parts as returned by _upload_part() checking the checksum of checksums computed by S3"""
+    resp = s3_client.complete_multipart_upload(Bucket=bucket_name, Key=s3_key_name, UploadId=upload_id,
+                                               MultipartUpload={'Parts': parts})
+    if 'ChecksumSHA256' in resp and all('ChecksumSHA256' in part for part in parts):
+        digests = b''.join(base64.b64decode(part['ChecksumSHA256']) for part in parts)
+        expected = '{}-{}'.format(_b64_sha256(hashlib.sha256(digests).digest()), len(parts))
+        if resp['ChecksumSHA256'] != expected:
+            raise Exception("Checksum of s3://{}/{} is {} instead of {}".format(
+                bucket_name, s3_key_name, resp['ChecksumSHA256'], expected))
+
+
+def _git_mirror_dir(clone_url):
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', clone_url.rstrip('/').split('/')[-1])
+    return os.path.join(GIT_MIRROR_CACHE_DIR, hashlib.sha1(clone_url.encode('utf-8')).hexdigest()[:16] + '-' + name)
+
+
+def _git_refs_state_path(clone_url):
+    """Path of the refs of clone_url seen by the last successful backup"""
+    return _git_mirror_dir(clone_url) + '.refs.json'
+
+
+def _git_refresh_mirror(clone_url, log_file=None):
+    """Bring the persistent mirror of clone_url up to date, the mirror is cloned on first use"""
+    mirror_dir = _git_mirror_dir(clone_url)
+    if os.path.exists(os.path.join(mirror_dir, 'HEAD')):
+        return _run_command(["git", "remote", "update", "--prune"],
+                            "git fetch of {} to {}".format(clone_url, mirror_dir), cwd=mirror_dir, log_file=log_file)
+    shutil.rmtree(mirror_dir, ignore_errors=True)
+    if not os.path.exists(GIT_MIRROR_CACHE_DIR):
+        os.makedirs(GIT_MIRROR_CACHE_DIR)
+    ret = _run_command(["git", "clone", "--mirror", clone_url, mirror_dir],
+                       "git clone of {} to {}".format(clone_url, mirror_dir), cwd=GIT_MIRROR_CACHE_DIR, log_file=log_file)
+    if not ret['ret']:
+        shutil.rmtree(mirror_dir, ignore_errors=True)
+    return ret
+
+def _git_list_refs(mirror_dir):
+    myStdout = subprocess.check_output(["git", "for-each-ref", "--format=%(objectname) %(refname)"], cwd=mirror_dir)
+    return dict(reversed(line.split(' ', 1)) for line in _to_unicode(myStdout).splitlines())
+
+
+def _git_remote_refs(clone_url):
+    """Return {ref: object name} of clone_url asking the remote without fetching"""
+    myStdout = subprocess.check_output(["git", "ls-remote", clone_url])
+    return dict(reversed(line.split('\t', 1)) for line in _to_unicode(myStdout).splitlines())
+
+
+def _git_existing_objects(mirror_dir, object_names):
+    """Return the subset of object_names present in the mirror"""
+    myProcess = subprocess.Popen(["git", "cat-file", "--batch-check"], cwd=mirror_dir,
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    myStdout, _ = myProcess.communicate(''.join(name + '\n' for name in object_names).encode('ascii'))
+    return set(line.split(' ', 1)[0] for line in _to_unicode(myStdout).splitlines() if not line.endswith(' missing'))
+
+
+def _git_backup(clone_url, repo_archive_path, incremental=False, mirror_refreshed=False, log_file=None):
+    """Bundle clone_url to repo_archive_path using the persistent mirror of the repo.
+
+    With incremental only the refs and objects added since the last successful backup get to the bundle,
+    the backup is skipped altogether when there are none.
+    Return also "refs" to save to _git_refs_state_path() once the bundle is safely stored.
+    """
+    stdout = []
+    stderr = []
+    if not mirror_refreshed:
+        ret = _git_refresh_mirror(clone_url, log_file)
+        if not ret['ret']:
+            return ret
+        stdout.append(ret['stdout'])
+        stderr.append(ret['stderr'])
+    mirror_dir = _git_mirror_dir(clone_url)
+    refs = _git_list_refs(mirror_dir)
+    myCmd = ["git", "bundle", "create", repo_archive_path, "--all"]
+    if incremental:
+        last_refs = _load_json_file(_git_refs_state_path(clone_url)) or {}
+        known_objects = _git_existing_objects(mirror_dir, set(last_refs.values()))
+        if set(refs.values()) <= known_objects:
+            return {"ret": True,
+                    "skip": "No new commits in {} since the last backup, skip backup\n".format(clone_url),
+                    "description": "git incremental backup from {} is up to date.".format(clone_url),
+                    "stdout": '\n'.join(stdout).strip(),
+                    "stderr": '\n'.join(stderr).strip(),
+                    "refs": refs}
+        if known_objects:
+            myCmd += ["--not"] + sorted(known_objects)
+    ret = _run_command(myCmd, "git local backup from {} to {}".format(clone_url, repo_archive_path),
+                       cwd=mirror_dir, log_file=log_file)
+    ret['stdout'] = '\n'.join(stdout + [ret['stdout']]).strip()
+    ret['stderr'] = '\n'.join(stderr + [ret['stderr']]).strip()
+    if ret['ret']:
+        ret['refs'] = refs
+    return ret
+
+
+def _mysql_db_backup(db_name, backup_path, log_file=None):
+    with open(backup_path, 'wb') as backup_file:
+        return _run_command(["mysqldump", db_name], "MySQL backup of {} to {}".format(db_name, backup_path),
+                            log_file=log_file, stdout=backup_file)
+
+def _mysql_db_backup_to_archive(db_name, dest_archive, level=None):
+    """Pipe mysqldump of db_name into the archive as <db_name>.sql without staging it on disk.
+
+    Return also "size": the size of the dump.
+    """
+    archive_password = _get_s3_archive_pwd()
+    if not os.path.exists(os.path.dirname(dest_archive)):
+        os.makedirs(os.path.dirname(dest_archive))
+    myDumpStderr = tempfile.TemporaryFile()
+    myArchiverStderr = tempfile.TemporaryFile()
+    myDump = subprocess.Popen(["mysqldump", db_name], stdout=subprocess.PIPE, stderr=myDumpStderr)
+    myArchiver = subprocess.Popen(["7za", "a", "-t7z", "-mhe=on", "-p" + archive_password] + _7z_compression_args(level) +
+                                  ["-si" + db_name + ".sql", dest_archive],
+                                  stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=myArchiverStderr)
+    size = 0
+    try:
+        while True:
+            data = myDump.stdout.read(1024 * 1024)
+            if not data:
+                break
+            myArchiver.stdin.write(data)
+            size += len(data)
+    except BrokenPipeError:
+        myDump.kill()
+    finally:
+        myDump.stdout.close()
+        try:
+            myArchiver.stdin.close()
+        except BrokenPipeError:
+            pass
+    myDump.wait()
+    myArchiver.wait()
+    myStderr = []
+    for f in (myDumpStderr, myArchiverStderr):
+        f.seek(0)
+        myStderr.append(_to_unicode(f.read()).rstrip())
+        f.close()
+    myStderr = '\n'.join(err for err in myStderr if err)
+
+    if myDump.returncode != 0 or myArchiver.returncode != 0:
+        return {"ret": False,
+                "description": "MySQL backup of {} to {} finished with return codes {} (mysqldump), {} (7za).".format(
+                    db_name, dest_archive, myDump.returncode, myArchiver.returncode),
+                "stdout": "",
+                "stderr": myStderr,
+                "size": size}
+    return {"ret": True,
+            "description": "MySQL backup of {} to {} completed successfully.".format(db_name, dest_archive),
+            "stdout": "",
+            "stderr": myStderr,
+            "size": size}
+
+
+def _mysql_parallel_backup(db_name, backup_dir, threads=None):
+    """Dump db_name to backup_dir with mydumper.
+
+    Tables are dumped in parallel by several connections sharing one consistent snapshot
+    and each table is compressed as it is dumped. Restore with myloader.
+    Return also "binlog": [binary log file, position] of the snapshot or None if binary logging is off.
+    """
+    ret = _run_command(["mydumper"] + MYSQL_CLIENT_OPTIONS +
+                       ["--database", db_name, "--outputdir", backup_dir, "--threads", str(threads or MYSQL_DUMP_THREADS),
+                        "--compress", "--trx-consistency-only", "--triggers", "--events", "--routines"],
+                       "Parallel MySQL backup of {} to {}".format(db_name, backup_dir))
+    ret['binlog'] = None
+    if ret['ret']:
+        with open(os.path.join(backup_dir, 'metadata')) as f:
+            metadata = f.read()
+        # 'Log: <file>' and 'Pos: <pos>' in older mydumper versions, 'File = <file>' and 'Position = <pos>' in newer
+        log = re.search(r'(?:Log:|File\s*=)\s*(\S+)', metadata)
+        pos = re.search(r'(?:Pos:|Position\s*=)\s*(\d+)', metadata)
+        if log and pos:
+            ret['binlog'] = [log.group(1), int(pos.group(1))]
+    return ret
+
+
+def _mysql_query(sql):
+    myStdout = subprocess.check_output(["mysql"] + MYSQL_CLIENT_OPTIONS + ["--batch", "--skip-column-names", "-e", sql])
+    return [line.split('\t') for line in _to_unicode(myStdout).splitlines()]
+
+
+def _mysql_binlog_backup(start_file, backup_dir):
+    """Copy the binary logs from start_file on to backup_dir rotating the current binary log first.
+
+    Return also "binlog": [binary log file, position] where the next incremental backup starts
+    or None if start_file is not available anymore.
+    """
+    _mysql_query("FLUSH BINARY LOGS")
+    all_binlogs = [row[0] for row in _mysql_query("SHOW BINARY LOGS")]
+    if start_file not in all_binlogs:
+        return {"ret": False,
+                "description": "MySQL binary log {} is not available anymore.".format(start_file),
+                "stdout": "",
+                "stderr": "",
+                "binlog": None}
+    # the last one has just been opened by the flush
+    binlogs = all_binlogs[all_binlogs.index(start_file):-1]
+    ret = _run_command(["mysqlbinlog"] + MYSQL_CLIENT_OPTIONS +
+                       ["--read-from-remote-server", "--raw", "--result-file=" + backup_dir + os.sep] + binlogs,
+                       "MySQL binary log backup of {} to {}".format(', '.join(binlogs), backup_dir))
+    ret['binlog'] = [all_binlogs[-1], 4]
+    return ret
+
+
+def _trac_backup(trac_dir, backup_dir, log_file=None):
+    return _run_command(["/usr/local/bin/trac-admin", trac_dir, "hotcopy", backup_dir],
+                        "trac backup at {}".format(trac_dir), cwd=trac_dir, log_file=log_file)
+
+def _is_incompressible(path, size):
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    if size < INCOMPRESSIBLE_SAMPLE_SIZE:
+        return False
+    with open(path, 'rb') as f:
+        sample = f.read(INCOMPRESSIBLE_SAMPLE_SIZE)
+    return len(zlib.compress(sample, 1)) > len(sample) * INCOMPRESSIBLE_RATIO
+
+
+def _7z_compression_args(level=None):
+    level = ARCHIVE_COMPRESSION_LEVEL if level is None else level
+    return (["-mx{}".format(level)] if level is not None else []) + ["-mmt{}".format(COMPRESSION_THREADS or os.cpu_count() or 1)]
+
+
+def _compress_cmd(codec=None, level=None):
+    """Return the command compressing stdin to stdout with codec (ARCHIVE_CODEC by default) or None for Codec.STORE"""
+    codec = codec or ARCHIVE_CODEC
+    level = ARCHIVE_COMPRESSION_LEVEL if level is None else level
+    threads = "-T{}".format(COMPRESSION_THREADS or 0)
+    if codec == Codec.STORE:
+        return None
+    if codec == Codec.ZSTD:
+        return ["zstd", "-q", "-c", threads] + (["--ultra"] if level is not None and level > 19 else []) + \
+            (["-{}".format(level)] if level is not None else [])
+    if codec in (Codec.XZ, Codec.SEVEN_ZIP):
+        return ["xz", "-c", threads] + (["-{}".format(level)] if level is not None else [])
+    raise Exception("Unsupported codec {}".format(codec))
+
+
+_COMPRESSION_MAGIC_SIZE = 6
+
+
+def _decompress_cmds(header):
+    """Return the decompression pipeline for a tar stream starting with header, empty for a stored one"""
+    if header.startswith(b"\xfd7zXZ\x00"):
+        return [["xz", "-d", "-c", "-T0"]]
+    if header.startswith(b"\x28\xb5\x2f\xfd"):
+        return [["zstd", "-d", "-q", "-c"]]
+    return []
+
+
+def _archive(src_dir, dest_archive, follow_symlinks=False, codec=None, level=None):
+    """Archive src_dir to dest_archive with codec (ARCHIVE_CODEC by default).
+
+    7z archives are made by 7za, with STORE_COMPRESSED_FILES in two passes: the compressed files are added stored.
+    The other codecs and Encryption.AES_GCM make an encrypted tar stream like _stream_archive_to_s3().
+    Return also "sha256" of the archive.
+    """
+    if not os.path.exists(os.path.dirname(dest_archive)):
+        os.makedirs(os.path.dirname(dest_archive))
+    if (codec or ARCHIVE_CODEC) != Codec.SEVEN_ZIP or ARCHIVE_ENCRYPTION != Encryption.GPG:
+        return _tar_archive(src_dir, dest_archive, follow_symlinks, codec, level)
+    archive_password = _get_s3_archive_pwd()
+    myCmd = ["7za", "a", "-t7z", "-mhe=on"] + (["-l"] if follow_symlinks else []) + ["-p" + archive_password]
+    # 7za runs in src_dir
+    archive = os.path.abspath(dest_archive)
+    names = sorted(name for name in os.listdir(src_dir) if not name.startswith('.'))
+    members = _archive_members(src_dir, follow_symlinks) if STORE_COMPRESSED_FILES else []
+    stored = set(path for path, kind, st in members
+                 if kind == 'f' and _is_incompressible(os.path.join(src_dir, path), st.st_size))
+    if not stored:
+        ret = _run_command(myCmd + _7z_compression_args(level) + [archive, "--"] + names,
+                           "archiving {} to {}".format(src_dir, dest_archive), cwd=src_dir)
+    else:
+        # files and empty directories are listed one by one, a listed directory would be added with all its content
+        non_empty = set(os.path.dirname(path) for path, kind, st in members)
+        compressed = [path for path, kind, st in members if path not in stored and (kind != 'd' or path not in non_empty)]
+        # an empty list file would make 7za add the whole src_dir, skip that pass (stored is never empty here)
+        for args, paths in ((_7z_compression_args(level), compressed), (["-mx0"], sorted(stored))):
+            if not paths:
+                continue
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8') as name_list:
+                name_list.write(''.join(path + '\n' for path in paths))
+                name_list.flush()
+                ret = _run_command(myCmd + args + ["-spd", "-scsUTF-8", archive, "@" + name_list.name],
+                                   "archiving {} to {}".format(src_dir, dest_archive), cwd=src_dir)
+            if not ret['ret']:
+                break
+    # skip stdout since it contains all files added to the archive
+    result = {"ret": ret['ret'], "description": ret['description'], "stderr": ret['stderr']}
+    if ret['ret']:
+        # read back while the archive is still in the page cache
+        result['sha256'] = _file_sha256(dest_archive)
+    return result
+
+
+def _tar_archive(src_dir, dest_archive, follow_symlinks=False, codec=None, level=None):
+    """Write the encrypted tar stream of src_dir to dest_archive. Return also "sha256" of the archive"""
+    procs = _start_pipeline(_streaming_archive_cmds(src_dir, follow_symlinks, codec, level))
+    sha256 = hashlib.sha256()
+    try:
+        output = _archive_output(procs)
+        with open(dest_archive, 'wb') as out:
+            for data in iter(lambda: output.read(1024 * 1024), b''):
+                sha256.update(data)
+                out.write(data)
+    except BaseException:
+        for myProcess in procs:
+            if myProcess.poll() is None:
+                myProcess.kill()
+        raise
+    finally:
+        procs[-1].stdout.close()
+        failed, stderr = _finish_pipeline(procs)
+    if failed:
+        return {"ret": False,
+                "description": "archiving {} to {} failed. {}".format(src_dir, dest_archive, '; '.join(failed)),
+                "stderr": stderr}
+    return {"ret": True,
+            "description": "archiving {} to {} completed successfully.".format(src_dir, dest_archive),
+            "stderr": stderr,
+            "sha256": sha256.hexdigest()}
+
+
+def _streaming_archive_cmds(src_dir, follow_symlinks=False, codec=None, level=None):
+    """Return the tar | compressor | gpg pipeline producing an encrypted archive of src_dir on stdout.
+
+    Like _archive, only the top-level entries matched by '*' are included.
+    The result can be extracted with 'gpg -d <archive> | xz -d | tar -x' (zstd -d for Codec.ZSTD, no compressor
+    for Codec.STORE). With Encryption.AES_GCM gpg is left out, read the output with _archive_output().
+    """
+    members = sorted(name for name in os.listdir(src_dir) if not name.startswith('.'))
+    encrypt = _gpg_cmd(["--symmetric", "--cipher-algo", "AES256", "--compress-algo", "none", "-o", "-"]) \
+        if ARCHIVE_ENCRYPTION == Encryption.GPG else None
+    return [cmd for cmd in [["tar", "-C", src_dir, "-cf", "-"] + (["-h"] if follow_symlinks else []) + ["--"] + members,
+                            _compress_cmd(codec, level), encrypt]
+            if cmd]
+
+
+def _archive_output(procs):
+    """Return the encrypted archive made by the _streaming_archive_cmds() pipeline as a file object"""
+    if ARCHIVE_ENCRYPTION == Encryption.AES_GCM:
+        return _IterReader(_aead_encrypt_chunks(procs[-1].stdout))
+    return procs[-1].stdout
+
+
+class _IterReader:
+    """Read-only file object over an iterable of bytes"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self._offset = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._offset >= len(self._buffer):
+                self._buffer = next(self._chunks, None)
+                self._offset = 0
+                if self._buffer is None:
+                    self._buffer = b''
+                    break
+            end = len(self._buffer) if size < 0 else min(len(self._buffer), self._offset + size)
+            parts.append(self._buffer[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+        return b''.join(parts)
+
+
+# Archives encrypted by _aead_encrypt_chunks() start with
+# _AEAD_MAGIC, 16 bytes of key salt, 8 bytes of nonce prefix and 4 bytes of chunk size
+_AEAD_MAGIC = b'BUAEAD1\n'
+_AEAD_HEADER_SIZE = len(_AEAD_MAGIC) + 16 + 8 + 4
+_AEAD_TAG_SIZE = 16
+
+
+def _aead_cipher(salt):
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise Exception("{} encryption needs the cryptography package".format(Encryption.AES_GCM))
+    # gpg takes the first line of the password file
+    password = (_get_s3_archive_pwd().splitlines() or [''])[0]
+    key = hashlib.scrypt(_to_utf8(password), salt=salt, n=2 ** 15, r=8, p=1, maxmem=64 * 1024 * 1024, dklen=32)
+    return AESGCM(key)
+
+
+def _aead_chunk_args(header, nonce_prefix, index, final):
+    # each chunk is bound to the header, its position and whether it is the last one,
+    # so that reordered, truncated or extended archives fail to decrypt
+    return (nonce_prefix + index.to_bytes(4, 'big'),
+            header + index.to_bytes(8, 'big') + (b'\1' if final else b'\0'))
+
+
+def _aead_map_chunks(process, chunks, threads=None):
+    """Yield process(index, chunk, final) for the (chunk, final) pairs in order running them in parallel threads"""
+    threads = threads or ENCRYPTION_THREADS or os.cpu_count() or 1
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for index, (chunk, final) in enumerate(chunks):
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+            pending.append(executor.submit(process, index, chunk, final))
+        while pending:
+            yield pending.popleft().result()
+
+
+def _aead_encrypt_chunks(stream, chunk_size=None, threads=None):
+    """Yield what is read from stream encrypted with AES-256-GCM chunk by chunk.
+
+    Every chunk but the last one holds chunk_size (ENCRYPTION_CHUNK_SIZE by default) bytes of plain text.
+    The key is derived from the archive password by scrypt.
+    """
+    chunk_size = chunk_size or ENCRYPTION_CHUNK_SIZE
+    salt = os.urandom(16)
+    nonce_prefix = os.urandom(8)
+    header = _AEAD_MAGIC + salt + nonce_prefix + chunk_size.to_bytes(4, 'big')
+    cipher = _aead_cipher(salt)
+    yield header
+
+    def read_chunks():
+        while True:
+            data = _read_part(stream, chunk_size)
+            # a short chunk, possibly empty, marks the end
+            final = len(data) < chunk_size
+            yield data, final
+            if final:
+                return
+
+    def encrypt(index, data, final):
+        nonce, aad = _aead_chunk_args(header, nonce_prefix, index, final)
+        return cipher.encrypt(nonce, data, aad)
+
+    for data in _aead_map_chunks(encrypt, read_chunks(), threads):
+        yield data
+
+
+def _aead_decrypt_chunks(stream, threads=None):
+    """Yield the plain text of the archive made by _aead_encrypt_chunks() read from stream"""
+    header = _read_part(stream, _AEAD_HEADER_SIZE)
+    if len(header) < _AEAD_HEADER_SIZE or not header.startswith(_AEAD_MAGIC):
+        raise Exception("Not an {} encrypted archive".format(Encryption.AES_GCM))
+    salt = header[len(_AEAD_MAGIC):len(_AEAD_MAGIC) + 16]
+    nonce_prefix = header[len(_AEAD_MAGIC) + 16:len(_AEAD_MAGIC) + 24]
+    chunk_size = int.from_bytes(header[len(_AEAD_MAGIC) + 24:], 'big')
+    cipher = _aead_cipher(salt)
+
+    def read_chunks():
+        while True:
+            data = _read_part(stream, chunk_size + _AEAD_TAG_SIZE)
+            final = len(data) < chunk_size + _AEAD_TAG_SIZE
+            yield data, final
+            if final:
+                return
+
+    def decrypt(index, data, final):
+        nonce, aad = _aead_chunk_args(header, nonce_prefix, index, final)
+        try:
+            return cipher.decrypt(nonce, data, aad)
+        except Exception:
+            raise Exception("Failed to decrypt chunk {} of the archive: it is damaged, truncated "
+                            "or the password is wrong".format(index))
+
+    for data in _aead_map_chunks(decrypt, read_chunks(), threads):
+        yield data
+
+
+def _gpg_cmd(args):
+    return ["gpg", "--batch", "--quiet", "--yes", "--pinentry-mode", "loopback",
+            "--passphrase-file", _get_s3_archive_pwd_path()] + args
+
+
+def _start_pipeline(cmds, cwd=None, stdin=subprocess.DEVNULL):
+    """Start cmds connected stdout to stdin. Stderr of each command is collected into a temporary file."""
+    procs = []
+    for cmd in cmds:
+        myStderr = tempfile.TemporaryFile()
+        myProcess = subprocess.Popen(cmd, cwd=cwd, stdin=procs[-1].stdout if procs else stdin,
+                                     stdout=subprocess.PIPE, stderr=myStderr)
+        if procs:
+            # let the upstream process get SIGPIPE if we exit early
+            procs[-1].stdout.close()
+        myProcess.stderr_file = myStderr
+        procs.append(myProcess)
+    return procs
+
+
+def _finish_pipeline(procs):
+    """Wait for the pipeline to finish. Return the list of failed commands and the combined stderr"""
+    failed = []
+    stderr = []
+    for myProcess in procs:
+        myProcess.wait()
+        myProcess.stderr_file.seek(0)
+        myStderr = _to_unicode(myProcess.stderr_file.read()).rstrip()
+        myProcess.stderr_file.close()
+        if myStderr:
+            stderr.append(myStderr)
+        if myProcess.returncode != 0:
+            failed.append("'{}' finished with return code {}".format(myProcess.args[0], myProcess.returncode))
+    return failed, '\n'.join(stderr)
+
+
+def _stream_archive_to_s3(src_dir, archive_path, bucket_name, keep_local_copy=True, follow_symlinks=False,
+                          codec=None, level=None, mirror_buckets=(), mirror_dir=None):
+    """Archive src_dir and upload it to S3 under the base name of archive_path as it gets compressed.
+
+    No staging file is needed, a local copy is written to archive_path only if keep_local_copy is set.
+    The archive is sent to mirror_buckets and mirror_dir at the same time, see _stream_to_s3().
+    Return also "mirrors": {mirror: error message or None}.
+    """
+    if not os.path.exists(os.path.dirname(archive_path)):
+        os.makedirs(os.path.dirname(archive_path))
+    s3_key_name = os.path.basename(archive_path)
+    procs = _start_pipeline(_streaming_archive_cmds(src_dir, follow_symlinks, codec, level))
+    result = {}
+
+    def check_pipeline():
+        result['failed'], result['stderr'] = _finish_pipeline(procs)
+        if result['failed']:
+            raise Exception('; '.join(result['failed']))
+
+    try:
+        size, sha256, mirrors = _stream_to_s3(_archive_output(procs), bucket_name, s3_key_name,
+                                              local_copy_path=archive_path if keep_local_copy else None,
+                                              on_eof=check_pipeline, mirror_buckets=mirror_buckets,
+                                              mirror_dir=mirror_dir)
+    except Exception as e:
+        for myProcess in procs:
+            if myProcess.poll() is None:
+                myProcess.kill()
+        if 'stderr' not in result:
+            result['failed'], result['stderr'] = _finish_pipeline(procs)
+        if keep_local_copy and os.path.exists(archive_path):
+            os.remove(archive_path)
+        return {"ret": False,
+                "description": "streaming {} to s3://{}/{} failed. {}".format(src_dir, bucket_name, s3_key_name, e),
+                "stderr": result['stderr']}
+    finally:
+        procs[-1].stdout.close()
+    warning = _record_latest_upload(bucket_name, s3_key_name, size, sha256)
+    warning += _record_mirror_uploads(mirrors, mirror_buckets, s3_key_name, size, sha256)
+    return {"ret": True,
+            "description": "streaming {} to s3://{}/{} completed successfully.{}".format(
+                src_dir, bucket_name, s3_key_name, warning),
+            "warning": warning,
+            "stderr": result['stderr'],
+            "size": size,
+            "sha256": sha256,
+            "mirrors": mirrors}
+
+
+def _archive_members(src_dir, follow_symlinks=False):
+    """Return [(path relative to src_dir, type, os.stat_result)] of what _archive() would include.
+
+    The type is 'd' for directories, 'l' for symlinks and 'f' for regular files. Other files are skipped.
+    """
+    members = []
+
+    def add(path):
+        st = os.lstat(path)
+        if follow_symlinks and stat.S_ISLNK(st.st_mode) and os.path.exists(path):
+            st = os.stat(path)
+        for kind, check in (('d', stat.S_ISDIR), ('l', stat.S_ISLNK), ('f', stat.S_ISREG)):
+            if check(st.st_mode):
+                members.append((os.path.relpath(path, src_dir), kind, st))
+                return kind
+
+    for name in sorted(name for name in os.listdir(src_dir) if not name.startswith('.')):
+        if add(os.path.join(src_dir, name)) != 'd':
+            continue
+        for root, dirs, files in os.walk(os.path.join(src_dir, name), followlinks=follow_symlinks):
+            dirs.sort()
+            for name in dirs + sorted(files):
+                add(os.path.join(root, name))
+    return members
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(data)
+    return h.hexdigest()
+
+
+def _tar_name_list(names):
+    """Return the temporary file with names for 'tar --null --verbatim-files-from -T'"""
+    name_list = tempfile.NamedTemporaryFile()
+    name_list.write(b''.join(os.fsencode(name) + b'\0' for name in names))
+    name_list.flush()
+    return name_list
+
+
+def _write_archive_segment(src_dir, names, out, follow_symlinks=False, codec=None, level=None):
+    """Write names from src_dir to out as a tar compressed with codec and encrypted as ARCHIVE_ENCRYPTION tells.
+    Return the number of bytes written"""
+    with _tar_name_list(names) as name_list:
+        cmds = [["tar", "-C", src_dir, "-cf", "-", "--no-recursion", "--null", "--verbatim-files-from"] +
+                (["-h"] if follow_symlinks else []) + ["-T", name_list.name],
+                _compress_cmd(codec, level),
+                _gpg_cmd(["--symmetric", "--cipher-algo", "AES256", "--compress-algo", "none", "-o", "-"])
+                if ARCHIVE_ENCRYPTION == Encryption.GPG else None]
+        procs = _start_pipeline([cmd for cmd in cmds if cmd])
+        length = 0
+        try:
+            output = _archive_output(procs)
+            for data in iter(lambda: output.read(1024 * 1024), b''):
+                out.write(data)
+                length += len(data)
+        except BaseException:
+            for myProcess in procs:
+                if myProcess.poll() is None:
+                    myProcess.kill()
+            raise
+        finally:
+            procs[-1].stdout.close()
+            failed, stderr = _finish_pipeline(procs)
+        if failed:
+            raise Exception('{}. {}'.format('; '.join(failed), stderr))
+    return length
+
+
+def _write_indexed_archive(src_dir, out, follow_symlinks=False, codec=None, level=None):
+    """Write the indexed archive of src_dir to out. Return the index.
+
+    The archive is a sequence of segments, each of them an encrypted tar of whole files compressed with codec.
+    With STORE_COMPRESSED_FILES the already compressed files go to segments of their own stored uncompressed.
+    The index is {"segments": [{"offset", "length"}],
+                  "members": {path: {"type", "size", "mtime", "sha256" (files only), "segment"}}}
+    """
+    index = {'segments': [], 'members': {}}
+    # pending members of the compressed and stored segments
+    pending = {False: [], True: []}
+    sizes = {False: 0, True: 0}
+
+    def flush(stored):
+        length = _write_archive_segment(src_dir, [path for path, _ in pending[stored]], out, follow_symlinks,
+                                        Codec.STORE if stored else codec, level)
+        for _, member in pending[stored]:
+            member['segment'] = len(index['segments'])
+        last = index['segments'][-1] if index['segments'] else {'offset': 0, 'length': 0}
+        offset = last['offset'] + last['length']
+        index['segments'].append({'offset': offset, 'length': length})
+        pending[stored] = []
+        sizes[stored] = 0
+
+    for path, kind, st in _archive_members(src_dir, follow_symlinks):
+        member = {'type': kind, 'size': st.st_size, 'mtime': st.st_mtime, 'segment': None}
+        stored = False
+        if kind == 'f':
+            full_path = os.path.join(src_dir, path)
+            member['sha256'] = _file_sha256(full_path)
+            stored = STORE_COMPRESSED_FILES and _is_incompressible(full_path, st.st_size)
+            sizes[stored] += st.st_size
+        index['members'][path] = member
+        pending[stored].append((path, member))
+        if sizes[stored] >= INDEX_SEGMENT_SIZE:
+            flush(stored)
+    for stored in (False, True):
+        if pending[stored]:
+            flush(stored)
+    return index
+
+
+def _encode_archive_index(index):
+    data = zlib.compress(json.dumps(index).encode('utf-8'))
+    if ARCHIVE_ENCRYPTION == Encryption.AES_GCM:
+        return b''.join(_aead_encrypt_chunks(_IterReader([data])))
+    return _gpg_encrypt(data)
+
+
+def _decode_archive_index(data):
+    if data.startswith(_AEAD_MAGIC):
+        data = b''.join(_aead_decrypt_chunks(_IterReader([data])))
+    else:
+        data = _gpg_decrypt(data)
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+class _HashingWriter:
+    """File object writing to out and computing the SHA-256 of what is written"""
+
+    def __init__(self, out):
+        self._out = out
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self._out.write(data)
+
+
+def _indexed_archive(src_dir, dest_archive, follow_symlinks=False, codec=None, level=None):
+    """Make the indexed archive of src_dir, see _write_indexed_archive(). The index goes to dest_archive + INDEX_KEY_SUFFIX.
+
+    Return also "sha256" of the archive.
+    """
+    if not os.path.exists(os.path.dirname(dest_archive)):
+        os.makedirs(os.path.dirname(dest_archive))
+    try:
+        with open(dest_archive, 'wb') as f:
+            out = _HashingWriter(f)
+            index = _write_indexed_archive(src_dir, out, follow_symlinks, codec, level)
+        with open(dest_archive + INDEX_KEY_SUFFIX, 'wb') as f:
+            f.write(_encode_archive_index(index))
+    except Exception as e:
+        return {"ret": False,
+                "description": "archiving {} to {} failed. {}".format(src_dir, dest_archive, e),
+                "stderr": ''}
+    return {"ret": True,
+            "description": "archiving {} to {} with {} completed successfully.".format(
+                src_dir, dest_archive, dest_archive + INDEX_KEY_SUFFIX),
+            "stderr": '',
+            "sha256": out.sha256.hexdigest()}
+
+
+def _stream_indexed_archive_to_s3(src_dir, archive_path, bucket_name, keep_local_copy=True, follow_symlinks=False,
+                                  codec=None, level=None, mirror_buckets=(), mirror_dir=None):
+    """Like _stream_archive_to_s3() but make the indexed archive and upload its index next to it"""
+    if not os.path.exists(os.path.dirname(archive_path)):
+        os.makedirs(os.path.dirname(archive_path))
+    s3_key_name = os.path.basename(archive_path)
+    read_fd, write_fd = os.pipe()
+    result = {}
+
+    def write_archive():
+        try:
+            with os.fdopen(write_fd, 'wb') as out:
+                result['index'] = _write_indexed_archive(src_dir, out, follow_symlinks, codec, level)
+        except BaseException as e:
+            result['error'] = e
+
+    def check_archive():
+        writer.join()
+        if 'error' in result:
+            raise result['error']
+
+    writer = threading.Thread(target=write_archive)
+    writer.start()
+    try:
+        with os.fdopen(read_fd, 'rb') as stream:
+            size, sha256, mirrors = _stream_to_s3(stream, bucket_name, s3_key_name,
+                                                  local_copy_path=archive_path if keep_local_copy else None,
+                                                  on_eof=check_archive, mirror_buckets=mirror_buckets,
+                                                  mirror_dir=mirror_dir)
+        index = _encode_archive_index(result['index'])
+        _get_s3_client(bucket_name).put_object(Bucket=bucket_name, Key=s3_key_name + INDEX_KEY_SUFFIX, Body=index)
+        for mirror in mirror_buckets:
+            name = 's3://{}/{}'.format(mirror, s3_key_name)
+            if mirrors[name] is None:
+                try:
+                    _get_s3_client(mirror).put_object(Bucket=mirror, Key=s3_key_name + INDEX_KEY_SUFFIX, Body=index)
+                except Exception as e:
+                    mirrors[name] = "{} failed. {}".format(name, e)
+        name = mirror_dir and os.path.join(mirror_dir, s3_key_name)
+        if mirror_dir and mirrors[name] is None:
+            try:
+                with open(name + INDEX_KEY_SUFFIX, 'wb') as f:
+                    f.write(index)
+            except Exception as e:
+                mirrors[name] = "{} failed. {}".format(name, e)
+    except Exception as e:
+        writer.join()
+        if keep_local_copy and os.path.exists(archive_path):
+            os.remove(archive_path)
+        return {"ret": False,
+                "description": "streaming {} to s3://{}/{} failed. {}".format(src_dir, bucket_name, s3_key_name, e),
+                "stderr": ''}
+    warning = _record_latest_upload(bucket_name, s3_key_name, size, sha256)
+    warning += _record_mirror_uploads(mirrors, mirror_buckets, s3_key_name, size, sha256)
+    return {"ret": True,
+            "description": "streaming {} to s3://{}/{} completed successfully.{}".format(
+                src_dir, bucket_name, s3_key_name, warning),
+            "warning": warning,
+            "stderr": '',
+            "size": size,
+            "sha256": sha256,
+            "mirrors": mirrors}
+
+
+def _load_archive_index(bucket_name, s3_key_name):
+    """Return the index of the archive or None if it is not indexed"""
+    try:
+        data = _get_s3_client(bucket_name).get_object(Bucket=bucket_name, Key=s3_key_name + INDEX_KEY_SUFFIX)['Body'].read()
+    except _client_error() as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return _decode_archive_index(data)
+
+
+def _match_index_members(index, patterns):
+    """Return the sorted archive members matching any of patterns: a path, a directory with all its content or a glob"""
+    def match(path, pattern):
+        return path == pattern or path.startswith(pattern.rstrip('/') + '/') or fnmatch.fnmatchcase(path, pattern)
+    return sorted(path for path in index['members'] if any(match(path, pattern) for pattern in patterns))
+
+
+def _restore_indexed_members(bucket_name, s3_key_name, index, paths, target_dir):
+    """Extract paths of the indexed archive to target_dir fetching only the segments holding them.
+
+    Up to DOWNLOAD_MAX_CONCURRENCY segments are restored at once, each one decrypted and extracted
+    as its DOWNLOAD_PART_SIZE ranges are downloaded one after another, so a segment holding a big file
+    is never held in memory. Return the number of bytes downloaded.
+    """
+    s3_client = _get_s3_client(bucket_name)
+    etag = s3_client.head_object(Bucket=bucket_name, Key=s3_key_name)['ETag']
+    segment_names = {}
+    for path in paths:
+        segment_names.setdefault(index['members'][path]['segment'], []).append(path)
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    def restore_segment(segment, names):
+        ranges = _iter_s3_ranges(bucket_name, s3_key_name, max_concurrency=1, start=segment['offset'],
+                                 end=segment['offset'] + segment['length'], etag=etag)
+        first = next(ranges, b'')
+        restore = _aead_stream_restore if first.startswith(_AEAD_MAGIC) else _gpg_stream_restore
+        with _tar_name_list(names) as name_list:
+            return restore(first, ranges, target_dir,
+                           ["--no-recursion", "--null", "--verbatim-files-from", "-T", name_list.name])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_MAX_CONCURRENCY) as executor:
+        size = sum(executor.map(lambda item: restore_segment(index['segments'][item[0]], item[1]),
+                                segment_names.items()))
+    corrupted = [path for path in paths if index['members'][path]['type'] == 'f' and
+                 _file_sha256(os.path.join(target_dir, path)) != index['members'][path]['sha256']]
+    if corrupted:
+        raise Exception('Restored files do not match their hashes: ' + ', '.join(corrupted))
+    return size
+
+
+_RETENTION_PERIODS = {'daily': lambda t: t.date(),
+                      'weekly': lambda t: tuple(t.isocalendar())[:2],
+                      'monthly': lambda t: (t.year, t.month),
+                      'yearly': lambda t: t.year}
+
+
+def _select_expired(archives, policy=None, max_age=MAX_ARCHIVE_AGE_DAYS, now=None, bases=None):
+    """Return the names of archives [(name, modification time as aware datetime)] the retention policy does not keep.
+
+    See RETENTION_POLICY, with no policy the archives older than max_age days are expired like 'find -mtime +max_age' does.
+    bases is {name of an incremental archive: name of the full archive it builds on}, see _incremental_bases().
+    An incremental archive is kept with its full archive and the incremental ones made in between.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    if not policy:
+        keep = set(name for name, mtime in archives if now - mtime < datetime.timedelta(days=max_age + 1))
+    else:
+        for rule in policy:
+            if rule not in _RETENTION_PERIODS:
+                raise Exception("Unsupported retention rule {}".format(rule))
+        archives = sorted(archives, key=lambda archive: archive[1], reverse=True)
+        # the newest archive is always kept
+        keep = set(name for name, _ in archives[:1])
+        for rule, count in policy.items():
+            periods = set()
+            for name, mtime in archives:
+                period = _RETENTION_PERIODS[rule](mtime)
+                if period not in periods:
+                    if len(periods) >= count:
+                        break
+                    periods.add(period)
+                    keep.add(name)
+    if bases:
+        mtimes = dict(archives)
+        for name in [name for name in keep if bases.get(name) is not None]:
+            keep.update(other for other, mtime in archives
+                        if bases.get(other) == bases[name] and mtime <= mtimes[name])
+    return sorted(name for name, _ in archives if name not in keep)
+
+
+def _select_expired_by_series(archives, policy=None, max_age=MAX_ARCHIVE_AGE_DAYS, bases=None):
+    """Like _select_expired() but apply the policy to each series of archives on its own, see _archive_series().
+
+    Archives named with no timestamp are expired after max_age days whatever the policy, see RETENTION_POLICY.
+    """
+    series = collections.defaultdict(list)
+    by_age = []
+    for name, mtime in archives:
+        base_name = name.rsplit('/', 1)[-1]
+        if _archive_series(base_name) == base_name:
+            by_age.append((name, mtime))
+        else:
+            series[_archive_series(name)].append((name, mtime))
+    expired = _select_expired(by_age, None, max_age, bases=bases)
+    for group in series.values():
+        expired += _select_expired(group, policy, max_age, bases=bases)
+    return sorted(expired)
+
+
+def _cleanup_old_archines(dir, extension, max_age=MAX_ARCHIVE_AGE_DAYS, policy=None, dry_run=False, prefix='',
+                          series=None, by_age=False):
+    """Delete the archives dir/prefix*extension expired by the retention policy (RETENTION_POLICY by default)
+    applied to each series of archives on its own, by_age the ones older than max_age days whatever the policy.
+
+    With series only the archives of that series are considered, see _archive_series().
+    Index files of the deleted archives are deleted with them.
+    """
+    policy = None if by_age else policy or RETENTION_POLICY
+    try:
+        archives = []
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.name.startswith(prefix) or \
+                        not entry.name.endswith(extension) or not entry.is_file():
+                    continue
+                if series is not None and _archive_series(entry.name) != series:
+                    continue
+                mtime = datetime.datetime.fromtimestamp(entry.stat().st_mtime, datetime.timezone.utc)
+                archives.append((entry.name, mtime))
+        if by_age:
+            expired = _select_expired(archives, None, max_age, bases=_incremental_bases())
+        else:
+            expired = _select_expired_by_series(archives, policy, max_age, bases=_incremental_bases())
+        if not dry_run:
+            for name in expired:
+                for path in (os.path.join(dir, name), os.path.join(dir, name + INDEX_KEY_SUFFIX)):
+                    if os.path.exists(path):
+                        os.remove(path)
+    except Exception as e:
+        return {"ret": False,
+                "description": "cleaning up {}/{}*{} failed. {}".format(dir, prefix, extension, e),
+                "stderr": '',
+                "deleted": []}
+    return {"ret": True,
+            "description": "cleaning up {}/{}*{} completed successfully, {} {} archive(s).".format(
+                dir, prefix, extension, 'would delete' if dry_run else 'deleted', len(expired)),
+            "stderr": '',
+            "deleted": expired}
+
+
+def _delete_s3_keys(bucket_name, s3_key_names):
+    """Delete the keys with batched DeleteObjects calls"""
+    s3_client = _get_s3_client(bucket_name)
+    for i in range(0, len(s3_key_names), S3_DELETE_BATCH_SIZE):
+        batch = s3_key_names[i:i + S3_DELETE_BATCH_SIZE]
+        resp = s3_client.delete_objects(Bucket=bucket_name,
+                                        Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+        if resp.get('Errors'):
+            raise Exception('Failed to delete {}'.format(', '.join(
+                '{} ({})'.format(error['Key'], error.get('Message', error.get('Code'))) for error in resp['Errors'])))
+
+
+def _cleanup_old_s3_archives(bucket_name, key_prefix, extension='', max_age=MAX_ARCHIVE_AGE_DAYS, policy=None,
+                             dry_run=False):
+    """Delete the objects under key_prefix ending with extension expired by the retention policy,
+    applied to each series of archives on its own as by _select_expired_by_series().
+
+    The objects of the dedup snapshots under DEDUP_KEY_PREFIX are never deleted.
+
+    Return the list of the deleted keys, index objects of the deleted archives are deleted with them.
+    """
+    policy = policy or RETENTION_POLICY
+    objects = _list_s3_keys(bucket_name, key_prefix)
+    all_keys = set(obj['Key'] for obj in objects)
+    # dedup packs and snapshots are shared by the snapshots and cannot be expired one by one
+    archives = [(obj['Key'], obj['LastModified']) for obj in objects
+                if obj['Key'].endswith(extension) and obj['Key'] != LATEST_MANIFEST_KEY and
+                not obj['Key'].endswith(INDEX_KEY_SUFFIX) and not obj['Key'].startswith(DEDUP_KEY_PREFIX)]
+    expired = _select_expired_by_series(archives, policy, max_age, bases=_incremental_bases())
+    if expired and not dry_run:
+        _delete_s3_keys(bucket_name, expired + [key + INDEX_KEY_SUFFIX for key in expired
+                                                if key + INDEX_KEY_SUFFIX in all_keys])
+        _forget_latest_uploads(bucket_name, expired)
+    return expired
+
+
+def _gpg_process(data, args):
+    myProcess = subprocess.Popen(_gpg_cmd(args), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    myStdout, myStderr = myProcess.communicate(data)
+    if myProcess.returncode != 0:
+        raise Exception("gpg finished with return code {}. {}".format(
+            myProcess.returncode, _to_unicode(myStderr).rstrip()))
+    return myStdout
+
+
+def _gpg_encrypt(data):
+    return _gpg_process(data, ["--symmetric", "--cipher-algo", "AES256", "--compress-algo", "none", "-o", "-"])
+
+
+def _gpg_decrypt(data):
+    return _gpg_process(data, ["--decrypt", "-o", "-"])
+
+
+# Content-defined chunking by bit anchors: each byte value is mapped to one bit by _CHUNK_BIT_TABLE and a chunk
+# ends right after the first DEDUP_AVG_CHUNK_BITS bytes whose bits form the anchor pattern of _chunk_anchor(),
+# ending past DEDUP_MIN_CHUNK_SIZE, or at DEDUP_MAX_CHUNK_SIZE. Both steps run in C via bytes.translate()
+# and bytes.find(). The boundaries must not change, otherwise the chunks of the existing dedup indexes are not reused
+_CHUNK_BIT_TABLE = bytes(hashlib.sha256(bytes([i])).digest()[0] & 1 for i in range(256))
+_chunk_anchors = {}
+_CHUNK_SCAN_BLOCK = 256 * 1024
+
+
+def _chunk_anchor(bits):
+    """Return the anchor pattern of bits bytes, fixed and with no short period"""
+    if bits not in _chunk_anchors:
+        digest = hashlib.sha256('backup_util chunk anchor {}'.format(bits).encode('utf-8')).digest()
+        _chunk_anchors[bits] = bytes((digest[i // 8] >> (i % 8)) & 1 for i in range(bits))
+    return _chunk_anchors[bits]
+
+
+def _chunk_boundary(data, end):
+    """Return the end of the content-defined chunk starting at data[0].
+
+    data[:end] must hold DEDUP_MAX_CHUNK_SIZE bytes or everything up to the end of file.
+    """
+    end = min(end, DEDUP_MAX_CHUNK_SIZE)
+    if DEDUP_MIN_CHUNK_SIZE >= end:
+        return end
+    anchor = _chunk_anchor(DEDUP_AVG_CHUNK_BITS)
+    # the anchor may start in the chunk head but ends past DEDUP_MIN_CHUNK_SIZE
+    start = max(0, DEDUP_MIN_CHUNK_SIZE - len(anchor) + 1)
+    while True:
+        # scan by blocks overlapping by the anchor length rather than mapping the whole rest up to end
+        stop = min(end, start + _CHUNK_SCAN_BLOCK)
+        i = data[start:stop].translate(_CHUNK_BIT_TABLE).find(anchor)
+        if i >= 0:
+            return start + i + len(anchor)
+        if stop == end:
+            return end
+        start = stop - len(anchor) + 1
+
+
+def _iter_file_chunks(path):
+    with open(path, 'rb') as f:
+        buf = bytearray()
+        eof = False
+        while True:
+            if not eof and len(buf) < DEDUP_MAX_CHUNK_SIZE:
+                data = f.read(2 * DEDUP_MAX_CHUNK_SIZE)
+                eof = not data
+                buf += data
+                continue
+            if not buf:
+                return
+            cut = _chunk_boundary(buf, len(buf))
+            yield bytes(buf[:cut])
+            del buf[:cut]
+
+
+def _open_dedup_index(bucket_name):
+    """Open the local index of the chunks already stored in bucket_name"""
+    if not os.path.exists(DEDUP_INDEX_DIR):
+        os.makedirs(DEDUP_INDEX_DIR)
+    index = sqlite3.connect(os.path.join(DEDUP_INDEX_DIR, bucket_name + '.sqlite'), timeout=600)
+    index.execute('CREATE TABLE IF NOT EXISTS chunks '
+                  '(id TEXT PRIMARY KEY, pack TEXT, offset INTEGER, length INTEGER, size INTEGER)')
+    # chunk lists of the files backed up last time, to avoid re-reading unchanged files
+    index.execute('CREATE TABLE IF NOT EXISTS files '
+                  '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, chunks TEXT)')
+    return index
+
+
+def _lock_dedup_bucket(bucket_name, exclusive=False):
+    """Lock the dedup objects of bucket_name on this host, shared by the backups and exclusive for the prune
+    that must not delete the packs whose chunks a running backup reuses. Close the returned file to unlock"""
+    if not os.path.exists(DEDUP_INDEX_DIR):
+        os.makedirs(DEDUP_INDEX_DIR)
+    lock_file = open(os.path.join(DEDUP_INDEX_DIR, bucket_name + '.lock'), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    except BaseException:
+        lock_file.close()
+        raise
+    return lock_file
+
+
+class _PackWriter:
+    """Collect new chunks into packs and upload the packs to S3 in the background.
+
+    Chunks get into the index only once their pack is uploaded.
+    """
+
+    def __init__(self, s3_client, bucket_name, index):
+        self._s3_client = s3_client
+        self._bucket_name = bucket_name
+        self._index = index
+        self._buf = bytearray()
+        self._chunks = []
+        self._pending = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=STREAM_MAX_PARTS_IN_FLIGHT)
+        self.added = set()
+        self.uploaded_bytes = 0
+
+    def add(self, chunk_id, data):
+        blob = zlib.compress(data, 6)
+        if len(blob) < len(data):
+            blob = b'\x01' + blob
+        else:
+            blob = b'\x00' + data
+        self._chunks.append((chunk_id, len(self._buf), len(blob), len(data)))
+        self._buf += blob
+        self.added.add(chunk_id)
+        if len(self._buf) >= DEDUP_PACK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._chunks:
+            return
+        if len(self._pending) >= STREAM_MAX_PARTS_IN_FLIGHT:
+            self._wait(concurrent.futures.FIRST_COMPLETED)
+        future = self._executor.submit(self._upload, bytes(self._buf))
+        self._pending[future] = self._chunks
+        self._buf = bytearray()
+        self._chunks = []
+
+    def close(self):
+        try:
+            self.flush()
+            self._wait(concurrent.futures.ALL_COMPLETED)
+        finally:
+            self._executor.shutdown()
+
+    def _upload(self, data):
+        encrypted = _gpg_encrypt(data)
+        pack_id = hashlib.sha256(encrypted).hexdigest()
+        self._s3_client.put_object(Bucket=self._bucket_name, Key=DEDUP_KEY_PREFIX + 'packs/' + pack_id, Body=encrypted)
+        return pack_id, len(encrypted)
+
+    def _wait(self, return_when):
+        done, _ = concurrent.futures.wait(self._pending, return_when=return_when)
+        for future in done:
+            chunks = self._pending.pop(future)
+            pack_id, size = future.result()
+            self._index.executemany('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?)',
+                                    [(chunk_id, pack_id, offset, length, chunk_size)
+                                     for chunk_id, offset, length, chunk_size in chunks])
+            self._index.commit()
+            self.uploaded_bytes += size
+
+
+def _dedup_snapshot_key(snapshot_name):
+    return DEDUP_KEY_PREFIX + 'snapshots/' + snapshot_name + '.manifest'
+
+
+def _dedup_backup(src_dir, snapshot_name, bucket_name, log_file, follow_symlinks=False):
+    """Back up src_dir to S3 as a deduplicated snapshot.
+
+    Files are split into content-defined chunks, only chunks missing from the bucket are packed and uploaded,
+    followed by the snapshot manifest listing the files with their chunks.
+    Files with the same size and mtime as in the previous backup are not read again.
+    Like _archive, top-level entries starting with '.' are skipped.
+    Return {"ret": bool, "description": status for the backup report, "size": uploaded bytes}
+    """
+    chunk_key = _get_s3_archive_pwd().encode('utf-8')
+    s3_client = _get_s3_client(bucket_name)
+    with _lock_dedup_bucket(bucket_name):
+        return _dedup_backup_locked(src_dir, snapshot_name, bucket_name, s3_client, chunk_key, follow_symlinks)
+
+
+def _dedup_backup_locked(src_dir, snapshot_name, bucket_name, s3_client, chunk_key, follow_symlinks):
+    index = _open_dedup_index(bucket_name)
+    try:
+        writer = _PackWriter(s3_client, bucket_name, index)
+        entries = []
+        file_chunks = {}
+        total_size = 0
+        new_size = 0
+        try:
+            for root, dirs, files in os.walk(src_dir, followlinks=follow_symlinks):
+                if root == src_dir:
+                    dirs[:] = [name for name in dirs if not name.startswith('.')]
+                    files = [name for name in files if not name.startswith('.')]
+                dirs.sort()
+                for name in dirs + sorted(files):
+                    path = os.path.join(root, name)
+                    st = os.stat(path) if follow_symlinks else os.lstat(path)
+                    entry = {"path": os.path.relpath(path, src_dir), "mode": st.st_mode & 0o7777,
+                             "mtime": st.st_mtime}
+                    entries.append(entry)
+                    if stat.S_ISLNK(st.st_mode):
+                        entry['type'] = 'l'
+                        entry['target'] = os.readlink(path)
+                        continue
+                    if stat.S_ISDIR(st.st_mode):
+                        entry['type'] = 'd'
+                        continue
+                    if not stat.S_ISREG(st.st_mode):
+                        entries.pop()
+                        continue
+                    entry['type'] = 'f'
+                    entry['size'] = st.st_size
+                    total_size += st.st_size
+                    # files reached through the symlinks of a staging dir are known by their real path
+                    cache_key = os.path.realpath(path) if follow_symlinks else path
+                    row = index.execute('SELECT size, mtime_ns, chunks FROM files WHERE path = ?',
+                                        (cache_key,)).fetchone()
+                    if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+                        entry['chunks'] = json.loads(row[2])
+                    else:
+                        entry['chunks'] = []
+                        for data in _iter_file_chunks(path):
+                            chunk_id = hmac.new(chunk_key, data, hashlib.sha256).hexdigest()
+                            entry['chunks'].append(chunk_id)
+                            if chunk_id not in writer.added and not index.execute(
+                                    'SELECT 1 FROM chunks WHERE id = ?', (chunk_id,)).fetchone():
+                                writer.add(chunk_id, data)
+                                new_size += len(data)
+                    file_chunks[cache_key] = (st.st_size, st.st_mtime_ns, entry['chunks'])
+        finally:
+            writer.close()
+
+        chunks = {}
+        for entry in entries:
+            for chunk_id in entry.get('chunks', []):
+                if chunk_id not in chunks:
+                    row = index.execute('SELECT pack, offset, length, size FROM chunks WHERE id = ?',
+                                        (chunk_id,)).fetchone()
+                    if row is None:
+                        raise Exception("Chunk {} of {} is missing from the index".format(chunk_id, entry['path']))
+                    chunks[chunk_id] = row
+        manifest = {"version": 1, "source": src_dir, "created": datetime.datetime.today().isoformat(),
+                    "entries": entries, "chunks": chunks}
+        manifest_data = _gpg_encrypt(zlib.compress(json.dumps(manifest).encode('utf-8'), 9))
+        s3_client.put_object(Bucket=bucket_name, Key=_dedup_snapshot_key(snapshot_name), Body=manifest_data)
+
+        index.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                          [(path, size, mtime_ns, json.dumps(chunk_ids))
+                           for path, (size, mtime_ns, chunk_ids) in file_chunks.items()])
+        index.commit()
+    finally:
+        index.close()
+    return {"ret": True,
+            "size": writer.uploaded_bytes + len(manifest_data),
+            "description": "Deduplicated {} to snapshot {}: {} files, {} bytes, {} bytes new, "
+                           "uploaded {} bytes in packs and {} bytes of manifest...done.".format(
+                               src_dir, snapshot_name, len(file_chunks), total_size, new_size,
+                               writer.uploaded_bytes, len(manifest_data))}
+
+
+def _load_dedup_manifest(s3_client, bucket_name, snapshot_key):
+    manifest_data = s3_client.get_object(Bucket=bucket_name, Key=snapshot_key)['Body'].read()
+    return json.loads(zlib.decompress(_gpg_decrypt(manifest_data)).decode('utf-8'))
+
+
+def _prune_dedup_snapshots(bucket_name, snapshot_prefix, max_age=MAX_ARCHIVE_AGE_DAYS, policy=None, dry_run=False):
+    """Delete the dedup snapshots named with snapshot_prefix expired by the retention policy
+    and the packs no other snapshot in the bucket refers to.
+
+    The chunks of the deleted packs are dropped from the local index, the indexes of other hosts
+    backing up to the same bucket are not aware of that. The dedup backups to the bucket running
+    on this host are waited for and the new ones wait for the prune, see _lock_dedup_bucket().
+    Return the names of the deleted snapshots and the number of the deleted packs.
+    """
+    with _lock_dedup_bucket(bucket_name, exclusive=True):
+        return _prune_dedup_snapshots_locked(bucket_name, snapshot_prefix, max_age, policy, dry_run)
+
+
+def _prune_dedup_snapshots_locked(bucket_name, snapshot_prefix, max_age, policy, dry_run):
+    policy = policy or RETENTION_POLICY
+    s3_client = _get_s3_client(bucket_name)
+    snapshots_prefix = _dedup_snapshot_key('')[:-len('.manifest')]
+    snapshots = [obj for obj in _list_s3_keys(bucket_name, snapshots_prefix) if obj['Key'].endswith('.manifest')]
+    expired_keys = set(_select_expired([(obj['Key'], obj['LastModified']) for obj in snapshots
+                                        if obj['Key'].startswith(snapshots_prefix + snapshot_prefix)],
+                                       policy, max_age))
+    expired = sorted(key[len(snapshots_prefix):-len('.manifest')] for key in expired_keys)
+    if not expired or dry_run:
+        return expired, 0
+    referenced = set()
+    for obj in snapshots:
+        if obj['Key'] not in expired_keys:
+            manifest = _load_dedup_manifest(s3_client, bucket_name, obj['Key'])
+            referenced.update(pack_id for pack_id, _, _, _ in manifest['chunks'].values())
+    _delete_s3_keys(bucket_name, sorted(expired_keys))
+    grace_start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=DEDUP_PRUNE_GRACE_HOURS)
+    packs_prefix = DEDUP_KEY_PREFIX + 'packs/'
+    unreferenced = [obj['Key'][len(packs_prefix):] for obj in _list_s3_keys(bucket_name, packs_prefix)
+                    if obj['Key'][len(packs_prefix):] not in referenced and obj['LastModified'] < grace_start]
+    if unreferenced:
+        # forget the chunks before their packs are gone so that the next backups upload them again
+        index = _open_dedup_index(bucket_name)
+        try:
+            index.executemany('DELETE FROM chunks WHERE pack = ?', [(pack_id,) for pack_id in unreferenced])
+            # the cached chunk lists may refer to the deleted chunks
+            index.execute('DELETE FROM files')
+            index.commit()
+        finally:
+            index.close()
+        _delete_s3_keys(bucket_name, [packs_prefix + pack_id for pack_id in unreferenced])
+    return expired, len(unreferenced)
+
+
+def _dedup_restore(bucket_name, snapshot_name, target_dir):
+    """Restore the snapshot made by _dedup_backup() to target_dir. Return the number of restored files"""
+    s3_client = _get_s3_client(bucket_name)
+    manifest = _load_dedup_manifest(s3_client, bucket_name, _dedup_snapshot_key(snapshot_name))
+    chunks = manifest['chunks']
+    # {pack: [(path, file offset, pack offset, length)]}
+    pack_chunks = {}
+    files = []
+    for entry in manifest['entries']:
+        path = os.path.join(target_dir, entry['path'])
+        if entry['type'] == 'd':
+            if not os.path.exists(path):
+                os.makedirs(path)
+            continue
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if entry['type'] == 'l':
+            os.symlink(entry['target'], path)
+            continue
+        with open(path, 'wb') as f:
+            f.truncate(entry['size'])
+        files.append(entry)
+        offset = 0
+        for chunk_id in entry['chunks']:
+            pack_id, pack_offset, length, size = chunks[chunk_id]
+            pack_chunks.setdefault(pack_id, []).append((path, offset, pack_offset, length))
+            offset += size
+
+    for pack_id, refs in pack_chunks.items():
+        pack = _gpg_decrypt(s3_client.get_object(Bucket=bucket_name,
+                                                 Key=DEDUP_KEY_PREFIX + 'packs/' + pack_id)['Body'].read())
+        for path, offset, pack_offset, length in refs:
+            blob = pack[pack_offset:pack_offset + length]
+            data = zlib.decompress(blob[1:]) if blob[:1] == b'\x01' else blob[1:]
+            with open(path, 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+
+    for entry in reversed(manifest['entries']):
+        if entry['type'] != 'l':
+            path = os.path.join(target_dir, entry['path'])
+            os.chmod(path, entry['mode'])
+            os.utime(path, (entry['mtime'], entry['mtime']))
+    return len(files)
+
+
+def _upload_archive(archive_path, bucket_name, phases=None, sha256=None):
+    """Upload archive_path to S3 unless it is already there. Return the status for the backup report
+
+    sha256 (hex) of the archive if known is compared with the one of the stored object instead of the size.
+    The records of the existence check and upload phases are appended to phases if given.
+    """
+    phases = [] if phases is None else phases
+    size = os.path.getsize(archive_path)
+    start = time.monotonic()
+    exists = _is_file_exist_on_s3(archive_path, bucket_name, sha256)
+    phases.append(_make_phase('s3_check', start))
+    if not exists:
+        description = 'Uploading {} ({}) to S3...'.format(archive_path, _pretty_filesize(archive_path))
+        start = time.monotonic()
+        _upload_to_s3(archive_path, bucket_name, sha256=sha256)
+        warning = _record_latest_upload(bucket_name, os.path.basename(archive_path), size, sha256)
+        phases.append(_make_phase('upload', start, bytes_in=size))
+        return description + 'done.' + warning
+    return 'The file {} with size {} already exists at to S3, skip upload\n'.format(
+        archive_path, _pretty_filesize(archive_path))
+
+
+def _sync_files(file_paths, bucket_name, phases=None, max_concurrency=None):
+    """Upload in parallel the files not yet in S3. Return the status for the backup report
+
+    The bucket is listed once instead of checking the files one by one.
+    The records of the listing and upload phases are appended to phases if given.
+    """
+    phases = [] if phases is None else phases
+    start = time.monotonic()
+    key_prefix = os.path.commonprefix([os.path.basename(path) for path in file_paths])
+    stored_sizes = dict((obj['Key'], obj['Size']) for obj in _list_s3_keys(bucket_name, key_prefix))
+    sizes = dict((path, os.path.getsize(path)) for path in file_paths)
+    missing = [path for path in file_paths if stored_sizes.get(os.path.basename(path)) != sizes[path]]
+    phases.append(_make_phase('s3_check', start))
+    if not missing:
+        return 'All {} file(s) already exist at S3, skip upload\n'.format(len(file_paths))
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency or SYNC_MAX_CONCURRENCY) as executor:
+        for _ in executor.map(lambda path: _upload_to_s3(path, bucket_name), missing):
+            pass
+    warning = _record_latest_uploads(bucket_name, dict((os.path.basename(path), sizes[path]) for path in missing))
+    size = sum(sizes[path] for path in missing)
+    phases.append(_make_phase('upload', start, bytes_in=size))
+    return 'Uploaded {} of {} file(s) ({}) to S3: {}...done.{}'.format(
+        len(missing), len(file_paths), _pretty_size(size), ', '.join(os.path.basename(path) for path in missing),
+        warning)
+
+
+def _mirror_to_s3(archive_path, bucket_name, index_path=None, sha256=None):
+    _upload_archive(archive_path, bucket_name, sha256=sha256)
+    if index_path:
+        _upload_to_s3(index_path, bucket_name)
+
+
+def _mirror_to_dir(file_paths, mirror_dir):
+    """Copy the files missing from mirror_dir there"""
+    if not os.path.exists(mirror_dir):
+        os.makedirs(mirror_dir)
+    for path in file_paths:
+        mirror_path = os.path.join(mirror_dir, os.path.basename(path))
+        if not os.path.exists(mirror_path) or os.path.getsize(mirror_path) != os.path.getsize(path):
+            shutil.copyfile(path, mirror_path + '.part')
+            os.replace(mirror_path + '.part', mirror_path)
+
+
+def _start_mirroring(executor, job, archived):
+    """Start copying what _job_archive_stage() has made to the mirrors of the job. Return {mirror: future}"""
+    futures = {}
+    if archived.get('sync_paths'):
+        for bucket_name in job['mirror_buckets']:
+            futures['s3://' + bucket_name] = executor.submit(_sync_files, archived['sync_paths'], bucket_name)
+        if job['mirror_dir']:
+            futures[job['mirror_dir']] = executor.submit(_mirror_to_dir, archived['sync_paths'], job['mirror_dir'])
+    elif archived['upload_path']:
+        s3_key_name = os.path.basename(archived['upload_path'])
+        for bucket_name in job['mirror_buckets']:
+            futures['s3://{}/{}'.format(bucket_name, s3_key_name)] = executor.submit(
+                _mirror_to_s3, archived['upload_path'], bucket_name, archived.get('index_path'), archived.get('sha256'))
+        if job['mirror_dir']:
+            futures[os.path.join(job['mirror_dir'], s3_key_name)] = executor.submit(
+                _mirror_to_dir, [path for path in (archived['upload_path'], archived.get('index_path')) if path],
+                job['mirror_dir'])
+    return futures
+
+
+class SvnBackupType:
+    REPO = 1
+    WORKING_COPY = 2
+
+
+class SvnIncrementalMode:
+    # full hotcopy every time
+    NONE = 0
+    # dump of the revisions committed since the last backup
+    DUMP = 1
+    # incremental hotcopy to a persistent staging dir, the whole hotcopy is archived
+    HOTCOPY = 2
+
+
+class Encryption:
+    """Encryption of the tar based archives, see ARCHIVE_ENCRYPTION"""
+    GPG = 'gpg'
+    AES_GCM = 'aes-gcm'
+
+
+class Codec:
+    """Compression codecs of the archives, see ARCHIVE_CODEC"""
+    SEVEN_ZIP = '7z'
+    ZSTD = 'zstd'
+    XZ = 'xz'
+    STORE = 'store'
+
+
+class BackupKind:
+    """Kinds of backup jobs run by run_backup_jobs(), one per backup_* function"""
+    DIR = 'dir'
+    LAMP = 'lamp'
+    SVN_REPO = 'svn_repo'
+    SVN_WC = 'svn_wc'
+    GIT_REPO = 'git_repo'
+    TRAC = 'trac'
+    LATEST = 'latest'
+    MYSQL = 'mysql'
+
+
+def _make_job(kind, hint, source, archive_path, bucket_name, log_file, **options):
+    """Return the backup job description.
+
+    source is the directory, MySQL db name, svn repo url, svn working copy, git clone url, trac dir
+    or file mask for BackupKind.LATEST depending on kind. archive_path is not used by BackupKind.LATEST.
+    """
+    job = {'kind': kind, 'hint': hint, 'source': source, 'archive_path': archive_path,
+           'bucket_name': bucket_name, 'log_file': log_file,
+           'stream_to_s3': False, 'keep_local_copy': True, 'dedup': False, 'incremental': False,
+           'mysql_dump_threads': None, 'index': False, 'retention_policy': None, 'retention_prefix': None,
+           'codec': None, 'compression_level': None, 'skip_unchanged': False, 'sync': False,
+           'mirror_buckets': [], 'mirror_dir': None}
+    for name in options:
+        if name not in job:
+            raise Exception("Unsupported backup job option {}".format(name))
+    job.update(options)
+    return job
+
+
+# The dump step of each kind of backup job prepares the directory to archive, staging data in temp_dir if needed
+def _dump_dir(job, temp_dir):
+    # the preflight of the archive stage has walked the source already
+    src_bytes = job.get('source_bytes')
+    return {"ret": True, "src_dir": job['source'],
+            "src_bytes": _dir_size(job['source']) if src_bytes is None else src_bytes}
+
+
+# Directories backed up by backup_lamp() and their names in the archive
+_LAMP_SOURCES = [('/var/www/html/', 'var.www.html'),
+                 ('/etc/apache2/', 'etc.apache2'),
+                 ('/etc/mysql/', 'etc.mysql'),
+                 ('/var/log/apache2/', 'var.log.apache2')]
+
+
+def _lamp_stages_dump(job):
+    """Return whether the mysqldump of the LAMP job is staged on disk rather than piped into the 7z archive"""
+    return bool(job['mysql_dump_threads'] or job['stream_to_s3'] or job['dedup'] or job['index'] or
+                (job['codec'] or ARCHIVE_CODEC) != Codec.SEVEN_ZIP)
+
+
+def _dump_lamp(job, temp_dir):
+    # The archiver reads the sources in place through symlinks named as the directories in the archive
+    for src, name in _LAMP_SOURCES:
+        if not os.path.isdir(src):
+            raise Exception("{} does not exist".format(src))
+        os.symlink(src, os.path.join(temp_dir, name))
+    # the preflight of the archive stage has walked the directories already
+    src_bytes = job.get('source_bytes')
+    if src_bytes is None:
+        src_bytes = sum(_dir_size(src) for src, _ in _LAMP_SOURCES)
+    db_name = job['source']
+    start = time.monotonic()
+    if job['mysql_dump_threads']:
+        dump_dir = os.path.join(temp_dir, db_name)
+        ret = _mysql_parallel_backup(db_name, dump_dir, job['mysql_dump_threads'])
+        dump_size = _dir_size(dump_dir) if ret['ret'] else None
+        src_bytes += dump_size or 0
+    elif _lamp_stages_dump(job):
+        # tar needs the size of each member upfront, so here the dump is staged on disk
+        dump_path = os.path.join(temp_dir, db_name + '.sql')
+        ret = _mysql_db_backup(db_name, dump_path, job['log_file'])
+        dump_size = os.path.getsize(dump_path) if ret['ret'] else None
+        src_bytes += dump_size or 0
+    else:
+        # the directories are added to the archive started by the dump
+        if os.path.exists(job['archive_path']):
+            os.remove(job['archive_path'])
+        ret = _mysql_db_backup_to_archive(db_name, job['archive_path'], job['compression_level'])
+        dump_size = ret.pop('size')
+    ret['phases'] = [_make_phase('mysqldump', start, bytes_out=dump_size)]
+    ret['src_dir'] = temp_dir
+    ret['src_bytes'] = src_bytes
+    ret['follow_symlinks'] = True
+    return ret
+
+
+def _dump_mysql(job, temp_dir):
+    db_name = job['source']
+    state_path = os.path.join(MYSQL_STATE_DIR, db_name + '.json')
+    state = _load_json_file(state_path) if job['incremental'] else None
+    if state and state.get('binlog') and \
+            time.time() - state['full_backup_time'] < MYSQL_FULL_BACKUP_INTERVAL_DAYS * 24 * 3600:
+        binlog_dir = os.path.join(temp_dir, 'binlog')
+        os.makedirs(binlog_dir)
+        _write_log(job['log_file'], "Backing up MySQL binary logs from {} position {}".format(*state['binlog']))
+        ret = _mysql_binlog_backup(state['binlog'][0], binlog_dir)
+        if ret['binlog'] is not None:
+            # replay with 'mysqlbinlog --start-position=<position> --database=<db> <files> | mysql'
+            _save_json_file(os.path.join(binlog_dir, 'binlog.json'),
+                            {'database': db_name, 'start_file': state['binlog'][0], 'start_position': state['binlog'][1]})
+            ret['src_dir'] = binlog_dir
+            ret['state'] = {state_path: dict(state, binlog=ret['binlog'])}
+            ret['state'].update(_chain_state(job, full=False))
+            return ret
+        _write_log(job['log_file'], ret['description'] + " Falling back to a full backup.")
+        shutil.rmtree(binlog_dir, ignore_errors=True)
+
+    dump_dir = os.path.join(temp_dir, db_name)
+    _write_log(job['log_file'], "Backing up MySQL database {} with {} threads".format(
+               db_name, job['mysql_dump_threads'] or MYSQL_DUMP_THREADS))
+    ret = _mysql_parallel_backup(db_name, dump_dir, job['mysql_dump_threads'])
+    ret['src_dir'] = dump_dir
+    if job['incremental']:
+        if ret['ret'] and ret['binlog'] is None:
+            ret['ret'] = False
+            ret['description'] += " Incremental backups need binary logging enabled."
+        ret['state'] = {state_path: {'full_backup_time': time.time(), 'binlog': ret['binlog']}}
+        ret['state'].update(_chain_state(job, full=True))
+    return ret
+
+
+def _dump_svn_repo(job, temp_dir):
+    svn_dir = job['source']
+    if not job['incremental']:
+        _write_log(job['log_file'], "Backing up svn repo at " + svn_dir)
+        ret = _svn_backup(svn_dir, temp_dir, log_file=job['log_file'])
+        ret['src_dir'] = temp_dir
+        return ret
+
+    state_path = os.path.join(SVN_STAGING_DIR, _svn_state_name(svn_dir) + '.json')
+    youngest = _svn_youngest(svn_dir)
+    last_youngest = (_load_json_file(state_path) or {}).get('youngest')
+    if last_youngest is not None and last_youngest > youngest:
+        # the repo has been replaced since
+        last_youngest = None
+    if last_youngest == youngest:
+        return {"ret": True,
+                "skip": "No new revisions in {} since r{}, skip backup\n".format(svn_dir, youngest)}
+    if job['incremental'] == SvnIncrementalMode.HOTCOPY:
+        staging_dir = os.path.join(SVN_STAGING_DIR, _svn_state_name(svn_dir))
+        if not os.path.exists(SVN_STAGING_DIR):
+            os.makedirs(SVN_STAGING_DIR)
+        _write_log(job['log_file'], "Incrementally backing up svn repo at {} to {}".format(svn_dir, staging_dir))
+        ret = _svn_backup(svn_dir, staging_dir, incremental=True, log_file=job['log_file'])
+        if not ret['ret']:
+            # start from scratch next time rather than trust a half-done hotcopy
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        ret['src_dir'] = staging_dir
+    else:
+        full = last_youngest is None or _is_full_backup_due(job, SVN_FULL_DUMP_INTERVAL_DAYS)
+        start_rev = 0 if full else last_youngest + 1
+        _write_log(job['log_file'], "Dumping revisions {}:{} of svn repo at {}".format(start_rev, youngest, svn_dir))
+        ret = _svn_dump(svn_dir, os.path.join(temp_dir, 'svn_repo.r{}-{}.dump'.format(start_rev, youngest)),
+                        start_rev, youngest, job['log_file'])
+        ret['src_dir'] = temp_dir
+    ret['state'] = {state_path: {'youngest': youngest}}
+    if job['incremental'] == SvnIncrementalMode.DUMP:
+        ret['state'].update(_chain_state(job, full))
+    return ret
+
+
+def _dump_svn_wc(job, temp_dir):
+    _write_log(job['log_file'], "Updating " + job['source'])
+    ret = _svn_update(job['source'], job['log_file'])
+    ret['src_dir'] = job['source']
+    return ret
+
+
+def _dump_git_repo(job, temp_dir):
+    _write_log(job['log_file'], "Backing up git repo at " + job['source'])
+    # the first incremental backup is a full one, so is one every GIT_FULL_BACKUP_INTERVAL_DAYS days
+    incremental = job['incremental'] and os.path.exists(_git_refs_state_path(job['source'])) and \
+        not _is_full_backup_due(job, GIT_FULL_BACKUP_INTERVAL_DAYS)
+    bundle_name = 'git_repo.incremental.bundle' if incremental else 'git_repo.bundle'
+    ret = _git_backup(job['source'], os.path.join(temp_dir, bundle_name), incremental,
+                      job.get('git_mirror_refreshed', False), job['log_file'])
+    ret['src_dir'] = temp_dir
+    if 'refs' in ret:
+        ret['state'] = {_git_refs_state_path(job['source']): ret.pop('refs')}
+        if job['incremental'] and 'skip' not in ret:
+            ret['state'].update(_chain_state(job, full=not incremental))
+    return ret
+
+
+def _dump_trac(job, temp_dir):
+    _write_log(job['log_file'], "Backing up TRAC at " + job['source'])
+    trac_backup_dir = os.path.join(temp_dir, 'trac')
+    ret = _trac_backup(job['source'], trac_backup_dir, job['log_file'])
+    ret['src_dir'] = trac_backup_dir
+    return ret
+
+
+_JOB_DUMPERS = {
+    BackupKind.DIR: _dump_dir,
+    BackupKind.LAMP: _dump_lamp,
+    BackupKind.SVN_REPO: _dump_svn_repo,
+    BackupKind.SVN_WC: _dump_svn_wc,
+    BackupKind.GIT_REPO: _dump_git_repo,
+    BackupKind.TRAC: _dump_trac,
+    BackupKind.MYSQL: _dump_mysql,
+}
+
+
+def _job_state_name(job):
+    name = json.dumps([job['kind'], job['source'], job['bucket_name'], os.path.dirname(job['archive_path'])])
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+
+def _fingerprint_state_path(job):
+    """Path of the fingerprint of the job source as of its last successful backup"""
+    return os.path.join(FINGERPRINT_DIR, _job_state_name(job) + '.json')
+
+
+def _source_fingerprint(job):
+    """Return the fingerprint of the job source, or None when its kind does not support skip_unchanged,
+    and the size of the source if the fingerprint has walked it"""
+    if job['kind'] in (BackupKind.DIR, BackupKind.TRAC):
+        return _dir_fingerprint(job['source'])
+    if job['kind'] == BackupKind.SVN_WC:
+        fingerprint, size = _dir_fingerprint(job['source'])
+        return '{}:{}'.format(_svn_head_revision(job['source']), fingerprint), size
+    if job['kind'] == BackupKind.GIT_REPO:
+        refs = _git_remote_refs(job['source'])
+        return hashlib.sha256(json.dumps(refs, sort_keys=True).encode('utf-8')).hexdigest(), None
+    return None, None
+
+
+def _last_fingerprint(job):
+    return (_load_json_file(_fingerprint_state_path(job)) or {}).get('fingerprint')
+
+
+def _incremental_state_path(job):
+    """Path of the chain of incremental archives of the job:
+    {'full_backup_time', 'base': name of the last full archive, 'bases': {archive name: name of its full archive}}"""
+    return os.path.join(INCREMENTAL_STATE_DIR, _job_state_name(job) + '.json')
+
+
+def _is_full_backup_due(job, interval_days):
+    state = _load_json_file(_incremental_state_path(job)) or {}
+    return time.time() - state.get('full_backup_time', 0) >= interval_days * 24 * 3600
+
+
+def _chain_state(job, full):
+    """Return the state adding the archive of the job to its chain, to save once the backup succeeds"""
+    path = _incremental_state_path(job)
+    state = _load_json_file(path) or {'bases': {}}
+    name = os.path.basename(job['archive_path'])
+    if full:
+        state['full_backup_time'] = time.time()
+        state['base'] = name
+    # the chains of the jobs backed up before their chains were recorded start unknown
+    state['bases'][name] = state.get('base')
+    return {path: state}
+
+
+def _forget_chain_archives(job, names):
+    """Drop the archives deleted by the retention from the chain of the job"""
+    path = _incremental_state_path(job)
+    state = _load_json_file(path)
+    if state and any(name in state['bases'] for name in names):
+        for name in names:
+            state['bases'].pop(name, None)
+        _save_json_file(path, state)
+
+
+def _incremental_bases():
+    """Return {archive name: name of the full archive it builds on} of all the incremental jobs"""
+    bases = {}
+    if os.path.isdir(INCREMENTAL_STATE_DIR):
+        for name in os.listdir(INCREMENTAL_STATE_DIR):
+            if name.endswith('.json'):
+                bases.update((_load_json_file(os.path.join(INCREMENTAL_STATE_DIR, name)) or {}).get('bases', {}))
+    return bases
+
+
+def _job_fetch_stage(job):
+    """Refresh the git mirror of a job ahead of its archive stage, unless skip_unchanged and the repo is unchanged.
+
+    Return the job to pass to _job_archive_stage().
+    """
+    if job['skip_unchanged']:
+        job = dict(job, fingerprint=_source_fingerprint(job)[0])
+        if job['fingerprint'] == _last_fingerprint(job):
+            return job
+    if _git_refresh_mirror(job['source'], job['log_file'])['ret']:
+        job = dict(job, git_mirror_refreshed=True)
+    # otherwise the archive stage retries the fetch and reports its failure
+    return job
+
+
+def _staging_state_path(job):
+    """Path of the sizes of the source, dump and archive of the last successful backup of the job"""
+    return os.path.join(STAGING_STATE_DIR, _job_state_name(job) + '.json')
+
+
+def _staging_source_size(job):
+    """Return the size of the data the job dumps or None if it cannot be told without dumping"""
+    if job['kind'] in (BackupKind.DIR, BackupKind.SVN_REPO, BackupKind.SVN_WC, BackupKind.TRAC):
+        return _dir_size(job['source'])
+    if job['kind'] == BackupKind.LAMP:
+        return sum(_dir_size(src) for src, _ in _LAMP_SOURCES)
+    if job['kind'] == BackupKind.GIT_REPO and os.path.isdir(_git_mirror_dir(job['source'])):
+        return _dir_size(_git_mirror_dir(job['source']))
+    return None
+
+
+def _staging_estimate(job):
+    """Return the source size, the bytes the job is expected to stage and to write as a local archive
+    and whether the estimate is a guess rather than based on the sizes recorded by the previous backups.
+
+    The source size is the one told by the fingerprint of the source if any. Otherwise the source is walked
+    on the first backup of the job only, or when the dump reuses the size (directories and LAMP jobs).
+    The sizes of the previous backup are scaled by how much the source has grown since if the source size
+    is known, with no previous backup the dump is taken as big as the source and the archive
+    as STAGING_GUESS_ARCHIVE_RATIO of the dump. LAMP jobs stage only the mysqldump, which is not told
+    by the size of the directories. The staged bytes are None when there is nothing to estimate them from.
+    """
+    dumps_in_place = job['kind'] in (BackupKind.DIR, BackupKind.SVN_WC) or \
+        (job['kind'] == BackupKind.SVN_REPO and job['incremental'] == SvnIncrementalMode.HOTCOPY)
+    keeps_archive = not job['dedup'] and (job['keep_local_copy'] or not job['stream_to_s3'])
+    source_bytes = job.get('source_bytes')
+    if dumps_in_place and not keeps_archive:
+        return source_bytes, 0, 0, False
+    last = _load_json_file(_staging_state_path(job)) or {}
+    if source_bytes is None and (not last or job['kind'] in (BackupKind.DIR, BackupKind.LAMP)):
+        source_bytes = _staging_source_size(job)
+    guessed = []
+
+    def scale(name, default):
+        if last.get(name) is None:
+            guessed.append(name)
+            return default
+        if source_bytes is not None and last.get('source_bytes'):
+            return int(last[name] * source_bytes / last['source_bytes'])
+        return last[name]
+
+    staged_bytes = 0
+    archive_default = None
+    if job['kind'] == BackupKind.LAMP:
+        if _lamp_stages_dump(job):
+            staged_bytes = last.get('staged_bytes')
+        archive_default = (source_bytes or 0) + (staged_bytes or 0)
+    elif not dumps_in_place:
+        staged_bytes = scale('staged_bytes', source_bytes)
+    if staged_bytes is not None:
+        staged_bytes = int(staged_bytes * STAGING_ESTIMATE_MARGIN)
+    archive_bytes = 0
+    if keeps_archive:
+        if archive_default is None:
+            archive_default = staged_bytes or source_bytes or 0
+        archive_default = int(archive_default * STAGING_GUESS_ARCHIVE_RATIO)
+        archive_bytes = int(scale('archive_bytes', archive_default) * STAGING_ESTIMATE_MARGIN)
+    return source_bytes, staged_bytes, archive_bytes, bool(guessed)
+
+
+def _open_staging_ledger():
+    """Open the reservations of staging space shared by the backups running on the host"""
+    if not os.path.exists(STAGING_STATE_DIR):
+        os.makedirs(STAGING_STATE_DIR)
+    ledger = sqlite3.connect(os.path.join(STAGING_STATE_DIR, 'staging.sqlite'), timeout=600, isolation_level=None)
+    # path is where the reserved bytes go and baseline its size when reserved
+    ledger.execute('CREATE TABLE IF NOT EXISTS reservations (id INTEGER PRIMARY KEY, device INTEGER, bytes INTEGER, '
+                   'pid INTEGER, path TEXT, baseline INTEGER)')
+    return ledger
+
+
+def _written_size(path):
+    """Return the size of the staging dir or of the archive file (with its .part) a reservation is for"""
+    if os.path.isdir(path):
+        return _dir_size(path, follow_symlinks=False)
+    size = 0
+    for name in (path, path + '.part'):
+        try:
+            size += os.stat(name).st_size
+        except OSError:
+            pass
+    return size
+
+
+def _measure_reservations(ledger):
+    """Return {reservation id: _written_size() of its path}. Walks the staging dirs, so call it outside transactions"""
+    return {reservation_id: _written_size(path)
+            for reservation_id, path in ledger.execute('SELECT id, path FROM reservations').fetchall()}
+
+
+def _outstanding_reservations(ledger, written):
+    """Return the reserved bytes not written yet by device, the written ones are already gone from free space.
+    written is from _measure_reservations(), the reservations made since are taken as not written at all.
+    """
+    outstanding = collections.Counter()
+    for reservation_id, device, size, baseline in ledger.execute('SELECT id, device, bytes, baseline '
+                                                                 'FROM reservations'):
+        outstanding[device] += max(0, size - max(0, written.get(reservation_id, baseline) - baseline))
+    return outstanding
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _existing_dir(path):
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def _reserve_staging(job, staged_bytes, archive_bytes, guessed=False):
+    """Pick the first of STAGING_DIRS with room for staged_bytes and reserve them there and archive_bytes
+    next to the archive of the job. Dumps of unknown size are staged in the last of STAGING_DIRS.
+
+    Wait up to STAGING_WAIT_TIMEOUT seconds when other backups hold the space. When the space would not do
+    anyway fail, unless the sizes are guessed: then log a warning and stage in the last of STAGING_DIRS
+    without reserving anything.
+    Return a new temp dir in the staging dir and the reservation ids to pass to _release_staging().
+    """
+    candidates = STAGING_DIRS or [(tempfile.gettempdir(), None)]
+    if staged_bytes is None:
+        candidates = [(candidates[-1][0], None)]
+        staged_bytes = 0
+    archive_dir = _existing_dir(os.path.abspath(os.path.dirname(job['archive_path'])))
+    deadline = time.monotonic() + STAGING_WAIT_TIMEOUT
+    ledger = _open_staging_ledger()
+    try:
+        while True:
+            # reservations of crashed backups
+            for pid, in ledger.execute('SELECT DISTINCT pid FROM reservations').fetchall():
+                if not _is_process_alive(pid):
+                    ledger.execute('DELETE FROM reservations WHERE pid = ?', (pid,))
+            # measure the disks before locking the ledger, the lock is held only to read and write it
+            written = _measure_reservations(ledger)
+            archive_baseline = _written_size(job['archive_path'])
+            fitting = []
+            for staging_dir, max_bytes in candidates:
+                if max_bytes is not None and staged_bytes > max_bytes:
+                    continue
+                if not os.path.exists(staging_dir):
+                    os.makedirs(staging_dir)
+                wanted = collections.Counter()
+                staging_device = os.stat(staging_dir).st_dev
+                archive_device = os.stat(archive_dir).st_dev
+                wanted[staging_device] += staged_bytes
+                wanted[archive_device] += archive_bytes
+                free = {staging_device: shutil.disk_usage(staging_dir).free,
+                        archive_device: shutil.disk_usage(archive_dir).free}
+                if all(free[device] >= size for device, size in wanted.items()):
+                    fitting.append((staging_dir, staging_device, archive_device, wanted, free))
+            fits = bool(fitting)
+            ledger.execute('BEGIN IMMEDIATE')
+            try:
+                reserved = _outstanding_reservations(ledger, written)
+                for staging_dir, staging_device, archive_device, wanted, free in fitting:
+                    if all(free[device] - reserved[device] >= size for device, size in wanted.items()):
+                        # a new temp dir has nothing written yet
+                        temp_dir = tempfile.mkdtemp(dir=staging_dir)
+                        ids = [ledger.execute('INSERT INTO reservations (device, bytes, pid, path, baseline) '
+                                              'VALUES (?, ?, ?, ?, ?)',
+                                              (device, size, os.getpid(), path, baseline)).lastrowid
+                               for device, size, path, baseline in (
+                                   (staging_device, staged_bytes, temp_dir, 0),
+                                   (archive_device, archive_bytes, job['archive_path'], archive_baseline))
+                               if size]
+                        ledger.execute('COMMIT')
+                        return temp_dir, ids
+                ledger.execute('COMMIT')
+            except BaseException:
+                ledger.execute('ROLLBACK')
+                raise
+            if not fits and guessed:
+                _write_log(job['log_file'], 'Warning: there might be not enough disk space to stage {} and to write '
+                           '{} to {}, these sizes are guessed with no previous backup to tell them'.format(
+                               _pretty_size(staged_bytes), _pretty_size(archive_bytes), archive_dir))
+                staging_dir = candidates[-1][0]
+                if not os.path.exists(staging_dir):
+                    os.makedirs(staging_dir)
+                return tempfile.mkdtemp(dir=staging_dir), []
+            if not fits:
+                raise Exception('Not enough disk space to stage {} and to write {} to {}'.format(
+                    _pretty_size(staged_bytes), _pretty_size(archive_bytes), archive_dir))
+            if time.monotonic() >= deadline:
+                raise Exception('The disk space to stage {} and to write {} to {} is still reserved by other backups '
+                                'after waiting {} sec.'.format(_pretty_size(staged_bytes), _pretty_size(archive_bytes),
+                                                               archive_dir, STAGING_WAIT_TIMEOUT))
+            time.sleep(min(5, max(0, deadline - time.monotonic())))
+    finally:
+        ledger.close()
+
+
+def _release_staging(reservation_ids):
+    ledger = _open_staging_ledger()
+    try:
+        ledger.executemany('DELETE FROM reservations WHERE id = ?',
+                           [(reservation_id,) for reservation_id in reservation_ids])
+    finally:
+        ledger.close()
+
+
+# Names of the dump phase by the kind of backup job
+_DUMP_PHASE_NAMES = {BackupKind.SVN_REPO: 'hotcopy',
+                     BackupKind.SVN_WC: 'update',
+                     BackupKind.GIT_REPO: 'clone',
+                     BackupKind.TRAC: 'hotcopy'}
+
+
+def _job_archive_stage(job):
+    """Dump and archive a backup job. Runs in a worker process when called from run_backup_jobs().
+
+    Return {"ret": bool, "description": status so far, "start": when the job started,
+            "upload_path": file to upload to S3 or None when there is nothing left to upload,
+            "index_path": index of the indexed archive to upload next to it if any,
+            "sync_paths": files to sync to S3 instead of upload_path if any,
+            "sha256": SHA-256 of the archive as hex if computed while making it,
+            "mirrors": {mirror: error message or None} of the mirrors the archive has been streamed to,
+            "state": {path: data} JSON state files to save when the backup succeeds,
+            "phases": records of the finished phases, see _make_phase()}
+    """
+    log_file = job['log_file']
+    result = {"ret": False, "description": '', "start": datetime.datetime.today(), "upload_path": None,
+              "state": {}, "phases": []}
     _write_log(log_file, 'Starting backup')
-    temp_backup_dir = None
-    try:
-        _write_log(log_file, "Backing up TRAC at " + trac_dir)
-        temp_backup_dir = tempfile.mkdtemp() + "/trac"
-        ret = _trac_backup(trac_dir, temp_backup_dir)
-        _write_log(log_file, '{}\nStdOut: {}\nStdErr: {}\n'.format(
-                   ret['description'], ret['stdout'], ret['stderr']))
-        if ret['ret']:
-            _write_log(log_file, "Archiving {} to {}".format(temp_backup_dir, archive_path))
-            ret = _archive(temp_backup_dir, archive_path)
-            _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
-            if ret['ret']:
-                if not _is_file_exist_on_s3(archive_path, bucket_name):
-                    status_detailed = 'Uploading {} ({}) to S3...'.format(
-                        archive_path, _pretty_filesize(archive_path))
-                    _upload_to_s3(archive_path, bucket_name)
-                    status_detailed += 'done.'
+    temp_dir = None
+    reservations = []
+    try:
+        fingerprint = None
+        if job['skip_unchanged'] and job['kind'] != BackupKind.LATEST:
+            # run_backup_jobs() fingerprints git repos before fetching them
+            fingerprint = job.get('fingerprint')
+            if fingerprint is None:
+                start = time.monotonic()
+                fingerprint, source_bytes = _source_fingerprint(job)
+                result['phases'].append(_make_phase('fingerprint', start, bytes_in=source_bytes))
+                # the preflight reuses the size of the walked source
+                job = dict(job, source_bytes=source_bytes)
+        if job['kind'] == BackupKind.LATEST:
+            files = glob.glob(job['source'])
+            if files and job['sync']:
+                result['sync_paths'] = sorted(files)
+            elif files:
+                result['upload_path'] = max(files, key=lambda filename: os.stat(filename).st_mtime)
+            else:
+                result['description'] = 'Nothing to backup in ' + job['source']
+            result['ret'] = True
+        elif fingerprint is not None and fingerprint == _last_fingerprint(job):
+            result['description'] = 'Nothing has changed in {} since the last backup, skip backup\n'.format(
+                job['source'])
+            result['ret'] = True
+        else:
+            start = time.monotonic()
+            source_bytes, staged_bytes, archive_bytes, guessed = _staging_estimate(job)
+            temp_dir, reservations = _reserve_staging(job, staged_bytes, archive_bytes, guessed)
+            _write_log(log_file, 'Staging in {}, reserved {} for the dump and {} for the archive'.format(
+                       temp_dir, _pretty_size(staged_bytes or 0), _pretty_size(archive_bytes)))
+            result['phases'].append(_make_phase('preflight', start, bytes_in=source_bytes))
+            job = dict(job, source_bytes=source_bytes)
+            start = time.monotonic()
+            ret = _JOB_DUMPERS[job['kind']](job, temp_dir)
+            if 'phases' in ret:
+                result['phases'] += ret['phases']
+            elif job['kind'] != BackupKind.DIR:
+                if ret['ret'] and ret.get('src_dir', '').startswith(temp_dir) and 'src_bytes' not in ret:
+                    ret['src_bytes'] = _dir_size(ret['src_dir'])
+                phase_name = _DUMP_PHASE_NAMES.get(job['kind'], 'dump')
+                if job['kind'] == BackupKind.SVN_REPO and job['incremental'] == SvnIncrementalMode.DUMP:
+                    phase_name = 'dump'
+                result['phases'].append(_make_phase(phase_name, start, bytes_out=ret.get('src_bytes')))
+            _flush_log(log_file)
+            if 'description' in ret:
+                _write_log(log_file, '{}\nStdOut: {}\nStdErr: {}\n'.format(
+                           ret['description'], ret['stdout'], ret['stderr']))
+            result['state'] = ret.get('state', {})
+            if fingerprint is not None and ret['ret']:
+                if job['kind'] == BackupKind.SVN_WC:
+                    # updating the working copy has changed it
+                    fingerprint = _source_fingerprint(job)[0]
+                result['state'][_fingerprint_state_path(job)] = {'fingerprint': fingerprint}
+            if ret['ret'] and 'skip' not in ret:
+                # the sizes the next estimate is based on
+                sizes = {'source_bytes': source_bytes, 'staged_bytes': _dir_size(temp_dir, follow_symlinks=False)}
+                result['state'][_staging_state_path(job)] = sizes
+            if ret['ret'] and 'skip' in ret:
+                result['description'] = ret['skip']
+                result['ret'] = True
+            elif ret['ret']:
+                src_dir = ret['src_dir']
+                src_bytes = ret.get('src_bytes')
+                follow_symlinks = ret.get('follow_symlinks', False)
+                archive_path = job['archive_path']
+                start = time.monotonic()
+                if job['dedup']:
+                    snapshot_name = os.path.splitext(os.path.basename(archive_path))[0]
+                    _write_log(log_file, "Deduplicating {} to S3 bucket {} as snapshot {}".format(
+                               src_dir, job['bucket_name'], snapshot_name))
+                    ret = _dedup_backup(src_dir, snapshot_name, job['bucket_name'], log_file, follow_symlinks)
+                    _write_log(log_file, ret['description'])
+                    result['description'] = ret['description']
+                    result['phases'].append(_make_phase('dedup', start, src_bytes, ret.get('size')))
+                elif job['stream_to_s3']:
+                    _write_log(log_file, "Streaming {} to S3 bucket {} as {}".format(
+                               src_dir, job['bucket_name'], os.path.basename(archive_path)))
+                    stream_archive = _stream_indexed_archive_to_s3 if job['index'] else _stream_archive_to_s3
+                    ret = stream_archive(src_dir, archive_path, job['bucket_name'], job['keep_local_copy'],
+                                         follow_symlinks, job['codec'], job['compression_level'],
+                                         job['mirror_buckets'], job['mirror_dir'])
+                    result['mirrors'] = ret.get('mirrors', {})
+                    _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
+                    if ret['ret']:
+                        if job['keep_local_copy']:
+                            sizes['archive_bytes'] = ret['size']
+                        result['description'] = 'Streamed {} ({} bytes) to S3...done.{}'.format(
+                            os.path.basename(archive_path), ret['size'], ret['warning'])
+                        result['phases'].append(_make_phase('stream', start, src_bytes, ret['size']))
+                    else:
+                        result['description'] = ret['description']
                 else:
-                    status_detailed = 'The file {} with size {} already exists at to S3, skip upload\n'.format(
-                        backup_filepath, _pretty_filesize(archive_path))
-                backup_ok = True
+                    _write_log(log_file, "Archiving {} to {}".format(src_dir, archive_path))
+                    ret = (_indexed_archive if job['index'] else _archive)(src_dir, archive_path, follow_symlinks,
+                                                                          job['codec'], job['compression_level'])
+                    _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
+                    if ret['ret']:
+                        result['upload_path'] = archive_path
+                        result['sha256'] = ret.get('sha256')
+                        sizes['archive_bytes'] = os.path.getsize(archive_path)
+                        if job['index']:
+                            result['index_path'] = archive_path + INDEX_KEY_SUFFIX
+                        result['phases'].append(_make_phase('archive', start, src_bytes,
+                                                            os.path.getsize(archive_path)))
+                result['ret'] = ret['ret']
+    except Exception as e:
+        result['description'] += '\nError: {}. {}'.format(type(e), e)
+    except:
+        result['description'] += '\nUnknown error'
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        if reservations:
+            try:
+                _release_staging(reservations)
+            except Exception as e:
+                _write_log(log_file, 'Failed to release the staging space. {}'.format(e))
+        # the worker process running the stage may exit without flushing
+        _flush_log(log_file)
+        return result
+
+
+def _job_upload_stage(job, archived):
+    """Upload the archive made by _job_archive_stage() and clean up old archives.
+
+    Return the job status as returned by the backup_* functions:
+    {'retval', 'status_brief', 'status_detailed', 'seconds': total duration, 'phases': see _make_phase()}
+    """
+    log_file = job['log_file']
+    status_brief = '[S3 Backup] ' + job['hint']
+    status_detailed = archived['description']
+    phases = archived.get('phases', [])
+    mirrors = dict(archived.get('mirrors', {}))
+    backup_ok = False
+    try:
+        if archived['ret']:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(job['mirror_buckets']) + 1) as executor:
+                # the mirrors get their copies while the main one is uploaded
+                mirror_futures = _start_mirroring(executor, job, archived)
+                if archived['upload_path']:
+                    status_detailed += _upload_archive(archived['upload_path'], job['bucket_name'], phases,
+                                                       archived.get('sha256'))
+                    _flush_log(log_file)
+                if archived.get('index_path'):
+                    _upload_to_s3(archived['index_path'], job['bucket_name'])
+                if archived.get('sync_paths'):
+                    status_detailed += _sync_files(archived['sync_paths'], job['bucket_name'], phases)
+                    _flush_log(log_file)
+                for name, future in mirror_futures.items():
+                    try:
+                        future.result()
+                        mirrors[name] = None
+                    except Exception as e:
+                        mirrors[name] = "{} failed. {}".format(name, e)
+            for name in sorted(mirrors):
+                status_detailed += '\nMirror {}: {}'.format(name, mirrors[name] or 'OK')
+            failed = [name for name in mirrors if mirrors[name]]
+            if failed:
+                raise Exception('Failed to back up to {}'.format(', '.join(sorted(failed))))
+            backup_ok = True
     except Exception as e:
         status_detailed += '\nError: {}. {}'.format(type(e), e)
     except:
         status_detailed += '\nUnknown error'
     finally:
-        if temp_backup_dir is not None:
-            shutil.rmtree(temp_backup_dir, ignore_errors=True)
         if backup_ok:
             status_brief += ' OK'
-            ret = _cleanup_old_archines(dir=os.path.dirname(archive_path),
-                                        extension=os.path.splitext(archive_path)[1])
-            _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
+            for path, data in archived.get('state', {}).items():
+                _save_json_file(path, data)
+            if job['kind'] != BackupKind.LATEST and not job['dedup']:
+                start = time.monotonic()
+                extension = os.path.splitext(job['archive_path'])[1]
+                local_dirs = [os.path.dirname(job['archive_path'])] + ([job['mirror_dir']] if job['mirror_dir'] else [])
+                # only the archives of this job, other jobs may keep theirs in the same directory
+                archive_name = os.path.basename(job['archive_path'])
+                if job['retention_prefix'] is not None:
+                    series_args = {'prefix': os.path.basename(job['retention_prefix'])}
+                elif _archive_series(archive_name) != archive_name:
+                    series_args = {'series': _archive_series(archive_name)}
+                else:
+                    # with no timestamp the series of the archives is unknown, expire them by age like find -mtime
+                    series_args = {'prefix': re.sub(r'[0-9]+[^0-9]*$', '', os.path.splitext(archive_name)[0]),
+                                   'by_age': True}
+                    _write_log(log_file, '{} has no timestamp, the archives named alike are expired after {} days '
+                               'rather than by the retention policy'.format(archive_name, MAX_ARCHIVE_AGE_DAYS))
+                deleted = set()
+                for local_dir in local_dirs:
+                    ret = _cleanup_old_archines(dir=local_dir, extension=extension, policy=job['retention_policy'],
+                                                **series_args)
+                    _write_log(log_file, '{}\nStdErr: {}\n'.format(ret['description'], ret['stderr']))
+                    deleted.update(ret['deleted'])
+                if job['retention_prefix'] is not None:
+                    for bucket_name in [job['bucket_name']] + job['mirror_buckets']:
+                        try:
+                            keys = _cleanup_old_s3_archives(bucket_name, job['retention_prefix'], extension,
+                                                            policy=job['retention_policy'])
+                            deleted.update(keys)
+                            _write_log(log_file, 'Deleted {} expired archive(s) from S3 bucket {}: {}'.format(
+                                len(keys), bucket_name, ', '.join(keys)))
+                        except Exception as e:
+                            _write_log(log_file, 'Failed to clean up S3 bucket {}. {}'.format(bucket_name, e))
+                _forget_chain_archives(job, deleted)
+                phases.append(_make_phase('cleanup', start))
+            elif job['dedup'] and job['retention_prefix'] is not None:
+                start = time.monotonic()
+                try:
+                    snapshots, pack_count = _prune_dedup_snapshots(job['bucket_name'], job['retention_prefix'],
+                                                                   policy=job['retention_policy'])
+                    _write_log(log_file, 'Deleted {} expired snapshot(s) and {} unreferenced pack(s) from S3 bucket '
+                               '{}: {}'.format(len(snapshots), pack_count, job['bucket_name'], ', '.join(snapshots)))
+                except Exception as e:
+                    _write_log(log_file, 'Failed to clean up S3 bucket {}. {}'.format(job['bucket_name'], e))
+                phases.append(_make_phase('cleanup', start))
         else:
             status_brief += ' FAILED'
+        for phase in phases:
+            status_detailed += '\n' + _format_phase(phase)
         end = datetime.datetime.today()
-        status_detailed += '\nElapsed time: ' + _format_time_delta(end - start)
+        status_detailed += '\nElapsed time: ' + _format_time_delta(end - archived['start'])
         _write_log(log_file, status_detailed)
         _write_log(log_file, 'Backup to {} finished with status {}'.format(
-                   bucket_name, 'SUCCESS' if backup_ok else 'ERROR'))
-        return {'retval': backup_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
+                   job['bucket_name'], 'SUCCESS' if backup_ok else 'ERROR'), flush=True)
+        result = {'retval': backup_ok, 'status_brief': status_brief, 'status_detailed': status_detailed,
+                  'seconds': (end - archived['start']).total_seconds(), 'phases': phases}
+        try:
+            _export_metrics(job, result)
+        except Exception as e:
+            _write_log(log_file, 'Failed to export metrics. {}'.format(e))
+        return result
+
+
+def _run_backup_job(job):
+    return _job_upload_stage(job, _job_archive_stage(job))
+
+
+def _make_email(subject, text, sender, recipients, log_file=None):
+    """Return the mail with text and the tail of log_file attached if given"""
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+    from email.utils import formatdate
+
+    msg = MIMEMultipart()
+    if log_file:
+        attachment = MIMEText(_to_utf8(_get_log_tail(log_file)), 'plain', 'utf-8')
+        attachment.add_header('Content-Disposition', 'attachment', filename=log_file)
+        msg.attach(attachment)
+    msg.attach(MIMEText(_to_utf8(text), 'plain', 'utf-8'))
+
+    msg['Subject'] = subject
+    msg['From'] = sender
+    msg['To'] = ', '.join(recipients)
+    msg['Date'] = formatdate()
+    return msg.as_string()
+
+
+def _smtp_connect(host, port, user=None, password=None):
+    import smtplib
+    smtp = smtplib.SMTP(host, port)
+    if user and password is not None:
+        smtp.login(user, password)
+    return smtp
+
+
+def _smtp_quit(smtp):
+    try:
+        smtp.quit()
+    except Exception:
+        smtp.close()
+
+
+def _spool_email(sender, recipients, subject, mail):
+    """Keep the mail in NOTIFY_SPOOL_DIR to send it later"""
+    name = '{:020}-{}-{}.json'.format(time.time_ns(), os.getpid(), threading.get_ident())
+    _save_json_file(os.path.join(NOTIFY_SPOOL_DIR, name),
+                    {'sender': sender, 'recipients': recipients, 'subject': subject, 'mail': mail})
+
+
+def _spooled_emails():
+    """Return the paths of the spooled mails, oldest first"""
+    if not os.path.isdir(NOTIFY_SPOOL_DIR):
+        return []
+    return [os.path.join(NOTIFY_SPOOL_DIR, name) for name in sorted(os.listdir(NOTIFY_SPOOL_DIR))
+            if name.endswith('.json')]
+
+
+def _format_status_detailed(status):
+    # backups report status_detailed as text, the other operations as a list of lines
+    detailed = status['status_detailed']
+    return '\n'.join(detailed) if isinstance(detailed, list) else detailed
+
+
+
+#
+# Public API
+#
+
+def send_email(aSubj, aMsg, aSender, aRecepients, aLogFile, anSmtpSvrHost='localhost', anSmtpSvrPort=25, aUser=None, aPassword=None):
+    """Mail aMsg with the tail of aLogFile attached and wait until it is sent, see NotificationQueue to send many"""
+    mySmtpSvr = _smtp_connect(anSmtpSvrHost, anSmtpSvrPort, aUser, aPassword)
+    # mySmtpSvr.set_debuglevel(1)
+    mySmtpSvr.sendmail(aSender, aRecepients, _make_email(aSubj, aMsg, aSender, aRecepients, aLogFile))
+    mySmtpSvr.quit()
+
+
+class NotificationQueue:
+    """Mail notifications from a background thread over one SMTP connection, so that jobs do not wait for the relay.
+
+    notify() mails the status returned by a backup_* function with the tail of its log file attached.
+    With digest the statuses are collected instead and mailed in one summary by flush() or close(),
+    a line per job followed by its phase timings and the details of the failed jobs.
+    The connection is kept open while there are mails to send and NOTIFY_SMTP_IDLE_TIMEOUT seconds longer.
+    A mail is tried NOTIFY_MAX_ATTEMPTS times backing off between the attempts, see NOTIFY_RETRY_BACKOFF.
+    Mails that cannot be sent are logged to log_file, reported by close() and spooled to NOTIFY_SPOOL_DIR.
+    The spooled mails, of this queue or of previous ones, are sent when the queue starts and after each mail
+    that gets through.
+    """
+
+    def __init__(self, sender, recipients, log_file, smtp_host='localhost', smtp_port=25, user=None, password=None,
+                 digest=False, digest_subject='[S3 Backup] Backup digest'):
+        self._sender = sender
+        self._recipients = recipients
+        self._log_file = log_file
+        self._smtp_args = (smtp_host, smtp_port, user, password)
+        self._digest_subject = digest_subject
+        self._digest = [] if digest else None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._queued = 0
+        self._sent = 0
+        self._resent = 0
+        self._errors = []
+        self._thread = threading.Thread(target=self._deliver, name='NotificationQueue', daemon=True)
+        self._thread.start()
+
+    def send(self, subject, text, log_file=None):
+        """Queue the mail with the tail of log_file attached if given"""
+        with self._lock:
+            self._queued += 1
+        self._queue.put((subject, _make_email(subject, text, self._sender, self._recipients, log_file)))
+
+    def notify(self, status, log_file=None):
+        """Queue the mail of status or add status to the digest"""
+        with self._lock:
+            if self._digest is not None:
+                self._digest.append(status)
+                return
+        self.send(status['status_brief'], _format_status_detailed(status), log_file)
+
+    def flush(self):
+        """Queue the digest of the statuses notified since the previous one"""
+        with self._lock:
+            if not self._digest:
+                return
+            statuses, self._digest = self._digest, []
+        lines = []
+        for status in statuses:
+            lines.append(status['status_brief'])
+            lines += ['    ' + _format_phase(phase) for phase in status.get('phases', [])]
+            if status.get('seconds') is not None:
+                lines.append('    Elapsed time: ' + _format_time_delta(datetime.timedelta(seconds=status['seconds'])))
+        failed = [status for status in statuses if not status['retval']]
+        for status in failed:
+            lines += ['', status['status_brief'], _format_status_detailed(status)]
+        subject = '{}: {} jobs, {}'.format(self._digest_subject, len(statuses),
+                                           '{} FAILED'.format(len(failed)) if failed else 'OK')
+        self.send(subject, '\n'.join(lines), self._log_file)
+
+    def close(self, timeout=None):
+        """Send the digest and the queued mails waiting at most timeout seconds, return the delivery status"""
+        self.flush()
+        self._queue.put(None)
+        self._thread.join(timeout)
+        status_detailed = list(self._errors)
+        pending = self._queued - self._sent - len(status_detailed)
+        status_detailed.append('{} mail(s) sent, {} failed and spooled, {} not sent yet, {} spooled mail(s) sent.'.format(
+            self._sent, len(status_detailed), pending, self._resent))
+        delivery_ok = not self._errors and not pending
+        return {'retval': delivery_ok, 'status_brief': '[S3 Backup] Notifications: {}'.format(
+                'OK' if delivery_ok else 'FAILED'), 'status_detailed': status_detailed}
+
+    def _send_spooled(self, smtp):
+        """Send the spooled mails over smtp. Return smtp or None if it has failed"""
+        for path in _spooled_emails():
+            spooled = _load_json_file(path)
+            if spooled is None:
+                continue
+            try:
+                smtp.sendmail(spooled['sender'], spooled['recipients'], spooled['mail'])
+            except Exception as e:
+                _write_log(self._log_file, 'Failed to send spooled {}. {}. {}'.format(spooled['subject'], type(e), e),
+                           flush=True)
+                _smtp_quit(smtp)
+                return None
+            try:
+                os.remove(path)
+            except OSError:
+                # sent by another queue meanwhile
+                pass
+            self._resent += 1
+        return smtp
+
+    def _deliver(self):
+        smtp = None
+        if _spooled_emails():
+            try:
+                smtp = self._send_spooled(_smtp_connect(*self._smtp_args))
+            except Exception:
+                # still down, the mails stay spooled
+                pass
+        while True:
+            try:
+                item = self._queue.get(timeout=NOTIFY_SMTP_IDLE_TIMEOUT if smtp else None)
+            except queue.Empty:
+                _smtp_quit(smtp)
+                smtp = None
+                continue
+            if item is None:
+                break
+            subject, mail = item
+            for attempt in range(NOTIFY_MAX_ATTEMPTS):
+                if attempt:
+                    time.sleep(NOTIFY_RETRY_BACKOFF * 2 ** (attempt - 1))
+                try:
+                    if smtp is None:
+                        smtp = _smtp_connect(*self._smtp_args)
+                    smtp.sendmail(self._sender, self._recipients, mail)
+                    self._sent += 1
+                    smtp = self._send_spooled(smtp)
+                    break
+                except Exception as e:
+                    # the connection may be broken, the next attempt opens a new one
+                    error = 'Failed to send {}. {}. {}'.format(subject, type(e), e)
+                    if smtp is not None:
+                        _smtp_quit(smtp)
+                        smtp = None
+            else:
+                self._errors.append(error)
+                _write_log(self._log_file, error + ' Spooled to be sent later.', flush=True)
+                _spool_email(self._sender, self._recipients, subject, mail)
+        if smtp is not None:
+            _smtp_quit(smtp)
+
+
+def configure_s3_clients(max_pool_connections=None, retry_mode=None, max_retry_attempts=None, bucket_regions=None,
+                         bucket_endpoints=None):
+    """Change the settings of the S3 clients shared by all backups and downloads.
+
+    bucket_endpoints maps buckets to the endpoint urls of the S3 compatible storages serving them.
+    Clients created with the previous settings are dropped and recreated on the next use.
+    """
+    global S3_MAX_POOL_CONNECTIONS, S3_RETRY_MODE, S3_MAX_RETRY_ATTEMPTS
+    with _s3_clients_lock:
+        if max_pool_connections is not None:
+            S3_MAX_POOL_CONNECTIONS = max_pool_connections
+        if retry_mode is not None:
+            S3_RETRY_MODE = retry_mode
+        if max_retry_attempts is not None:
+            S3_MAX_RETRY_ATTEMPTS = max_retry_attempts
+        if bucket_regions is not None:
+            S3_BUCKET_REGIONS.update(bucket_regions)
+        if bucket_endpoints is not None:
+            S3_BUCKET_ENDPOINTS.update(bucket_endpoints)
+        _s3_clients.clear()
+
+
+def backup_dir(hint, dir, archive_path, bucket_name, log_file, stream_to_s3=False, keep_local_copy=True, dedup=False,
+               index=False, codec=None, compression_level=None, skip_unchanged=False,
+               mirror_buckets=None, mirror_dir=None):
+    """Back up dir to S3.
+
+    With dedup only the content not yet stored in the bucket is uploaded as deduplicated chunks together with
+    a snapshot manifest named after archive_path without extension, restore it with restore_dedup_snapshot().
+    With index the archive is made of separately encrypted segments and uploaded with an index of its files,
+    so that single files can be restored with restore_files() without downloading the whole archive.
+    codec and compression_level override ARCHIVE_CODEC and ARCHIVE_COMPRESSION_LEVEL.
+    With skip_unchanged the backup is skipped when no file in dir has been added, removed or modified
+    since the last successful backup, see FINGERPRINT_DIR.
+    The archive is also uploaded to each of mirror_buckets and copied to mirror_dir at the same time, streamed
+    archives are read once for all of them. The backup fails unless every destination gets the archive.
+    The other backup_* functions take mirror_buckets and mirror_dir as well.
+    """
+    return _run_backup_job(_make_job(BackupKind.DIR, hint, dir, archive_path, bucket_name, log_file,
+                                     stream_to_s3=stream_to_s3, keep_local_copy=keep_local_copy, dedup=dedup,
+                                     index=index, codec=codec, compression_level=compression_level,
+                                     skip_unchanged=skip_unchanged,
+                                     mirror_buckets=list(mirror_buckets or []), mirror_dir=mirror_dir))
+
+
+# Backup LAMP setup including apache HTML directory, apache config directory and MySQL Db
+# With mysql_dump_threads the Db is dumped by that many threads as with backup_mysql_db()
+# With index the archive is indexed and codec, compression_level are applied as with backup_dir()
+def backup_lamp(backup_name_hint, db_name, archive_path, bucket_name, log_file,
+                stream_to_s3=False, keep_local_copy=True, mysql_dump_threads=None, index=False,
+                codec=None, compression_level=None, mirror_buckets=None, mirror_dir=None):
+    return _run_backup_job(_make_job(BackupKind.LAMP, backup_name_hint, db_name, archive_path, bucket_name, log_file,
+                                     stream_to_s3=stream_to_s3, keep_local_copy=keep_local_copy,
+                                     mysql_dump_threads=mysql_dump_threads, index=index,
+                                     codec=codec, compression_level=compression_level,
+                                     mirror_buckets=list(mirror_buckets or []), mirror_dir=mirror_dir))
+
+
+def backup_mysql_db(backup_name_hint, db_name, archive_path, bucket_name, log_file,
+                    stream_to_s3=False, keep_local_copy=True, threads=None, incremental=False,
+                    mirror_buckets=None, mirror_dir=None):
+    """Back up the MySQL database dumping its tables in parallel from one consistent snapshot with mydumper.
+
+    With incremental only the binary logs written since the last backup are archived, a full backup is made
+    every MYSQL_FULL_BACKUP_INTERVAL_DAYS days. Restore with myloader and replay the binary logs
+    as described in binlog.json of each incremental archive.
+    Connection options come from MYSQL_CLIENT_OPTIONS and the usual MySQL option files.
+    """
+    return _run_backup_job(_make_job(BackupKind.MYSQL, backup_name_hint, db_name, archive_path, bucket_name, log_file,
+                                     stream_to_s3=stream_to_s3, keep_local_copy=keep_local_copy,
+                                     incremental=incremental, mysql_dump_threads=threads,
+                                     mirror_buckets=list(mirror_buckets or []), mirror_dir=mirror_dir))
+
+
+def backup_svn_repo(backup_name_hint, svn_url, archive_path, bucket_name, log_file,
+                    stream_to_s3=False, keep_local_copy=True, incremental=SvnIncrementalMode.NONE,
+                    mirror_buckets=None, mirror_dir=None):
+    """Back up the svn repo at svn_url.
+
+    With incremental other than SvnIncrementalMode.NONE the backup is skipped when there are no new revisions
+    since the last successful backup. With SvnIncrementalMode.DUMP the archive contains the dump of the new
+    revisions only, the first one and then one every SVN_FULL_DUMP_INTERVAL_DAYS days contain the full dump
+    and the retention keeps each dump with the ones it builds on; restore by 'svnadmin load'-ing them in order
+    from the last full one.
+    """
+    return _run_backup_job(_make_job(BackupKind.SVN_REPO, backup_name_hint, svn_url, archive_path, bucket_name, log_file,
+                                     stream_to_s3=stream_to_s3, keep_local_copy=keep_local_copy,
+                                     incremental=incremental,
+                                     mirror_buckets=list(mirror_buckets or []), mirror_dir=mirror_dir))
+
+
+# With skip_unchanged the update and backup are skipped when neither the repo has new revisions
+# nor the working copy has changed since the last successful backup
+def backup_svn_wc(backup_name_hint, svn_dir, archive_path, bucket_name, log_file,
+                  stream_to_s3=False, keep_local_copy=True, skip_unchanged=False, mirror_buckets=None, mirror_dir=None):
+    return _run_backup_job(_make_job(BackupKind.SVN_WC, backup_name_hint, svn_dir, archive_path, bucket_name, log_file,
+                                     stream_to_s3=stream_to_s3, keep_local_copy=keep_local_copy,
+                                     skip_unchanged=skip_unchanged,
+                                     mirror_buckets=list(mirror_buckets or []), mirror_dir=mirror_dir))
+
+
+def backup_git_repo(backup_name_hint, clone_url, archive_path, bucket_name, log_file,
+                    stream_to_s3=False, keep_local_copy=True, incremental=False, codec=None, compression_level=None,
+                    skip_unchanged=False, mirror_buckets=None, mirror_dir=None):
+    """Back up the git repo from a persistent mirror of clone_url refreshed by incremental fetches.
 
+    With incremental the bundle contains only the refs and objects added since the last successful backup
+    and the backup is skipped when there are none. A full bundle is made every GIT_FULL_BACKUP_INTERVAL_DAYS days,
+    the retention keeps each incremental bundle with the bundles it builds on. To restore, fetch from the last
+    full bundle and then from the incremental bundles made after it in order.
+    codec and compression_level are applied as with backup_dir().
+    With skip_unchanged the fetch and backup are skipped when 'git ls-remote' shows the same refs
+    as at the last successful backup.
+    """
+    return _run_backup_job(_make_job(BackupKind.GIT_REPO, backup_name_hint, clone_url, archive_path, bucket_name, log_file,
+                                     stream_to_s3=stream_to_s3, keep_local_copy=keep_local_copy,
+                                     incremental=incremental, codec=codec, compression_level=compression_level,
+                                     skip_unchanged=skip_unchanged,
+                                     mirror_buckets=list(mirror_buckets or []), mirror_dir=mirror_dir))
+
+
+# Upload the latest modified file matching backup_filemask.
+# With sync every matching file that is not in the bucket yet is uploaded, up to SYNC_MAX_CONCURRENCY at once
+def backup_latest(backup_name_hint, backup_filemask, bucket_name, log_file, sync=False,
+                  mirror_buckets=None, mirror_dir=None):
+    return _run_backup_job(_make_job(BackupKind.LATEST, backup_name_hint, backup_filemask, None, bucket_name, log_file,
+                                     sync=sync, mirror_buckets=list(mirror_buckets or []), mirror_dir=mirror_dir))
+
+
+# With skip_unchanged the backup is skipped when nothing in trac_dir has changed since the last successful backup
+def backup_trac(backup_name_hint, trac_dir, archive_path, bucket_name, log_file,
+                stream_to_s3=False, keep_local_copy=True, codec=None, compression_level=None, skip_unchanged=False,
+                mirror_buckets=None, mirror_dir=None):
+    return _run_backup_job(_make_job(BackupKind.TRAC, backup_name_hint, trac_dir, archive_path, bucket_name, log_file,
+                                     stream_to_s3=stream_to_s3, keep_local_copy=keep_local_copy,
+                                     codec=codec, compression_level=compression_level,
+                                     skip_unchanged=skip_unchanged,
+                                     mirror_buckets=list(mirror_buckets or []), mirror_dir=mirror_dir))
+
+
+def _start_archive_pool(max_workers):
+    """Return a pool of max_workers processes for the archive stages of run_backup_jobs()"""
+    # the workers rely on the globals set up by the parent such as S3_BUCKET_ENDPOINTS
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers or JOB_MAX_ARCHIVE_WORKERS,
+                                                  mp_context=multiprocessing.get_context('fork'))
+    # Launch the worker processes before starting any thread: with the fork start method
+    # they should not inherit locks held by other threads
+    pool.submit(int).result()
+    return pool
+
+
+def _is_pool_broken(pool):
+    try:
+        pool.submit(int).result()
+    except concurrent.futures.process.BrokenProcessPool:
+        return True
+    return False
+
+
+def run_backup_jobs(jobs, max_archive_workers=None, max_upload_workers=None, archive_pool=None):
+    """Run many backups at once overlapping their stages.
+
+    Dumps and archiving run in a pool of max_archive_workers processes, uploads and cleanup
+    in a pool of max_upload_workers threads, so one job gets compressed while another one is being uploaded.
+    Each job is a dict with the keys kind (see BackupKind), hint, source, archive_path, bucket_name, log_file
+    and optionally stream_to_s3, keep_local_copy, dedup, incremental, mysql_dump_threads, index, retention_policy,
+    retention_prefix, codec, compression_level, skip_unchanged, sync, mirror_buckets and mirror_dir.
+    source is the argument following the hint in the corresponding backup_* function.
+    Once a job succeeds its local archives are pruned by retention_policy (RETENTION_POLICY by default),
+    with retention_prefix the same is done to the archives with that prefix in the bucket.
+    Only the local archives named with retention_prefix, or when not given the ones named as archive_path
+    but for the timestamp (see _archive_series()), are pruned. With no timestamp in archive_path the ones
+    named as archive_path up to its last number are expired after MAX_ARCHIVE_AGE_DAYS, see RETENTION_POLICY.
+    The archives in mirror_dir and mirror_buckets are pruned alike.
+    dedup snapshots are pruned only with retention_prefix, see prune_dedup_snapshots().
+    archive_pool is the pool of a previous run to reuse instead of max_archive_workers new processes,
+    it is left running.
+    Return the list of job statuses in the order of jobs, each as returned by the backup_* functions.
+    """
+    jobs = [_make_job(**job) for job in jobs]
+    results = [None] * len(jobs)
+    start = datetime.datetime.today()
+    own_archive_pool = archive_pool is None
+    if own_archive_pool:
+        archive_pool = _start_archive_pool(max_archive_workers)
+    fetch_pool = None
+    upload_pool = None
+    try:
+        fetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=GIT_MAX_PARALLEL_FETCHES)
+        upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_upload_workers or JOB_MAX_UPLOAD_WORKERS)
+        # {future: (stage, job index)}
+        pending = {}
+
+        def upload(i, archived):
+            pending[upload_pool.submit(_job_upload_stage, jobs[i], archived)] = ('upload', i)
+
+        def failed(e):
+            return {"ret": False, "description": '\nError: {}. {}'.format(type(e), e), "start": start,
+                    "upload_path": None}
+
+        def archive(i, job):
+            try:
+                pending[archive_pool.submit(_job_archive_stage, job)] = ('archive', i)
+            except concurrent.futures.process.BrokenProcessPool as e:
+                # a worker has died, e.g. killed for running out of memory
+                upload(i, failed(e))
+
+        for i, job in enumerate(jobs):
+            if job['kind'] == BackupKind.GIT_REPO:
+                # git fetches are network-bound, run them apart from the archive stages
+                pending[fetch_pool.submit(_job_fetch_stage, job)] = ('fetch', i)
+            else:
+                archive(i, job)
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage, i = pending.pop(future)
+                if stage == 'fetch':
+                    archive(i, future.result() if future.exception() is None else jobs[i])
+                elif stage == 'archive':
+                    try:
+                        archived = future.result()
+                    except Exception as e:
+                        archived = failed(e)
+                    upload(i, archived)
+                else:
+                    results[i] = future.result()
+    finally:
+        if own_archive_pool:
+            archive_pool.shutdown()
+        for pool in (fetch_pool, upload_pool):
+            if pool is not None:
+                pool.shutdown()
+    return results
+
+
+def _load_job_file(job_file):
+    """Return the settings and the scheduled jobs of the JSON job file, see run_daemon()"""
+    with open(job_file) as f:
+        config = json.load(f)
+    jobs = []
+    for job in config.get('jobs', []):
+        job = dict({'archive_path': None}, **job)
+        schedule = {name: job.pop(name) for name in ('at', 'every') if name in job}
+        if len(schedule) != 1:
+            raise Exception("Backup job {} needs either 'at' or 'every' schedule".format(job.get('hint')))
+        if isinstance(schedule.get('at'), str):
+            schedule['at'] = [schedule['at']]
+        for at in schedule.get('at', []):
+            datetime.datetime.strptime(at, '%H:%M')
+        _make_job(**job)
+        jobs.append((schedule, job))
+    return config, jobs
+
+
+def _next_run_time(schedule, after):
+    """Return the first time after after when the job with schedule is due"""
+    if 'every' in schedule:
+        return after + datetime.timedelta(seconds=schedule['every'])
+    run_times = []
+    for at in schedule['at']:
+        at = datetime.datetime.strptime(at, '%H:%M')
+        run_time = after.replace(hour=at.hour, minute=at.minute, second=0, microsecond=0)
+        if run_time <= after:
+            run_time += datetime.timedelta(days=1)
+        run_times.append(run_time)
+    return min(run_times)
+
+
+def run_daemon(job_file, log_file, once=False):
+    """Run the backup jobs of job_file on their schedules until SIGTERM or SIGINT.
+
+    job_file is JSON like {"jobs": [...], "max_archive_workers": 2, "max_upload_workers": 4, "s3": {...}}
+    where each job is a run_backup_jobs() job with either "at": "HH:MM" (or a list of such times) to run it daily
+    or "every": <seconds> to run it at that interval starting right away, "s3" holds configure_s3_clients() arguments
+    and the optional "email" holds NotificationQueue arguments to mail the job statuses, a digest per run with digest.
+    archive_path may contain strftime() directives, they are filled in at each run.
+    The job file is reloaded when it changes. Jobs due at the same time run together. As the process stays up,
+    the imports, S3 clients, log files, git mirrors, svn working copies and fingerprints are reused by every run,
+    so are the archive worker processes until the job file changes or one of them dies.
+    With once all the jobs are run right away a single time and their statuses are returned.
+    """
+    stop = threading.Event()
+    if not once and threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: stop.set())
+    _write_log(log_file, 'Starting backup daemon with {}'.format(job_file), flush=True)
+    job_file_mtime = None
+    config = {}
+    notifications = None
+    archive_pool = None
+    # [(schedule, job, next run time)]
+    scheduled = []
+    results = []
+
+    def start_workers():
+        """(Re)start the archive worker processes, then the notification queue, see _start_archive_pool()"""
+        nonlocal archive_pool, notifications
+        if notifications is not None:
+            # drain the queue: the thread must be gone when the workers are forked
+            status = notifications.close()
+            _write_log(log_file, [status['status_brief']] + status['status_detailed'])
+            notifications = None
+        if archive_pool is not None:
+            archive_pool.shutdown()
+        archive_pool = _start_archive_pool(config.get('max_archive_workers'))
+        notifications = NotificationQueue(log_file=log_file, **config['email']) if config.get('email') else None
 
-def download_latest(bucket_name, file_prefix, store_dir, log_file):
+    while not stop.is_set():
+        try:
+            mtime = os.path.getmtime(job_file)
+            if mtime != job_file_mtime:
+                config, jobs = _load_job_file(job_file)
+                job_file_mtime = mtime
+                configure_s3_clients(**config.get('s3', {}))
+                # the workers are forked with the settings of the job file
+                start_workers()
+                # keep the next run times of the jobs that did not change
+                next_runs = {json.dumps(job, sort_keys=True): next_run for _, job, next_run in scheduled}
+                now = datetime.datetime.today()
+                scheduled = [(schedule, job, next_runs.get(json.dumps(job, sort_keys=True)) or
+                              (now if once or 'every' in schedule else _next_run_time(schedule, now)))
+                             for schedule, job in jobs]
+                _write_log(log_file, 'Loaded {} backup jobs from {}'.format(len(scheduled), job_file), flush=True)
+        except Exception as e:
+            _write_log(log_file, 'Error: failed to load {}. {}. {}'.format(job_file, type(e), e), flush=True)
+            if once:
+                raise
+        now = datetime.datetime.today()
+        due = [i for i, (_, _, next_run) in enumerate(scheduled) if next_run <= now]
+        if due:
+            jobs = [dict(job, archive_path=now.strftime(job['archive_path']) if job['archive_path'] else None)
+                    for _, job, _ in (scheduled[i] for i in due)]
+            _write_log(log_file, 'Running backup jobs {}'.format(', '.join(job['hint'] for job in jobs)), flush=True)
+            try:
+                if archive_pool is None or _is_pool_broken(archive_pool):
+                    _write_log(log_file, 'Restarting the archive workers', flush=True)
+                    # forked after the uploads of the previous runs, the workers open S3 connections of their own,
+                    # see _reset_s3_clients_after_fork()
+                    start_workers()
+                results = run_backup_jobs(jobs, max_upload_workers=config.get('max_upload_workers'),
+                                          archive_pool=archive_pool)
+            except Exception as e:
+                results = [{'retval': False, 'status_brief': '[S3 Backup] {}: FAILED'.format(job['hint']),
+                            'status_detailed': ['Error: {}. {}'.format(type(e), e)]} for job in jobs]
+            _write_log(log_file, [result['status_brief'] for result in results], flush=True)
+            if notifications is not None:
+                for job, result in zip(jobs, results):
+                    notifications.notify(result, job['log_file'])
+                notifications.flush()
+            now = datetime.datetime.today()
+            for i in due:
+                schedule, job, _ = scheduled[i]
+                scheduled[i] = (schedule, job, _next_run_time(schedule, now))
+        if once:
+            break
+        next_run = min([next_run for _, _, next_run in scheduled], default=None)
+        timeout = DAEMON_POLL_INTERVAL
+        if next_run is not None:
+            timeout = max(0, min(timeout, (next_run - datetime.datetime.today()).total_seconds()))
+        stop.wait(timeout)
+    if archive_pool is not None:
+        archive_pool.shutdown()
+    if notifications is not None:
+        status = notifications.close(DAEMON_POLL_INTERVAL)
+        _write_log(log_file, [status['status_brief']] + status['status_detailed'])
+    _write_log(log_file, 'Backup daemon stopped', flush=True)
+    return results
+
+
+def restore_dedup_snapshot(bucket_name, snapshot_name, target_dir, log_file):
+    """Restore the snapshot made by backup_dir(..., dedup=True) to target_dir"""
+    status_brief = '[S3 Backup] Restore snapshot {} from {}:'.format(snapshot_name, bucket_name)
+    status_detailed = []
+    restore_ok = False
+    start = datetime.datetime.today()
+    _write_log(log_file, 'Restoring snapshot {} from bucket {} to {}'.format(snapshot_name, bucket_name, target_dir))
+    try:
+        file_count = _dedup_restore(bucket_name, snapshot_name, target_dir)
+        status_detailed.append('Restored {} files to {}.'.format(file_count, target_dir))
+        restore_ok = True
+    except Exception as e:
+        status_detailed.append('Error: {}. {}'.format(type(e), e))
+    except:
+        status_detailed.append('Unknown error')
+    finally:
+        status_brief += ' OK' if restore_ok else ' FAILED'
+        end = datetime.datetime.today()
+        status_detailed.append('Elapsed time: ' + _format_time_delta(end - start))
+        _write_log(log_file, status_detailed, flush=True)
+        return {'retval': restore_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
+
+
+def download_latest(bucket_name, file_prefix, store_dir, log_file, use_latest_manifest=True):
+    """Download the latest backup with the key starting with file_prefix.
+
+    With use_latest_manifest the latest backup is looked up in the manifest kept by the backups with one GET,
+    the bucket is listed only when the manifest has no such backup. Switch it off when the bucket
+    gets backups from elsewhere too.
+    """
     status_brief = '[S3 Backup] Get the latest backup starting with {} from {}:'.format(
         file_prefix, bucket_name)
     #@todo use list-like status_detailed for the rest status_detailed in this file iso tinkering with '\n'
     status_detailed = []
     download_ok = False
+    store_path = None
     start = datetime.datetime.today()
     _write_log(log_file, 'Starting download')
     try:
         _write_log(log_file, '[S3 backup] Downloading the latest backup starting with {} from bucket {} to {}'.format(
             file_prefix, bucket_name, store_dir))
-        s3_key = _find_latest_modified_s3_key(bucket_name, file_prefix)
+        s3_key = _find_latest_modified_s3_key(bucket_name, file_prefix, use_latest_manifest)
         if s3_key:
             store_path = os.path.join(store_dir, s3_key['Key'])
             if not os.path.exists(store_path) or os.path.getsize(store_path) != s3_key['Size']:
@@ -633,11 +4316,237 @@ def download_latest(bucket_name, file_prefix, store_dir, log_file):
         if download_ok:
             end = datetime.datetime.today()
             status_brief += ' OK'
-            status_detailed.append('Successfully downloaded {} ({})'.format(store_path, _pretty_filesize(store_path)))
+            if store_path:
+                status_detailed.append('Successfully downloaded {} ({})'.format(store_path, _pretty_filesize(store_path)))
             status_detailed.append('Elapsed time: ' + _format_time_delta(end - start))
         else:
             status_brief += ' FAILED'
             status_detailed.append('ERROR downloading from {} to {}'.format(bucket_name, store_dir))
 
-        _write_log(log_file, status_detailed)
+        _write_log(log_file, status_detailed, flush=True)
         return {'retval': download_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
+
+
+def restore_latest(bucket_name, file_prefix, target_dir, log_file, store_dir=None, use_latest_manifest=True):
+    """Download the latest backup starting with file_prefix and extract it to target_dir.
+
+    Archives streamed to S3 are decrypted and extracted as they are downloaded without an intermediate file,
+    indexed archives segment by segment.
+    7z archives are downloaded to store_dir (target_dir if not given) first, the download resumes if interrupted
+    and the archive is removed after extraction unless store_dir is given.
+    """
+    status_brief = '[S3 Backup] Restore the latest backup starting with {} from {}:'.format(file_prefix, bucket_name)
+    status_detailed = []
+    restore_ok = False
+    phases = []
+    start = datetime.datetime.today()
+    _write_log(log_file, 'Restoring the latest backup starting with {} from bucket {} to {}'.format(
+        file_prefix, bucket_name, target_dir))
+    try:
+        s3_key = _find_latest_modified_s3_key(bucket_name, file_prefix, use_latest_manifest)
+        if not s3_key:
+            raise Exception('No file found in bucket {} starting with {}'.format(bucket_name, file_prefix))
+        phase_start = time.monotonic()
+        index = _load_archive_index(bucket_name, s3_key['Key'])
+        if index:
+            status_detailed.append('Restoring {} from {} to {} by segments...'.format(s3_key['Key'], bucket_name, target_dir))
+            size = _restore_indexed_members(bucket_name, s3_key['Key'], index, sorted(index['members']), target_dir)
+            phases = [_make_phase('download+extract', phase_start, bytes_in=size)]
+        elif _is_7z_on_s3(bucket_name, s3_key['Key']):
+            archive_path = os.path.join(store_dir or target_dir, s3_key['Key'])
+            if not os.path.exists(archive_path) or os.path.getsize(archive_path) != s3_key['Size']:
+                status_detailed.append('Downloading {} from {} to {}...'.format(s3_key['Key'], bucket_name, archive_path))
+                _download_from_s3(bucket_name, s3_key['Key'], archive_path)
+            phases = [_make_phase('download', phase_start, bytes_out=s3_key['Size'])]
+            phase_start = time.monotonic()
+            ret = _extract_7z(archive_path, target_dir)
+            _write_log(log_file, '{}\nStdOut: {}\nStdErr: {}\n'.format(ret['description'], ret['stdout'], ret['stderr']))
+            if not ret['ret']:
+                raise Exception(ret['description'])
+            phases.append(_make_phase('extract', phase_start, bytes_in=s3_key['Size']))
+            if not store_dir:
+                os.remove(archive_path)
+        else:
+            status_detailed.append('Streaming {} from {} to {}...'.format(s3_key['Key'], bucket_name, target_dir))
+            size = _stream_restore_from_s3(bucket_name, s3_key['Key'], target_dir)
+            phases = [_make_phase('download+extract', phase_start, bytes_in=size)]
+        status_detailed.append('Restored {} to {}.'.format(s3_key['Key'], target_dir))
+        status_detailed += [_format_phase(phase) for phase in phases]
+        restore_ok = True
+    except Exception as e:
+        status_detailed.append('Error: {}. {}'.format(type(e), e))
+    except:
+        status_detailed.append('Unknown error')
+    finally:
+        status_brief += ' OK' if restore_ok else ' FAILED'
+        end = datetime.datetime.today()
+        status_detailed.append('Elapsed time: ' + _format_time_delta(end - start))
+        _write_log(log_file, status_detailed, flush=True)
+        return {'retval': restore_ok, 'status_brief': status_brief, 'status_detailed': status_detailed,
+                'phases': phases}
+
+
+def find_backup_files(bucket_name, archive_key, patterns, log_file):
+    """List the files of the archive indexed by backup_dir(..., index=True) matching patterns, see restore_files()"""
+    status_brief = '[S3 Backup] Find {} in {}/{}:'.format(', '.join(patterns), bucket_name, archive_key)
+    status_detailed = []
+    find_ok = False
+    start = datetime.datetime.today()
+    try:
+        index = _load_archive_index(bucket_name, archive_key)
+        if not index:
+            raise Exception('{} has no index'.format(archive_key))
+        for path in _match_index_members(index, patterns):
+            member = index['members'][path]
+            status_detailed.append('{} {} {} {}'.format(
+                path + '/' if member['type'] == 'd' else path, _pretty_size(member['size']),
+                datetime.datetime.fromtimestamp(member['mtime']).strftime('%Y-%m-%d %H:%M:%S'), member.get('sha256', '')))
+        find_ok = True
+    except Exception as e:
+        status_detailed.append('Error: {}. {}'.format(type(e), e))
+    except:
+        status_detailed.append('Unknown error')
+    finally:
+        status_brief += ' OK' if find_ok else ' FAILED'
+        end = datetime.datetime.today()
+        status_detailed.append('Elapsed time: ' + _format_time_delta(end - start))
+        _write_log(log_file, status_detailed, flush=True)
+        return {'retval': find_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
+
+
+def restore_files(bucket_name, archive_key, patterns, target_dir, log_file):
+    """Restore the files matching patterns from the archive indexed by backup_dir(..., index=True) to target_dir.
+
+    A pattern is a path in the archive, a directory to restore with all its content or a glob.
+    Only the byte ranges of the archive holding the matching files are downloaded.
+    """
+    status_brief = '[S3 Backup] Restore {} from {}/{}:'.format(', '.join(patterns), bucket_name, archive_key)
+    status_detailed = []
+    restore_ok = False
+    start = datetime.datetime.today()
+    _write_log(log_file, 'Restoring {} from {} in bucket {} to {}'.format(
+        ', '.join(patterns), archive_key, bucket_name, target_dir))
+    try:
+        index = _load_archive_index(bucket_name, archive_key)
+        if not index:
+            raise Exception('{} has no index'.format(archive_key))
+        paths = _match_index_members(index, patterns)
+        if not paths:
+            raise Exception('Nothing in {} matches {}'.format(archive_key, ', '.join(patterns)))
+        size = _restore_indexed_members(bucket_name, archive_key, index, paths, target_dir)
+        status_detailed.append('Restored {} files to {}, downloaded {}.'.format(len(paths), target_dir, _pretty_size(size)))
+        restore_ok = True
+    except Exception as e:
+        status_detailed.append('Error: {}. {}'.format(type(e), e))
+    except:
+        status_detailed.append('Unknown error')
+    finally:
+        status_brief += ' OK' if restore_ok else ' FAILED'
+        end = datetime.datetime.today()
+        status_detailed.append('Elapsed time: ' + _format_time_delta(end - start))
+        _write_log(log_file, status_detailed, flush=True)
+        return {'retval': restore_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
+
+
+def prune_backups(bucket_name, key_prefix, log_file, extension='', local_dir=None, policy=None, dry_run=False):
+    """Delete the archives expired by the retention policy (RETENTION_POLICY by default) from the bucket and local_dir.
+
+    Only the objects with key_prefix and the local files named with the base name of key_prefix
+    and ending with extension are considered. Dedup snapshots are left to prune_dedup_snapshots().
+    With dry_run nothing is deleted, the report lists what would be.
+    """
+    status_brief = '[S3 Backup] Prune {}* from {}:'.format(key_prefix, bucket_name)
+    status_detailed = []
+    prune_ok = False
+    start = datetime.datetime.today()
+    _write_log(log_file, 'Pruning {}*{} in bucket {}{}'.format(
+        key_prefix, extension, bucket_name, ' and ' + local_dir if local_dir else ''))
+    action = 'Would delete' if dry_run else 'Deleted'
+    try:
+        keys = _cleanup_old_s3_archives(bucket_name, key_prefix, extension, policy=policy, dry_run=dry_run)
+        status_detailed += ['{} s3://{}/{}'.format(action, bucket_name, key) for key in keys]
+        if local_dir:
+            ret = _cleanup_old_archines(local_dir, extension, policy=policy, dry_run=dry_run,
+                                        prefix=os.path.basename(key_prefix))
+            if not ret['ret']:
+                raise Exception(ret['description'])
+            status_detailed += ['{} {}'.format(action, os.path.join(local_dir, name)) for name in ret['deleted']]
+        status_detailed.append('done.')
+        prune_ok = True
+    except Exception as e:
+        status_detailed.append('Error: {}. {}'.format(type(e), e))
+    except:
+        status_detailed.append('Unknown error')
+    finally:
+        status_brief += ' OK' if prune_ok else ' FAILED'
+        end = datetime.datetime.today()
+        status_detailed.append('Elapsed time: ' + _format_time_delta(end - start))
+        _write_log(log_file, status_detailed, flush=True)
+        return {'retval': prune_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
+
+
+def prune_dedup_snapshots(bucket_name, snapshot_prefix, log_file, policy=None, dry_run=False):
+    """Delete the snapshots of backup_dir(..., dedup=True) named with snapshot_prefix expired by the retention policy
+    (RETENTION_POLICY by default) with the packs no remaining snapshot refers to.
+
+    Run it on the host making the snapshots, the deleted chunks are dropped from its local index.
+    Packs uploaded within DEDUP_PRUNE_GRACE_HOURS are kept. With dry_run nothing is deleted.
+    """
+    status_brief = '[S3 Backup] Prune snapshots {}* from {}:'.format(snapshot_prefix, bucket_name)
+    status_detailed = []
+    prune_ok = False
+    start = datetime.datetime.today()
+    _write_log(log_file, 'Pruning snapshots {}* in bucket {}'.format(snapshot_prefix, bucket_name))
+    try:
+        snapshots, pack_count = _prune_dedup_snapshots(bucket_name, snapshot_prefix, policy=policy, dry_run=dry_run)
+        action = 'Would delete' if dry_run else 'Deleted'
+        status_detailed += ['{} snapshot {}'.format(action, name) for name in snapshots]
+        if not dry_run:
+            status_detailed.append('Deleted {} unreferenced pack(s).'.format(pack_count))
+        status_detailed.append('done.')
+        prune_ok = True
+    except Exception as e:
+        status_detailed.append('Error: {}. {}'.format(type(e), e))
+    except:
+        status_detailed.append('Unknown error')
+    finally:
+        status_brief += ' OK' if prune_ok else ' FAILED'
+        end = datetime.datetime.today()
+        status_detailed.append('Elapsed time: ' + _format_time_delta(end - start))
+        _write_log(log_file, status_detailed, flush=True)
+        return {'retval': prune_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
+
+
+def abort_stale_uploads(bucket_name, log_file, max_age_hours=STALE_UPLOAD_MAX_AGE_HOURS):
+    """Abort multipart uploads left in bucket_name by crashed or killed backups"""
+    status_brief = '[S3 Backup] Abort stale uploads in {}:'.format(bucket_name)
+    status_detailed = []
+    abort_ok = False
+    start = datetime.datetime.today()
+    _write_log(log_file, 'Aborting multipart uploads to {} older than {} hours'.format(bucket_name, max_age_hours))
+    try:
+        keys = _abort_stale_multipart_uploads(bucket_name, max_age_hours)
+        status_detailed += ['Aborted stale upload of ' + key for key in keys]
+        status_detailed.append('{} stale upload(s) aborted.'.format(len(keys)))
+        abort_ok = True
+    except Exception as e:
+        status_detailed.append('Error: {}. {}'.format(type(e), e))
+    except:
+        status_detailed.append('Unknown error')
+    finally:
+        status_brief += ' OK' if abort_ok else ' FAILED'
+        end = datetime.datetime.today()
+        status_detailed.append('Elapsed time: ' + _format_time_delta(end - start))
+        _write_log(log_file, status_detailed, flush=True)
+        return {'retval': abort_ok, 'status_brief': status_brief, 'status_detailed': status_detailed}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run the backup jobs of a job file on their schedules')
+    parser.add_argument('job_file', help='JSON job file, see run_daemon()')
+    parser.add_argument('--log-file', default='backup_util.log')
+    parser.add_argument('--once', action='store_true', help='run every job once right away and exit')
+    args = parser.parse_args()
+    statuses = run_daemon(args.job_file, args.log_file, once=args.once)
+    raise SystemExit(0 if all(status['retval'] for status in statuses) else 1)
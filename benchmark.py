@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark backup_util end to end against a local S3 stand-in.
+
+Generates directory trees, a git repo, an svn repo and its working copy and a trac environment of the given size
+and compressibility, runs the public backup_* and restore/download functions on them one by one, each in a fresh
+process, and stores per-case and per-phase timings, throughput, peak RSS and the temp disk high-water mark as JSON.
+
+MySQL databases cannot be generated without a server to load them in, so backup_mysql_db and backup_lamp
+back up the existing database given with --mysql-db, connected to as by backup_util (MySQL option files),
+and backup_lamp the LAMP directories of the host too. The cases whose tools or data are missing are skipped.
+
+    ./benchmark.py --size 200M --files 2000 --compressibility 0.5 --out results.json
+    ./benchmark.py --s3 minio --cases backup_dir_7z,download_latest --out results-minio.json
+    ./benchmark.py --mysql-db benchmark --cases backup_mysql_db,backup_lamp --out results-mysql.json
+    ./benchmark.py --compare results-old.json results.json
+
+The S3 stand-in is moto server ('pip install moto[server]') or a MinIO binary in PATH,
+--s3 external with --endpoint-url uses a server started elsewhere. backup_util is pointed at it
+with AWS_ENDPOINT_URL which needs boto3 1.28 or newer.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BUCKET_NAME = 'backup-util-benchmark'
+ARCHIVE_PASSWORD = 'benchmark'
+# where backup_util runs trac-admin from
+TRAC_ADMIN = '/usr/local/bin/trac-admin'
+
+# (name, backup_util function, options, the cases it depends on)
+CASES = [
+    ('backup_dir_7z', 'backup_dir', {}, []),
+    ('backup_dir_zstd', 'backup_dir', {'codec': 'zstd'}, []),
+    ('backup_dir_stream', 'backup_dir', {'stream_to_s3': True, 'keep_local_copy': False}, []),
+    ('backup_dir_index', 'backup_dir', {'index': True}, []),
+    ('backup_dir_dedup', 'backup_dir', {'dedup': True}, []),
+    ('backup_git_repo', 'backup_git_repo', {}, []),
+    ('backup_svn_repo', 'backup_svn_repo', {}, []),
+    ('backup_svn_wc', 'backup_svn_wc', {}, []),
+    ('backup_trac', 'backup_trac', {}, []),
+    ('backup_mysql_db', 'backup_mysql_db', {}, []),
+    ('backup_lamp', 'backup_lamp', {}, []),
+    ('backup_latest', 'backup_latest', {}, []),
+    ('download_latest', 'download_latest', {}, ['backup_dir_7z']),
+    ('restore_latest_7z', 'restore_latest', {}, ['backup_dir_7z']),
+    ('restore_latest_stream', 'restore_latest', {}, ['backup_dir_stream']),
+    ('restore_files', 'restore_files', {}, ['backup_dir_index']),
+    ('restore_dedup_snapshot', 'restore_dedup_snapshot', {}, ['backup_dir_dedup']),
+]
+
+
+def parse_size(text):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if text[-1:].upper() in units:
+        return int(float(text[:-1]) * units[text[-1:].upper()])
+    return int(text)
+
+
+#
+# Source data
+#
+
+def make_content(rnd, size, compressibility):
+    """Return size bytes of which about compressibility is repetitive text and the rest is random"""
+    text_size = int(size * compressibility)
+    words = [b'backup', b'archive', b'upload', b'bucket', b'log', b'error', b'info', b'request', b'200', b'404']
+    text = bytearray()
+    while len(text) < text_size:
+        text += b' '.join(rnd.choice(words) for _ in range(12)) + b'\n'
+    return bytes(text[:text_size]) + rnd.randbytes(size - text_size)
+
+
+def make_tree(root, total_size, file_count, compressibility, seed=0):
+    """Generate file_count files of total_size bytes in nested directories under root"""
+    rnd = random.Random(seed)
+    os.makedirs(root)
+    for i in range(file_count):
+        subdir = os.path.join(root, 'd{:02}'.format(i % 16), 'e{:02}'.format(i % 7))
+        if not os.path.exists(subdir):
+            os.makedirs(subdir)
+        with open(os.path.join(subdir, 'f{:05}.dat'.format(i)), 'wb') as f:
+            f.write(make_content(rnd, total_size // file_count, compressibility))
+
+
+def make_git_repo(root, total_size, file_count, compressibility, commits=5):
+    """Generate a git repo with the tree committed in several commits"""
+    os.makedirs(root)
+    git = ['git', '-C', root, '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost']
+    subprocess.check_call(git + ['init', '-q'])
+    for commit in range(commits):
+        make_tree(os.path.join(root, 'c{}'.format(commit)), total_size // commits, max(file_count // commits, 1),
+                  compressibility, seed=commit)
+        subprocess.check_call(git + ['add', '-A'])
+        subprocess.check_call(git + ['commit', '-q', '-m', 'commit {}'.format(commit)])
+
+
+def make_svn_repo(root, total_size, file_count, compressibility, work_dir, wc_root):
+    """Generate an svn repo with the tree imported in one revision and check it out to wc_root"""
+    subprocess.check_call(['svnadmin', 'create', root])
+    tree = os.path.join(work_dir, 'svn-import')
+    make_tree(tree, total_size, file_count, compressibility)
+    trunk_url = 'file://' + os.path.abspath(root) + '/trunk'
+    subprocess.check_call(['svn', 'import', '-q', '-m', 'import', tree, trunk_url])
+    shutil.rmtree(tree)
+    subprocess.check_call(['svn', 'checkout', '-q', trunk_url, wc_root])
+
+
+def make_trac_env(root, total_size, file_count, compressibility):
+    """Generate a trac environment with the tree as its attachments"""
+    subprocess.check_call([TRAC_ADMIN, root, 'initenv', 'benchmark', 'sqlite:db/trac.db'],
+                          stdout=subprocess.DEVNULL)
+    make_tree(os.path.join(root, 'files', 'attachments'), total_size, file_count, compressibility)
+
+
+#
+# S3 stand-in
+#
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise Exception('S3 stand-in did not start listening on port {}'.format(port))
+
+
+def start_s3(kind, work_dir, env):
+    """Start the S3 stand-in. Return the process and its endpoint url"""
+    port = free_port()
+    if kind == 'moto':
+        cmd = [sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)]
+    else:
+        env = dict(env, MINIO_ROOT_USER=env['AWS_ACCESS_KEY_ID'], MINIO_ROOT_PASSWORD=env['AWS_SECRET_ACCESS_KEY'])
+        cmd = ['minio', 'server', os.path.join(work_dir, 'minio'), '--address', '127.0.0.1:{}'.format(port), '--quiet']
+    server = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return server, 'http://127.0.0.1:{}'.format(port)
+
+
+#
+# Running a case, in a child process
+#
+
+class DiskHighWater:
+    """Track the largest total size of the files under dirs, sampled every interval seconds"""
+
+    def __init__(self, dirs, interval=0.2):
+        self.dirs = dirs
+        self.interval = interval
+        self.high_water = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        total = 0
+        for top in self.dirs:
+            for root, _, files in os.walk(top):
+                for name in files:
+                    try:
+                        total += os.lstat(os.path.join(root, name)).st_size
+                    except OSError:
+                        pass
+        self.high_water = max(self.high_water, total)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def case_call(name, function, options, work_dir, mysql_db=None):
+    """Return the arguments of the backup_util function for the case and the data it processes,
+    None when it is measured after the call"""
+    sources = os.path.join(work_dir, 'sources')
+    archives = os.path.join(work_dir, 'archives', name)
+    log_file = os.path.join(work_dir, 'logs', name + '.log')
+    target = os.path.join(work_dir, 'restored', name)
+    tree = os.path.join(sources, 'tree')
+    if function == 'backup_dir':
+        # everything but 7z is a tar stream
+        tar_based = options.get('stream_to_s3') or options.get('index') or options.get('codec', '7z') != '7z'
+        ext = '.tar.gpg' if tar_based else '.7z'
+        return [name, tree, os.path.join(archives, name + ext), BUCKET_NAME, log_file], options, tree
+    if function == 'backup_git_repo':
+        repo = os.path.join(sources, 'git')
+        return [name, repo, os.path.join(archives, name + '.7z'), BUCKET_NAME, log_file], options, repo
+    if function == 'backup_svn_repo':
+        repo = os.path.join(sources, 'svn')
+        return [name, repo, os.path.join(archives, name + '.7z'), BUCKET_NAME, log_file], options, repo
+    if function == 'backup_svn_wc':
+        wc = os.path.join(sources, 'svn-wc')
+        return [name, wc, os.path.join(archives, name + '.7z'), BUCKET_NAME, log_file], options, wc
+    if function == 'backup_trac':
+        trac = os.path.join(sources, 'trac')
+        return [name, trac, os.path.join(archives, name + '.7z'), BUCKET_NAME, log_file], options, trac
+    if function in ('backup_mysql_db', 'backup_lamp'):
+        return [name, mysql_db, os.path.join(archives, name + '.7z'), BUCKET_NAME, log_file], options, None
+    if function == 'backup_latest':
+        return [name, os.path.join(sources, 'latest', '*'), BUCKET_NAME, log_file], options, os.path.join(sources, 'latest')
+    if function == 'download_latest':
+        return [BUCKET_NAME, 'backup_dir_7z', target, log_file], options, None
+    if function == 'restore_latest':
+        prefix = 'backup_dir_stream' if name.endswith('stream') else 'backup_dir_7z'
+        return [BUCKET_NAME, prefix, target, log_file], options, None
+    if function == 'restore_files':
+        return [BUCKET_NAME, 'backup_dir_index.tar.gpg', ['d00'], target, log_file], options, None
+    if function == 'restore_dedup_snapshot':
+        return [BUCKET_NAME, 'backup_dir_dedup', target, log_file], options, None
+    raise Exception('Unknown case function ' + function)
+
+
+def run_case(name, function, options, work_dir, mysql_db=None):
+    """Run the case in this process and return its results"""
+    import backup_util
+
+    # keep the password and the persistent caches inside the work dir
+    password_path = os.path.join(work_dir, 's3-archive.pwd')
+    backup_util._get_s3_archive_pwd_path = lambda: password_path
+    cache_dir = os.path.join(work_dir, 'cache')
+    backup_util.DEDUP_INDEX_DIR = cache_dir
+    backup_util.GIT_MIRROR_CACHE_DIR = os.path.join(cache_dir, 'git')
+    backup_util.SVN_STAGING_DIR = os.path.join(cache_dir, 'svn')
+    backup_util.MYSQL_STATE_DIR = os.path.join(cache_dir, 'mysql')
+    backup_util.FINGERPRINT_DIR = os.path.join(cache_dir, 'fingerprints')
+    backup_util.STAGING_STATE_DIR = os.path.join(cache_dir, 'staging')
+    backup_util.INCREMENTAL_STATE_DIR = os.path.join(cache_dir, 'incremental')
+    backup_util.UPLOAD_JOURNAL_DIR = os.path.join(cache_dir, 'uploads')
+
+    phases = []
+    make_phase = backup_util._make_phase
+
+    def record_phase(*args, **kwargs):
+        phase = make_phase(*args, **kwargs)
+        phases.append(phase)
+        return phase
+    backup_util._make_phase = record_phase
+
+    args, kwargs, source = case_call(name, function, options, work_dir, mysql_db)
+    source_bytes = backup_util._dir_size(source) if source else None
+    with DiskHighWater([os.environ['TMPDIR'], os.path.join(work_dir, 'archives'),
+                        os.path.join(work_dir, 'restored'), cache_dir]) as disk:
+        start = time.monotonic()
+        result = getattr(backup_util, function)(*args, **kwargs)
+        seconds = time.monotonic() - start
+    if source_bytes is None and function.startswith('backup_'):
+        # database dumps: what got archived
+        source_bytes = max([phase['bytes_in'] for phase in phases if phase['bytes_in'] is not None] or [0])
+    elif source_bytes is None:
+        # downloads and restores: measure what they produced
+        source_bytes = backup_util._dir_size(os.path.join(work_dir, 'restored', name))
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    children_peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    for phase in phases:
+        processed = phase['bytes_in'] if phase['bytes_in'] is not None else phase['bytes_out']
+        phase['mb_per_s'] = processed / phase['seconds'] / 1e6 if processed is not None and phase['seconds'] else None
+    return {'name': name, 'function': function, 'options': options,
+            'retval': result['retval'], 'status_brief': result['status_brief'],
+            'seconds': seconds, 'bytes': source_bytes,
+            'mb_per_s': source_bytes / seconds / 1e6 if seconds else None,
+            'peak_rss_bytes': peak_rss, 'children_peak_rss_bytes': children_peak_rss,
+            'temp_disk_high_water_bytes': disk.high_water,
+            'phases': phases}
+
+
+#
+# Driver
+#
+
+def prepare_sources(args, work_dir):
+    sources = os.path.join(work_dir, 'sources')
+    make_tree(os.path.join(sources, 'tree'), args.size, args.files, args.compressibility)
+    skipped = {}
+    if shutil.which('git'):
+        make_git_repo(os.path.join(sources, 'git'), args.size, args.files, args.compressibility)
+    else:
+        skipped['backup_git_repo'] = 'git not found'
+    if shutil.which('svnadmin') and shutil.which('svn'):
+        make_svn_repo(os.path.join(sources, 'svn'), args.size, args.files, args.compressibility, work_dir,
+                      os.path.join(sources, 'svn-wc'))
+    else:
+        skipped['backup_svn_repo'] = skipped['backup_svn_wc'] = 'svn not found'
+    if os.access(TRAC_ADMIN, os.X_OK):
+        make_trac_env(os.path.join(sources, 'trac'), args.size, args.files, args.compressibility)
+    else:
+        skipped['backup_trac'] = TRAC_ADMIN + ' not found'
+    if not args.mysql_db:
+        skipped['backup_mysql_db'] = skipped['backup_lamp'] = 'no --mysql-db given'
+    else:
+        if not shutil.which('mydumper'):
+            skipped['backup_mysql_db'] = 'mydumper not found'
+        if not shutil.which('mysqldump'):
+            skipped['backup_lamp'] = 'mysqldump not found'
+        else:
+            import backup_util
+            missing = [src for src, _ in backup_util._LAMP_SOURCES if not os.path.isdir(src)]
+            if missing:
+                skipped['backup_lamp'] = ', '.join(missing) + ' not found'
+    os.makedirs(os.path.join(sources, 'latest'))
+    with open(os.path.join(sources, 'latest', 'latest.bin'), 'wb') as f:
+        f.write(make_content(random.Random(1), args.size, args.compressibility))
+    with open(os.path.join(work_dir, 's3-archive.pwd'), 'w') as f:
+        f.write(ARCHIVE_PASSWORD)
+    return skipped
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='backup_util-benchmark-', dir=args.work_dir)
+    env = dict(os.environ,
+               TMPDIR=os.path.join(work_dir, 'tmp'),
+               AWS_ACCESS_KEY_ID=os.environ.get('AWS_ACCESS_KEY_ID', 'benchmark'),
+               AWS_SECRET_ACCESS_KEY=os.environ.get('AWS_SECRET_ACCESS_KEY', 'benchmark-secret'),
+               AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+               PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.abspath(__file__))] +
+                                          [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    os.makedirs(env['TMPDIR'])
+    os.makedirs(os.path.join(work_dir, 'logs'))
+    server = None
+    try:
+        if args.s3 == 'external':
+            endpoint_url = args.endpoint_url
+        else:
+            server, endpoint_url = start_s3(args.s3, work_dir, env)
+        env['AWS_ENDPOINT_URL'] = endpoint_url
+
+        import boto3
+        boto3.client('s3', endpoint_url=endpoint_url, aws_access_key_id=env['AWS_ACCESS_KEY_ID'],
+                     aws_secret_access_key=env['AWS_SECRET_ACCESS_KEY'],
+                     region_name=env['AWS_DEFAULT_REGION']).create_bucket(Bucket=BUCKET_NAME)
+
+        skipped = prepare_sources(args, work_dir)
+        wanted = args.cases.split(',') if args.cases else [case[0] for case in CASES]
+        results = []
+        for name, function, options, depends in CASES:
+            if name not in wanted:
+                continue
+            missing = [dep for dep in depends if not any(r['name'] == dep and r.get('retval') for r in results)]
+            if function in skipped or missing:
+                reason = skipped.get(function) or 'needs ' + ', '.join(missing)
+                results.append({'name': name, 'function': function, 'skipped': reason})
+                print('{:<24} skipped: {}'.format(name, reason))
+                continue
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case',
+                                   json.dumps([name, function, options, work_dir, args.mysql_db])],
+                                  env=env, stdout=subprocess.PIPE, universal_newlines=True)
+            if proc.returncode != 0:
+                result = {'name': name, 'function': function, 'retval': False,
+                          'status_brief': 'benchmark process exited with {}'.format(proc.returncode)}
+            else:
+                result = json.loads(proc.stdout.splitlines()[-1])
+            results.append(result)
+            print_result(result)
+        return {'started': datetime.datetime.now().isoformat(),
+                'host': {'platform': platform.platform(), 'python': platform.python_version(),
+                         'cpu_count': os.cpu_count()},
+                'params': {'size': args.size, 'files': args.files, 'compressibility': args.compressibility,
+                           's3': args.s3},
+                'cases': results}
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        if not args.keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_result(result):
+    if not result.get('retval'):
+        print('{:<24} FAILED: {}'.format(result['name'], result.get('status_brief')))
+        return
+    print('{:<24} {:8.2f} s {:8.1f} MB/s  rss {:6.0f} MB  children rss {:6.0f} MB  temp disk {:8.1f} MB'.format(
+        result['name'], result['seconds'], result['mb_per_s'] or 0, result['peak_rss_bytes'] / 1e6,
+        result['children_peak_rss_bytes'] / 1e6, result['temp_disk_high_water_bytes'] / 1e6))
+    for phase in result['phases']:
+        print('    {:<20} {:8.2f} s {:8.1f} MB/s'.format(phase['phase'], phase['seconds'], phase['mb_per_s'] or 0))
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = dict((case['name'], case) for case in json.load(f)['cases'] if case.get('retval'))
+    with open(new_path) as f:
+        new = [case for case in json.load(f)['cases'] if case.get('retval')]
+    for case in new:
+        if case['name'] not in old:
+            continue
+        before = old[case['name']]
+        print('{:<24} {:8.2f} s -> {:8.2f} s ({:+.1f}%)  rss {:6.0f} -> {:6.0f} MB  temp disk {:8.1f} -> {:8.1f} MB'.format(
+            case['name'], before['seconds'], case['seconds'], (case['seconds'] / before['seconds'] - 1) * 100,
+            before['peak_rss_bytes'] / 1e6, case['peak_rss_bytes'] / 1e6,
+            before['temp_disk_high_water_bytes'] / 1e6, case['temp_disk_high_water_bytes'] / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=parse_size, default=parse_size('100M'),
+                        help='size of each generated source, e.g. 500M (default 100M)')
+    parser.add_argument('--files', type=int, default=1000, help='number of files in each generated source')
+    parser.add_argument('--compressibility', type=float, default=0.5,
+                        help='share of compressible text in the generated files, 0 to 1 (default 0.5)')
+    parser.add_argument('--s3', choices=['moto', 'minio', 'external'], default='moto', help='S3 stand-in to use')
+    parser.add_argument('--endpoint-url', help='endpoint of the S3 server for --s3 external')
+    parser.add_argument('--cases', help='comma separated cases to run, all by default: ' +
+                        ', '.join(case[0] for case in CASES))
+    parser.add_argument('--mysql-db', help='existing MySQL database to run backup_mysql_db and backup_lamp on')
+    parser.add_argument('--work-dir', help='where to create the scratch directory (default: system temp dir)')
+    parser.add_argument('--keep-work-dir', action='store_true', help='do not remove the scratch directory')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(*json.loads(args.run_case))))
+        return
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.s3 == 'external' and not args.endpoint_url:
+        parser.error('--s3 external needs --endpoint-url')
+    results = run(args)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
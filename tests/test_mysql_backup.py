@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Full and binlog incremental backups of a MySQL database restored with myloader and mysqlbinlog.
+
+Runs against a local MySQL or MariaDB server with binary logging enabled, connected to as by backup_util
+(MySQL option files) plus the options in BACKUP_UTIL_TEST_MYSQL_OPTIONS, e.g. '--defaults-file=/path/to/test.cnf'.
+Skipped when the server or mydumper, myloader, mysqlbinlog are not available.
+"""
+
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import backup_util  # noqa: E402
+
+MYSQL_OPTIONS = shlex.split(os.environ.get('BACKUP_UTIL_TEST_MYSQL_OPTIONS', ''))
+
+
+def mysql(sql, database=None):
+    cmd = ['mysql'] + MYSQL_OPTIONS + ['--batch', '--skip-column-names', '-e', sql] + ([database] if database else [])
+    return subprocess.check_output(cmd, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def skip_reason():
+    for tool in ('mysql', 'mydumper', 'myloader', 'mysqlbinlog'):
+        if not shutil.which(tool):
+            return tool + ' not found'
+    try:
+        log_bin = mysql("SHOW VARIABLES LIKE 'log_bin'")
+    except (subprocess.CalledProcessError, OSError) as e:
+        return 'no MySQL server reachable: {}'.format(e)
+    if 'ON' not in log_bin.upper():
+        return 'binary logging is off'
+    return None
+
+
+SKIP_REASON = skip_reason()
+
+
+@unittest.skipIf(SKIP_REASON, SKIP_REASON)
+class MysqlIncrementalBackupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='backup_util-test-')
+        self.db_name = 'backup_util_test_{}'.format(os.getpid())
+        self.restored_db_name = self.db_name + '_restored'
+        self.settings = dict((name, getattr(backup_util, name))
+                             for name in ('MYSQL_CLIENT_OPTIONS', 'MYSQL_STATE_DIR', 'INCREMENTAL_STATE_DIR'))
+        backup_util.MYSQL_CLIENT_OPTIONS = MYSQL_OPTIONS
+        backup_util.MYSQL_STATE_DIR = os.path.join(self.work_dir, 'mysql')
+        backup_util.INCREMENTAL_STATE_DIR = os.path.join(self.work_dir, 'incremental')
+        mysql('CREATE DATABASE {}'.format(self.db_name))
+        mysql('CREATE TABLE t (id INT PRIMARY KEY, v VARCHAR(32)) ENGINE=InnoDB', self.db_name)
+
+    def tearDown(self):
+        for name, value in self.settings.items():
+            setattr(backup_util, name, value)
+        for db_name in (self.db_name, self.restored_db_name):
+            mysql('DROP DATABASE IF EXISTS {}'.format(db_name))
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def insert(self, ids):
+        mysql('INSERT INTO t VALUES ' + ', '.join("({0}, 'row {0}')".format(i) for i in ids), self.db_name)
+
+    def dump(self, archive_name):
+        """Run the dump step of an incremental backup_mysql_db() job, save its state as a successful backup does"""
+        job = backup_util._make_job(backup_util.BackupKind.MYSQL, 'test', self.db_name,
+                                    os.path.join(self.work_dir, 'archives', archive_name), 'bucket',
+                                    os.path.join(self.work_dir, 'backup.log'), incremental=True)
+        temp_dir = tempfile.mkdtemp(dir=self.work_dir)
+        ret = backup_util._dump_mysql(job, temp_dir)
+        self.assertTrue(ret['ret'], ret.get('description'))
+        for path, data in ret['state'].items():
+            backup_util._save_json_file(path, data)
+        return ret['src_dir']
+
+    def test_full_and_binlog_backup_restore(self):
+        self.insert(range(1, 4))
+        full_dir = self.dump('test_20240101.7z')
+        self.insert(range(4, 6))
+        mysql("UPDATE t SET v = 'changed' WHERE id = 1", self.db_name)
+        binlog_dir = self.dump('test_20240102.7z')
+        self.assertEqual(os.path.basename(binlog_dir), 'binlog')
+
+        # the retention keeps the binlog archive with the full dump it builds on
+        self.assertEqual(backup_util._incremental_bases(),
+                         {'test_20240101.7z': 'test_20240101.7z', 'test_20240102.7z': 'test_20240101.7z'})
+
+        mysql('CREATE DATABASE {}'.format(self.restored_db_name))
+        subprocess.check_call(['myloader'] + MYSQL_OPTIONS +
+                              ['--directory', full_dir, '--source-db', self.db_name,
+                               '--database', self.restored_db_name, '--overwrite-tables'])
+        replay = backup_util._load_json_file(os.path.join(binlog_dir, 'binlog.json'))
+        binlogs = sorted(name for name in os.listdir(binlog_dir) if name != 'binlog.json')
+        self.assertEqual(binlogs[0], replay['start_file'])
+        events = subprocess.check_output(
+            ['mysqlbinlog', '--start-position={}'.format(replay['start_position']),
+             '--database=' + replay['database'],
+             '--rewrite-db={}->{}'.format(replay['database'], self.restored_db_name)] +
+            [os.path.join(binlog_dir, name) for name in binlogs])
+        subprocess.run(['mysql'] + MYSQL_OPTIONS + [self.restored_db_name], input=events, check=True)
+
+        rows = [line.split('\t') for line in mysql('SELECT id, v FROM t ORDER BY id', self.restored_db_name).splitlines()]
+        self.assertEqual(rows, [['1', 'changed'], ['2', 'row 2'], ['3', 'row 3'], ['4', 'row 4'], ['5', 'row 5']])
+
+
+if __name__ == '__main__':
+    unittest.main()
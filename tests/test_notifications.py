@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""NotificationQueue delivering to an SMTP stand-in running in process on localhost"""
+
+import email
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import backup_util  # noqa: E402
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib, the mails received go to server.mails"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        with self.server.lock:
+            self.server.sessions += 1
+        self.reply('220 localhost SMTP stand-in')
+        data = None
+        for line in self.rfile:
+            if data is not None:
+                if line == b'.\r\n':
+                    with self.server.lock:
+                        self.server.mails.append(email.message_from_bytes(b''.join(data)))
+                    data = None
+                    self.reply('250 OK')
+                else:
+                    data.append(line[1:] if line.startswith(b'..') else line)
+                continue
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.reply('250 localhost')
+            elif command in (b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                self.reply('250 OK')
+            elif command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SmtpServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', port), SmtpHandler)
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.mails = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class NotificationQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='backup_util-test-')
+        self.log_file = os.path.join(self.work_dir, 'notify.log')
+        self.settings = dict((name, getattr(backup_util, name))
+                             for name in ('NOTIFY_SPOOL_DIR', 'NOTIFY_RETRY_BACKOFF', 'NOTIFY_MAX_ATTEMPTS'))
+        backup_util.NOTIFY_SPOOL_DIR = os.path.join(self.work_dir, 'spool')
+        backup_util.NOTIFY_RETRY_BACKOFF = 0.01
+        backup_util.NOTIFY_MAX_ATTEMPTS = 2
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.stop()
+        for name, value in self.settings.items():
+            setattr(backup_util, name, value)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def make_queue(self, port, digest=False):
+        return backup_util.NotificationQueue('backup@localhost', ['admin@localhost'], self.log_file,
+                                             smtp_host='127.0.0.1', smtp_port=port, digest=digest)
+
+    def test_mails_share_one_connection(self):
+        self.server = SmtpServer()
+        notifications = self.make_queue(self.server.server_address[1])
+        for i in range(3):
+            notifications.send('mail {}'.format(i), 'text {}'.format(i))
+        status = notifications.close(timeout=30)
+        self.assertTrue(status['retval'], status['status_detailed'])
+        self.assertEqual([mail['Subject'] for mail in self.server.mails], ['mail 0', 'mail 1', 'mail 2'])
+        self.assertEqual(self.server.sessions, 1)
+
+    def test_digest_is_one_mail(self):
+        self.server = SmtpServer()
+        notifications = self.make_queue(self.server.server_address[1], digest=True)
+        notifications.notify({'retval': True, 'status_brief': '[S3 Backup] web: OK', 'status_detailed': 'done',
+                              'phases': [], 'seconds': 1.0})
+        notifications.notify({'retval': False, 'status_brief': '[S3 Backup] db: FAILED',
+                              'status_detailed': 'Error: dump failed', 'phases': [], 'seconds': 2.0})
+        status = notifications.close(timeout=30)
+        self.assertTrue(status['retval'], status['status_detailed'])
+        self.assertEqual(len(self.server.mails), 1)
+        mail = self.server.mails[0]
+        self.assertEqual(mail['Subject'], '[S3 Backup] Backup digest: 2 jobs, 1 FAILED')
+        text = ''.join(part.get_payload(decode=True).decode('utf-8') for part in mail.walk()
+                       if not part.is_multipart())
+        self.assertIn('[S3 Backup] web: OK', text)
+        self.assertIn('Error: dump failed', text)
+
+    def test_failed_mails_are_spooled_and_sent_later(self):
+        port = free_port()
+        notifications = self.make_queue(port)
+        notifications.send('while down', 'text')
+        status = notifications.close(timeout=30)
+        self.assertFalse(status['retval'])
+        self.assertEqual(len(backup_util._spooled_emails()), 1)
+
+        self.server = SmtpServer(port)
+        notifications = self.make_queue(port)
+        notifications.send('once up', 'text')
+        status = notifications.close(timeout=30)
+        self.assertTrue(status['retval'], status['status_detailed'])
+        self.assertEqual([mail['Subject'] for mail in self.server.mails], ['while down', 'once up'])
+        self.assertEqual(backup_util._spooled_emails(), [])
+        self.assertEqual(self.server.sessions, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()